@@ -0,0 +1,240 @@
+"""
+Syncs a directory to a release without a patch, in the style of zsync.
+
+The server publishes a manifest of the release listing, for each file, its
+size, md5 and the adler32 and md5 of each of its blocks, and serves the
+files of the release as they are. A client on any version scans its local
+files with a rolling checksum (see rsyncdelta.py) to find the blocks it
+already has, and fetches only the rest of the data using Range requests.
+
+The output is a directory in the same form as that made by
+patchdiff.mergePatches, so it is applied with patchdiff.applyPatchDirectory
+"""
+
+import os
+import json
+import hashlib
+import urllib
+
+import patchdiff
+import rsyncdelta
+from partialdl import openRange
+
+MANIFEST_VERSION = 1
+
+#missing blocks are fetched in requests of at most this many bytes
+MAX_FETCH_SIZE = 16*1024*1024
+
+class SyncError(Exception):
+    """
+    Raised when the manifest is invalid or the data fetched is corrupt
+    """
+    pass
+
+def generateManifest(newDir, manifestFile, size=None):
+    """
+    Writes the manifest of the files in newDir to manifestFile
+
+    size - The block size. If None it is picked from the size of the
+           largest file (see rsyncdelta.blockSize)
+    """
+    files = {}
+    dirs = sorted(patchdiff._listDirs(newDir))
+    sizes = patchdiff._fileSizes(newDir)
+    if size is None:
+        size = rsyncdelta.blockSize(max(sizes.values() or [0]))
+
+    for fn in sorted(sizes):
+        path = os.path.join(newDir, fn)
+        files[fn.replace(os.sep, '/')] = {
+            'size' : sizes[fn],
+            'md5' : patchdiff._getFileMd5(path),
+            'blocks' : [[weak, strong.encode('hex')] for weak, strong
+                            in rsyncdelta.blockDigests(path, size)],
+        }
+
+    with open(manifestFile, 'w') as f:
+        f.write(json.dumps({
+            'version' : MANIFEST_VERSION,
+            'blocksize' : size,
+            'files' : files,
+            'dirs' : [d.replace(os.sep, '/') for d in dirs],
+        }))
+
+def readManifest(manifestFile):
+    try:
+        with open(manifestFile) as f:
+            manifest = json.loads(f.read())
+        if manifest['version'] > MANIFEST_VERSION:
+            raise SyncError('The manifest is too new to read')
+        for fn, info in manifest['files'].iteritems():
+            parts = fn.split('/')
+            if fn.startswith('/') or '..' in parts or '' in parts:
+                raise SyncError('The manifest has the unsafe path ' + fn)
+            info['size'], info['md5'], info['blocks']
+        manifest['blocksize'], manifest['dirs']
+    except (ValueError, KeyError, TypeError):
+        raise SyncError(manifestFile + ' isn\'t a valid manifest')
+    return manifest
+
+def sync(localDir, manifest, outDir, baseUrl, fetch=openRange,
+         oldManifest=None):
+    """
+    Writes the files of the release described by manifest that differ from
+    those in localDir to outDir, as patchdiff.mergePatches does. Blocks that
+    are in any of the local files that have changed (or been removed) are
+    reused, the rest are fetched from the files under baseUrl
+
+    manifest - The manifest, from readManifest
+    oldManifest - The manifest of the release localDir has. Only the files
+                  and directories in it that aren't in manifest are
+                  deleted, so files that aren't part of the release (such
+                  as the patcher's own config and downloads, or files the
+                  user made) are left alone. If None nothing is deleted
+    fetch - The function used to fetch data, given the url of a file, the
+            offset and the length. It returns a file like object to read the
+            data from
+
+    Returns a report dict, with the number of bytes that were 'reused' and
+    'fetched'
+    """
+    files = _manifestFiles(manifest)
+    localSizes = patchdiff._fileSizes(localDir)
+    changed = []
+    for fn in sorted(files):
+        if (localSizes.get(fn) != files[fn]['size']
+                or patchdiff._getFileMd5(os.path.join(localDir, fn))
+                    != files[fn]['md5']):
+            changed.append(fn)
+
+    oldFiles = set()
+    oldDirs = set()
+    if oldManifest is not None:
+        oldFiles = set(_manifestFiles(oldManifest))
+        oldDirs = set(d.replace('/', os.sep) for d in oldManifest['dirs'])
+    removed = sorted(fn for fn in localSizes
+                        if fn in oldFiles and fn not in files)
+
+    seeds = [fn for fn in changed if fn in localSizes] + removed
+    report = _syncFiles(localDir, manifest, changed, seeds,
+                        os.path.join(outDir, patchdiff.MERGED_FILES),
+                        baseUrl, fetch)
+
+    localDirs = patchdiff._listDirs(localDir)
+    newDirs = set(d.replace('/', os.sep) for d in manifest['dirs'])
+    patchdiff._mkdirs(outDir)
+    with open(os.path.join(outDir, patchdiff.PATCH_CFG), 'w') as f:
+        f.write(json.dumps({
+            'deleted' : removed,
+            'deleteddirs' : sorted((localDirs & oldDirs) - newDirs),
+        }))
+    return report
+
+def repair(localDir, manifest, fns, outDir, baseUrl, fetch=openRange):
+    """
+    Writes the files fns, as they are in the release described by manifest,
+    to outDir. The local copies of the files (which may be damaged) are
+    used as the base, so only the blocks of them that differ are fetched.
+    Files that aren't in the manifest are skipped
+
+    Returns a report dict, as sync does
+    """
+    files = _manifestFiles(manifest)
+    fns = [fn for fn in fns if fn in files]
+    seeds = [fn for fn in fns if os.path.isfile(os.path.join(localDir, fn))]
+    return _syncFiles(localDir, manifest, fns, seeds, outDir, baseUrl, fetch)
+
+def _manifestFiles(manifest):
+    return dict((fn.replace('/', os.sep), info)
+                for fn, info in manifest['files'].iteritems())
+
+def _syncFiles(localDir, manifest, changed, seeds, outDir, baseUrl, fetch):
+    """
+    Writes the files changed to outDir, reusing any of their blocks that
+    are in the local files seeds
+    """
+    size = manifest['blocksize']
+    files = _manifestFiles(manifest)
+    report = {
+        'reused' : 0,
+        'fetched' : 0,
+    }
+
+    #the blocks still needed, and where they were found locally
+    signatures = {}
+    for fn in changed:
+        for i, (weak, strong) in enumerate(files[fn]['blocks']):
+            signatures.setdefault(weak, {}).setdefault(
+                strong.decode('hex'), []).append((fn, i))
+    found = {}
+    for seed in seeds:
+        if len(found) == sum(len(files[fn]['blocks']) for fn in changed):
+            break
+        offset = 0
+        for data, blocks in rsyncdelta.scan(os.path.join(localDir, seed),
+                                            size, signatures):
+            offset += len(data)
+            if blocks is not None:
+                for block in blocks:
+                    found.setdefault(block, (seed, offset))
+                offset += size
+
+    for fn in changed:
+        out = os.path.join(outDir, fn)
+        patchdiff._mkdirs(os.path.dirname(out))
+        url = baseUrl + urllib.quote(fn.replace(os.sep, '/'))
+        with open(out, 'wb') as fout:
+            _writeFile(fout, localDir, files[fn], size, found, fn, url,
+                       fetch, report)
+        if patchdiff._getFileMd5(out) != files[fn]['md5']:
+            raise SyncError('The synced file ' + fn + ' is corrupt')
+    return report
+
+def _writeFile(fout, localDir, info, size, found, fn, url, fetch, report):
+    """
+    Writes the file fn to fout, from the blocks that were found and
+    the data fetched from url for the rest
+    """
+    blocks = info['blocks']
+    i = 0
+    while i < len(blocks):
+        if (fn, i) in found:
+            seed, offset = found[(fn, i)]
+            with open(os.path.join(localDir, seed), 'rb') as f:
+                f.seek(offset)
+                fout.write(f.read(size))
+            report['reused'] += size
+            i += 1
+            continue
+
+        #fetch the run of missing blocks in one go
+        end = i
+        while (end < len(blocks) and (fn, end) not in found
+                and (end - i + 1) * size <= MAX_FETCH_SIZE):
+            end += 1
+        _fetch(fout, url, i * size, (end - i) * size, fetch, report,
+               blocks[i:end], size)
+        i = end
+
+    tail = info['size'] - len(blocks) * size
+    if tail:
+        _fetch(fout, url, len(blocks) * size, tail, fetch, report)
+
+def _fetch(fout, url, offset, length, fetch, report, blocks=(), size=None):
+    """
+    Fetches the data at offset in url to fout, checking it against the
+    (adler32, md5) of the blocks it holds
+    """
+    src = fetch(url, offset, length)
+    try:
+        data = src.read(length)
+    finally:
+        src.close()
+    if len(data) != length:
+        raise SyncError('Not all of ' + url + ' could be fetched')
+    for i, (weak, strong) in enumerate(blocks):
+        block = data[i * size:(i + 1) * size]
+        if hashlib.md5(block).hexdigest() != strong:
+            raise SyncError('The data fetched from ' + url + ' is corrupt')
+    fout.write(data)
+    report['fetched'] += length
@@ -0,0 +1,403 @@
+"""
+A single file container for patches, which can be used instead of a zip.
+
+Unlike a zip, everything needed to find an entry is in a table at the
+start of the file, so a reader only has to parse the table to read any
+entry, and each entry carries the md5 of its payload so it can be checked
+on its own. The payloads are aligned to pages so they can be read straight
+from a memory map of the file.
+
+The layout (all integers are little endian) is
+
+    header - MAGIC, the format version (uint16), the number of entries
+             (uint32) and the offset of the first payload (uint64)
+    table  - For each entry, the length of its name (uint16), its name
+             (utf-8, with '/' between directories), its codec (uint8), the
+             offset and length of its payload and its size once decoded
+             (uint64s) and the md5 of its payload (16 bytes)
+    payloads - Each starting on a PAGE_SIZE boundary, in table order
+"""
+
+import os
+import mmap
+import struct
+import hashlib
+import zlib
+import bz2
+
+MAGIC = 'PYPATCH\0'
+VERSION = 1
+
+#payloads start on multiples of this
+PAGE_SIZE = 4096
+
+#the codecs a payload can be encoded with and their ids in the table.
+#deflate is raw deflate (no zlib header), as in zip files
+CODECS = {
+    'stored' : 0,
+    'deflate' : 1,
+    'bz2' : 2,
+}
+
+HEADER = struct.Struct('<8sHIQ')
+ENTRY_NAME_LENGTH = struct.Struct('<H')
+ENTRY = struct.Struct('<BQQQ16s')
+
+#the size of the blocks (in bytes) payloads are read and decoded in
+CHUNK_SIZE = 1024*1024
+
+class ContainerError(Exception):
+    """
+    Raised when a container is corrupt or can't be read
+    """
+    pass
+
+def isContainer(filePath):
+    with open(filePath, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def _align(offset):
+    return (offset + PAGE_SIZE - 1) // PAGE_SIZE * PAGE_SIZE
+
+def _fileMd5(filePath):
+    h = hashlib.md5()
+    with open(filePath, 'rb') as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            h.update(data)
+    return h.digest()
+
+def write(outputFile, entries):
+    """
+    Writes a container holding the given entries, in the given order
+
+    entries - A list of (name, path, codec, size) where path is the file
+              holding the payload, which is already encoded with codec,
+              and size is the size of the entry once decoded
+    """
+    table = []
+    tableSize = HEADER.size
+    for name, path, codec, size in entries:
+        if codec not in CODECS:
+            raise ContainerError('Unknown codec ' + codec)
+        encodedName = name.encode('utf-8')
+        table.append([encodedName, path, CODECS[codec], 0,
+                      os.path.getsize(path), size, _fileMd5(path)])
+        tableSize += ENTRY_NAME_LENGTH.size + len(encodedName) + ENTRY.size
+
+    offset = dataOffset = _align(tableSize)
+    for entry in table:
+        entry[3] = offset
+        offset = _align(offset + entry[4])
+
+    with open(outputFile, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(table), dataOffset))
+        for name, path, codec, offset, length, size, md5 in table:
+            f.write(ENTRY_NAME_LENGTH.pack(len(name)))
+            f.write(name)
+            f.write(ENTRY.pack(codec, offset, length, size, md5))
+
+        for name, path, codec, offset, length, size, md5 in table:
+            f.write('\0' * (offset - f.tell()))
+            with open(path, 'rb') as fin:
+                while True:
+                    data = fin.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    f.write(data)
+
+def _parseHeader(data):
+    """
+    Returns the (entry count, data offset) from the header of a container
+    """
+    magic, version, count, dataOffset = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ContainerError('The file is not a container')
+    if version > VERSION:
+        raise ContainerError(('The container is version ' + str(version)
+                            + ' which is too new to read'))
+    return count, dataOffset
+
+def _parseTable(data, header, size=None):
+    """
+    Returns the list of entries in the table of a container
+
+    header - The (entry count, data offset) from _parseHeader
+    size - The size of the container, to check the entries against
+    """
+    count, dataOffset = header
+    entries = []
+    pos = HEADER.size
+    for i in xrange(count):
+        nameLength, = ENTRY_NAME_LENGTH.unpack_from(data, pos)
+        pos += ENTRY_NAME_LENGTH.size
+        name = data[pos:pos + nameLength].decode('utf-8')
+        pos += nameLength
+        codec, offset, length, decodedSize, md5 = ENTRY.unpack_from(data, pos)
+        pos += ENTRY.size
+        if pos > dataOffset:
+            raise ContainerError('The table overlaps the payloads')
+        if offset < dataOffset or (size is not None and offset + length > size):
+            raise ContainerError('The entry ' + name + ' is out of bounds')
+        if entries and offset < entries[-1]['offset'] + entries[-1]['length']:
+            raise ContainerError('The entry ' + name + ' is out of order')
+
+        entries.append({
+            'name' : name,
+            'codec' : codec,
+            'offset' : offset,
+            'length' : length,
+            'size' : decodedSize,
+            'md5' : md5,
+        })
+    return entries
+
+def _entryPath(destDir, name):
+    """
+    Returns the path an entry is extracted to, making its directory
+    """
+    parts = name.split('/')
+    if name.startswith('/') or '..' in parts or '' in parts:
+        raise ContainerError('The entry ' + name + ' has an unsafe name')
+    dst = os.path.join(destDir, *parts)
+    if not os.path.exists(os.path.dirname(dst)):
+        os.makedirs(os.path.dirname(dst))
+    return dst
+
+class _Decoder:
+    """
+    Decodes the payload of an entry a chunk at a time, checking it
+    """
+    def __init__(self, entry):
+        self.entry = entry
+        if entry['codec'] == CODECS['deflate']:
+            self.decompressor = zlib.decompressobj(-15)
+        elif entry['codec'] == CODECS['bz2']:
+            self.decompressor = bz2.BZ2Decompressor()
+        elif entry['codec'] == CODECS['stored']:
+            self.decompressor = None
+        else:
+            raise ContainerError('The entry ' + entry['name']
+                               + ' has an unknown codec')
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def decode(self, chunk):
+        self.md5.update(chunk)
+        if self.decompressor is not None:
+            try:
+                chunk = self.decompressor.decompress(chunk)
+            except (zlib.error, IOError, EOFError):
+                raise ContainerError('The entry ' + self.entry['name']
+                                   + ' could not be decoded')
+        self.size += len(chunk)
+        return chunk
+
+    def finish(self):
+        """
+        Returns any remaining data, raising a ContainerError if the entry
+        is corrupt
+        """
+        chunk = ''
+        if self.entry['codec'] == CODECS['deflate']:
+            chunk = self.decompressor.flush()
+            self.size += len(chunk)
+        if (self.md5.digest() != self.entry['md5']
+                or self.size != self.entry['size']):
+            raise ContainerError('The entry ' + self.entry['name']
+                               + ' is corrupt')
+        return chunk
+
+class ContainerReader:
+    """
+    Reads entries from a container. Only the header and table are read when
+    it is opened, the payloads are read (and checked) as they are needed
+    """
+    def __init__(self, filePath):
+        self.filePath = filePath
+        self.entries = []
+        self.index = {}
+
+        self.f = open(filePath, 'rb')
+        try:
+            size = os.fstat(self.f.fileno()).st_size
+            if size < HEADER.size:
+                raise ContainerError(filePath + ' is too short')
+            self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ContainerError, mmap.error, EnvironmentError):
+            self.f.close()
+            raise
+        try:
+            self._readTable(size)
+        except struct.error:
+            self.close()
+            raise ContainerError(filePath + ' has a corrupt table')
+        except ContainerError:
+            self.close()
+            raise
+
+    def _readTable(self, size):
+        self.entries = _parseTable(self.map, _parseHeader(self.map), size)
+        for entry in self.entries:
+            self.index[entry['name']] = entry
+
+    def names(self):
+        return [e['name'] for e in self.entries]
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def _entry(self, name):
+        if name not in self.index:
+            raise ContainerError('There is no entry ' + name)
+        return self.index[name]
+
+    def verify(self, name):
+        """
+        Raises a ContainerError if the payload of an entry is corrupt
+        """
+        entry = self._entry(name)
+        h = hashlib.md5()
+        for chunk in self._chunks(entry):
+            h.update(chunk)
+        if h.digest() != entry['md5']:
+            raise ContainerError('The entry ' + name + ' is corrupt')
+
+    def _chunks(self, entry):
+        end = entry['offset'] + entry['length']
+        for pos in xrange(entry['offset'], end, CHUNK_SIZE):
+            yield self.map[pos:min(pos + CHUNK_SIZE, end)]
+
+    def _decoded(self, entry):
+        """
+        Yields the decoded data of an entry, checking the payload as it goes
+        """
+        decoder = _Decoder(entry)
+        for chunk in self._chunks(entry):
+            yield decoder.decode(chunk)
+        yield decoder.finish()
+
+    def read(self, name):
+        return ''.join(self._decoded(self._entry(name)))
+
+    def extract(self, name, destDir):
+        """
+        Extracts an entry to its path under destDir, returning the path
+        """
+        dst = _entryPath(destDir, name)
+
+        #written to a temporary file so a corrupt entry is never left behind
+        tmp = dst + '.part'
+        try:
+            with open(tmp, 'wb') as f:
+                for chunk in self._decoded(self._entry(name)):
+                    f.write(chunk)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(tmp, dst)
+        return dst
+
+    def extractAll(self, destDir):
+        for name in self.names():
+            self.extract(name, destDir)
+
+    def close(self):
+        if getattr(self, 'map', None) is not None:
+            self.map.close()
+            self.map = None
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class StreamReader:
+    """
+    Reads a container as it arrives (such as while it is downloading), so
+    each entry is extracted (and checked) as soon as all of it has arrived
+    rather than once the whole container has
+    """
+    def __init__(self, destDir, onEntry):
+        """
+        destDir - The directory to extract the entries to
+        onEntry - Called with the name of each entry and the path it was
+                  extracted to, in the order the entries are in
+        """
+        self.destDir = destDir
+        self.onEntry = onEntry
+
+        self.head = ''
+        self.entries = None
+        self.current = 0
+        self.pos = 0
+        self.out = None
+
+    def feed(self, data):
+        """
+        Reads the next part of the container
+        """
+        if self.entries is None:
+            self.head += data
+            if len(self.head) < HEADER.size:
+                return
+            header = _parseHeader(self.head)
+            if len(self.head) < header[1]:
+                return
+            try:
+                self.entries = _parseTable(self.head, header)
+            except struct.error:
+                raise ContainerError('The container has a corrupt table')
+            data = self.head[header[1]:]
+            self.pos = header[1]
+            self.head = None
+
+        while self.current < len(self.entries):
+            entry = self.entries[self.current]
+            end = entry['offset'] + entry['length']
+            if self.pos < entry['offset']:
+                skip = min(len(data), entry['offset'] - self.pos)
+                data = data[skip:]
+                self.pos += skip
+                if self.pos < entry['offset']:
+                    return
+
+            if self.out is None:
+                self.path = _entryPath(self.destDir, entry['name'])
+                self.out = open(self.path + '.part', 'wb')
+                self.decoder = _Decoder(entry)
+
+            take = min(len(data), end - self.pos)
+            if take:
+                self.out.write(self.decoder.decode(data[:take]))
+                data = data[take:]
+                self.pos += take
+            if self.pos < end:
+                return
+
+            self.out.write(self.decoder.finish())
+            self.out.close()
+            self.out = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(self.path + '.part', self.path)
+            self.current += 1
+            self.onEntry(entry['name'], self.path)
+
+    def done(self):
+        """
+        Returns true once every entry has been extracted
+        """
+        return self.entries is not None and self.current == len(self.entries)
+
+    def close(self):
+        if self.out is not None:
+            self.out.close()
+            self.out = None
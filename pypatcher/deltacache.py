@@ -0,0 +1,124 @@
+"""
+A persistent cache of generated deltas, so that generating patches from
+many historical versions doesn't diff the same pair of files again and again.
+
+Deltas are content addressed: they are keyed by the md5 of the old file,
+the md5 of the new file and the strategy (the patch type in the patch
+config) used to generate them. The cache is limited in size and the least
+recently used deltas are evicted first.
+"""
+
+import os
+import shutil
+import hashlib
+import sqlite3
+import time
+
+class DeltaCache:
+    """
+    The deltas are stored as files in a directory, with an sqlite database
+    holding their sizes and when they were last used
+    """
+    DB_NAME = 'deltas.sqlite'
+
+    def __init__(self, cacheDir, maxSize=1024*1024*1024):
+        """
+        cacheDir - The directory to store the deltas in
+        maxSize - The maximum total size (in bytes) of the stored deltas
+        """
+        if not os.path.exists(cacheDir):
+            os.makedirs(cacheDir)
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+
+        self.con = sqlite3.connect(os.path.join(cacheDir, self.DB_NAME))
+        self.con.row_factory = sqlite3.Row
+        self._sqlCreateTbl()
+
+    def _sqlCreateTbl(self):
+        cur = self.con.cursor()
+        cur.execute('''CREATE TABLE IF NOT EXISTS deltas (
+                           key varchar(255) PRIMARY KEY,
+                           size int,
+                           last_used real
+                       )''')
+        self.con.commit()
+
+    def _key(self, oldMd5, newMd5, strategy):
+        return '%s:%s:%s' % (oldMd5, newMd5, strategy)
+
+    def _path(self, key):
+        return os.path.join(self.cacheDir, hashlib.md5(key).hexdigest())
+
+    def get(self, oldMd5, newMd5, strategy, dst):
+        """
+        Copies the cached delta to dst. Returns False if there isn't
+        a cached delta
+        """
+        key = self._key(oldMd5, newMd5, strategy)
+        cur = self.con.cursor()
+        cur.execute('SELECT key FROM deltas WHERE key=?', (key,))
+        if cur.fetchone() is None:
+            return False
+
+        path = self._path(key)
+        if not os.path.exists(path):
+            #removed from under us, so forget about it
+            cur.execute('DELETE FROM deltas WHERE key=?', (key,))
+            self.con.commit()
+            return False
+
+        dstDir = os.path.dirname(dst)
+        if dstDir and not os.path.exists(dstDir):
+            os.makedirs(dstDir)
+        shutil.copyfile(path, dst)
+
+        cur.execute('UPDATE deltas SET last_used=? WHERE key=?',
+                    (time.time(), key))
+        self.con.commit()
+        return True
+
+    def put(self, oldMd5, newMd5, strategy, src):
+        """
+        Adds a copy of the delta in the file src to the cache, evicting
+        the least recently used deltas if the cache is too large
+        """
+        key = self._key(oldMd5, newMd5, strategy)
+        size = os.path.getsize(src)
+        if size > self.maxSize:
+            return
+
+        shutil.copyfile(src, self._path(key))
+        cur = self.con.cursor()
+        cur.execute('INSERT OR REPLACE INTO deltas VALUES (?,?,?)',
+                    (key, size, time.time()))
+        self.con.commit()
+        self._evict()
+
+    def size(self):
+        """
+        Returns the total size of the cached deltas
+        """
+        cur = self.con.cursor()
+        cur.execute('SELECT COALESCE(SUM(size), 0) AS total FROM deltas')
+        return cur.fetchone()['total']
+
+    def _evict(self):
+        total = self.size()
+        if total <= self.maxSize:
+            return
+
+        cur = self.con.cursor()
+        cur.execute('SELECT key, size FROM deltas ORDER BY last_used')
+        for row in cur.fetchall():
+            if total <= self.maxSize:
+                break
+            path = self._path(row['key'])
+            if os.path.exists(path):
+                os.remove(path)
+            cur.execute('DELETE FROM deltas WHERE key=?', (row['key'],))
+            total -= row['size']
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
@@ -1,2 +1,11 @@
-from .diff_match_patch import diff_match_patch, patch_obj
 
+from .diff_match_patch import diff_match_patch as pure_diff_match_patch, patch_obj
+
+#the NumPy backend gives identical results to the pure python reference
+#implementation, so use it whenever it is available
+try:
+    from .diff_match_patch_numpy import diff_match_patch_numpy
+except ImportError:
+    diff_match_patch_numpy = None
+
+diff_match_patch = diff_match_patch_numpy or pure_diff_match_patch
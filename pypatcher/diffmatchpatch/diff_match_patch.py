@@ -1512,6 +1512,29 @@ class diff_match_patch:
       patchesCopy.append(patchCopy)
     return patchesCopy
 
+  def patch_shallowCopy(self, patches):
+    """Given an array of patches, return another array of patch objects that
+    share their diffs lists with the originals (copy-on-write).
+    Functions which change a diffs list replace it rather than mutating it,
+    so the originals are never modified.
+
+    Args:
+      patches: Array of patch objects.
+
+    Returns:
+      Array of patch objects.
+    """
+    patchesCopy = []
+    for patch in patches:
+      patchCopy = patch_obj()
+      patchCopy.diffs = patch.diffs
+      patchCopy.start1 = patch.start1
+      patchCopy.start2 = patch.start2
+      patchCopy.length1 = patch.length1
+      patchCopy.length2 = patch.length2
+      patchesCopy.append(patchCopy)
+    return patchesCopy
+
   def patch_apply(self, patches, text):
     """Merge a set of patches onto the text.  Return a patched text, as well
     as a list of true/false values indicating which patches were applied.
@@ -1526,8 +1549,10 @@ class diff_match_patch:
     if not patches:
       return (text, [])
 
-    # Deep copy the patches so that no changes are made to originals.
-    patches = self.patch_deepCopy(patches)
+    # Copy the patches so that no changes are made to originals.  The diffs
+    # lists are only copied for the few patches that padding or splitting
+    # actually changes.
+    patches = self.patch_shallowCopy(patches)
 
     nullPadding = self.patch_addPadding(patches)
     text = nullPadding + text + nullPadding
@@ -1539,9 +1564,51 @@ class diff_match_patch:
     # has an effective expected position of 22.
     delta = 0
     results = []
+    # The text before done_length has been finalised into the done array and
+    # the remainder is pending + text[text_offset:].  Patches which match
+    # perfectly at their expected location (the common case) just extend
+    # done, instead of rebuilding the whole text for every patch.
+    done = []
+    done_length = 0
+    pending = ""
+    text_offset = 0
     for patch in patches:
       expected_loc = patch.start2 + delta
       text1 = self.diff_text1(patch.diffs)
+      rel_loc = expected_loc - done_length
+      if text1 and rel_loc >= 0 and self.Match_MaxBits != 0:
+        rel_end = rel_loc + len(text1)
+        window = (pending + text[text_offset:text_offset +
+                                 max(0, rel_end - len(pending))])
+        perfect = window[rel_loc:rel_end] == text1
+      else:
+        perfect = False
+      if perfect:
+        # Perfect match at the perfect spot.  match_main would return this
+        # location for text1 (or for both ends of an oversized text1).
+        results.append(True)
+        delta = 0
+        if rel_loc <= len(pending):
+          done.append(pending[:rel_loc])
+        else:
+          done.append(pending)
+          done.append(text[text_offset:text_offset + rel_loc - len(pending)])
+        if rel_end <= len(pending):
+          pending = self.diff_text2(patch.diffs) + pending[rel_end:]
+        else:
+          text_offset += rel_end - len(pending)
+          pending = self.diff_text2(patch.diffs)
+        done_length = expected_loc
+        continue
+      if done or pending:
+        # The fuzzy match needs the full text.
+        done.append(pending)
+        done.append(text[text_offset:])
+        text = "".join(done)
+        done = []
+        done_length = 0
+        pending = ""
+        text_offset = 0
       end_loc = -1
       if len(text1) > self.Match_MaxBits:
         # patch_splitMax will only provide an oversized pattern in the case of
@@ -1596,6 +1663,10 @@ class diff_match_patch:
                     self.diff_xIndex(diffs, index1 + len(data)):]
               if op != self.DIFF_DELETE:
                 index1 += len(data)
+    if done or pending:
+      done.append(pending)
+      done.append(text[text_offset:])
+      text = "".join(done)
     # Strip the padding off.
     text = text[len(nullPadding):-len(nullPadding)]
     return (text, results)
@@ -1621,11 +1692,13 @@ class diff_match_patch:
       patch.start2 += paddingLength
 
     # Add some padding on start of first diff.
+    # The diffs lists may be shared (see patch_shallowCopy), so new lists are
+    # assigned instead of changing them in place.
     patch = patches[0]
     diffs = patch.diffs
     if not diffs or diffs[0][0] != self.DIFF_EQUAL:
       # Add nullPadding equality.
-      diffs.insert(0, (self.DIFF_EQUAL, nullPadding))
+      patch.diffs = [(self.DIFF_EQUAL, nullPadding)] + diffs
       patch.start1 -= paddingLength  # Should be 0.
       patch.start2 -= paddingLength  # Should be 0.
       patch.length1 += paddingLength
@@ -1634,7 +1707,7 @@ class diff_match_patch:
       # Grow first equality.
       extraLength = paddingLength - len(diffs[0][1])
       newText = nullPadding[len(diffs[0][1]):] + diffs[0][1]
-      diffs[0] = (diffs[0][0], newText)
+      patch.diffs = [(diffs[0][0], newText)] + diffs[1:]
       patch.start1 -= extraLength
       patch.start2 -= extraLength
       patch.length1 += extraLength
@@ -1645,14 +1718,14 @@ class diff_match_patch:
     diffs = patch.diffs
     if not diffs or diffs[-1][0] != self.DIFF_EQUAL:
       # Add nullPadding equality.
-      diffs.append((self.DIFF_EQUAL, nullPadding))
+      patch.diffs = diffs + [(self.DIFF_EQUAL, nullPadding)]
       patch.length1 += paddingLength
       patch.length2 += paddingLength
     elif paddingLength > len(diffs[-1][1]):
       # Grow last equality.
       extraLength = paddingLength - len(diffs[-1][1])
       newText = diffs[-1][1] + nullPadding[:extraLength]
-      diffs[-1] = (diffs[-1][0], newText)
+      patch.diffs = diffs[:-1] + [(diffs[-1][0], newText)]
       patch.length1 += extraLength
       patch.length2 += extraLength
 
@@ -1674,6 +1747,8 @@ class diff_match_patch:
     for x in xrange(len(patches)):
       if patches[x].length1 > patch_size:
         bigpatch = patches[x]
+        # The diffs list is consumed below and may be shared with the caller.
+        bigpatch.diffs = bigpatch.diffs[:]
         # Remove the big old patch.
         del patches[x]
         x -= 1
@@ -1837,10 +1912,13 @@ class diff_match_patch:
     return patches
 
 
-class patch_obj:
+class patch_obj(object):
   """Class representing one patch operation.
+  Uses __slots__ as patch lists can hold tens of thousands of these.
   """
 
+  __slots__ = ('diffs', 'start1', 'start2', 'length1', 'length2')
+
   def __init__(self):
     """Initializes with an empty list of diffs.
     """
@@ -0,0 +1,464 @@
+"""NumPy backend for Diff Match and Patch.
+
+The pure Python diff_match_patch class is the reference implementation.  This
+subclass replaces its two hottest loops with vectorized versions which give
+bit-for-bit the same results:
+
+  diff_bisect: each step of the Myers frontier is computed for every diagonal
+      at once, rather than one diagonal at a time.
+  match_bitap: the bit array for each error level is computed with a parallel
+      prefix scan over the text, rather than one character at a time.
+
+Other methods (and inputs the vectorized versions don't handle) fall back to
+the reference implementation.  Importing this module raises ImportError if
+NumPy isn't installed.
+"""
+
+import sys
+import time
+
+import numpy
+
+from diff_match_patch import diff_match_patch
+
+
+def _codes(text):
+  """Return the characters of a string as an array of character codes, with
+  one element per index of the string.
+
+  Args:
+    text: String to convert.
+
+  Returns:
+    NumPy array of character codes.
+  """
+  if isinstance(text, unicode):
+    if sys.maxunicode > 0xffff:
+      return numpy.frombuffer(text.encode('utf-32-le'), dtype=numpy.uint32)
+    return numpy.frombuffer(text.encode('utf-16-le'), dtype=numpy.uint16)
+  return numpy.frombuffer(text, dtype=numpy.uint8)
+
+
+def _commonRun(codes1, codes2, x, y):
+  """Determine the number of equal characters in two arrays, starting at x
+  in the first and y in the second.  Compares in growing chunks so that long
+  runs don't need a Python loop per character.
+
+  Args:
+    codes1: First array of character codes.
+    codes2: Second array of character codes.
+    x: Start index in codes1.
+    y: Start index in codes2.
+
+  Returns:
+    The length of the common run.
+  """
+  length = min(len(codes1) - x, len(codes2) - y)
+  done = 0
+  step = 64
+  while done < length:
+    size = min(step, length - done)
+    differs = (codes1[x + done:x + done + size] !=
+               codes2[y + done:y + done + size])
+    if differs.any():
+      return done + int(differs.argmax())
+    done += size
+    step *= 2
+  return length
+
+
+class diff_match_patch_numpy(diff_match_patch):
+  """diff_match_patch with NumPy versions of diff_bisect and match_bitap.
+  """
+
+  # Inputs smaller than this are faster in pure Python.
+  Bisect_MinLength = 256
+  # The edit distance at which the bisect switches to walking every diagonal
+  # at once.  Narrower frontiers are faster in pure Python.
+  Bisect_VectorFrom = 128
+  # Number of vectorized snake steps before following the remaining snakes
+  # one diagonal at a time.
+  Bisect_SnakeSteps = 8
+
+  def diff_bisect(self, text1, text2, deadline):
+    """Find the 'middle snake' of a diff, split the problem in two
+      and return the recursively constructed diff.
+      See Myers 1986 paper: An O(ND) Difference Algorithm and Its Variations.
+
+    Args:
+      text1: Old string to be diffed.
+      text2: New string to be diffed.
+      deadline: Time at which to bail if not yet complete.
+
+    Returns:
+      Array of diff tuples.
+    """
+    if (type(text1) != type(text2) or
+        len(text1) + len(text2) < self.Bisect_MinLength):
+      return diff_match_patch.diff_bisect(self, text1, text2, deadline)
+
+    # Cache the text lengths to prevent multiple calls.
+    text1_length = len(text1)
+    text2_length = len(text2)
+    max_d = (text1_length + text2_length + 1) // 2
+    v_offset = max_d
+    v_length = 2 * max_d
+    v1 = [-1] * v_length
+    v1[v_offset + 1] = 0
+    v2 = v1[:]
+    delta = text1_length - text2_length
+    # If the total number of characters is odd, then the front path will
+    # collide with the reverse path.
+    front = (delta % 2 != 0)
+    # Offsets for start and end of k loop.
+    # Prevents mapping of space beyond the grid.
+    k1start = 0
+    k1end = 0
+    k2start = 0
+    k2end = 0
+    # While the frontier is narrow, walk it exactly as the reference does.
+    for d in xrange(min(max_d, self.Bisect_VectorFrom)):
+      # Bail out if deadline is reached.
+      if time.time() > deadline:
+        return [(self.DIFF_DELETE, text1), (self.DIFF_INSERT, text2)]
+
+      # Walk the front path one step.
+      for k1 in xrange(-d + k1start, d + 1 - k1end, 2):
+        k1_offset = v_offset + k1
+        if (k1 == -d or k1 != d and
+            v1[k1_offset - 1] < v1[k1_offset + 1]):
+          x1 = v1[k1_offset + 1]
+        else:
+          x1 = v1[k1_offset - 1] + 1
+        y1 = x1 - k1
+        while (x1 < text1_length and y1 < text2_length and
+               text1[x1] == text2[y1]):
+          x1 += 1
+          y1 += 1
+        v1[k1_offset] = x1
+        if x1 > text1_length:
+          # Ran off the right of the graph.
+          k1end += 2
+        elif y1 > text2_length:
+          # Ran off the bottom of the graph.
+          k1start += 2
+        elif front:
+          k2_offset = v_offset + delta - k1
+          if k2_offset >= 0 and k2_offset < v_length and v2[k2_offset] != -1:
+            # Mirror x2 onto top-left coordinate system.
+            x2 = text1_length - v2[k2_offset]
+            if x1 >= x2:
+              # Overlap detected.
+              return self.diff_bisectSplit(text1, text2, x1, y1, deadline)
+
+      # Walk the reverse path one step.
+      for k2 in xrange(-d + k2start, d + 1 - k2end, 2):
+        k2_offset = v_offset + k2
+        if (k2 == -d or k2 != d and
+            v2[k2_offset - 1] < v2[k2_offset + 1]):
+          x2 = v2[k2_offset + 1]
+        else:
+          x2 = v2[k2_offset - 1] + 1
+        y2 = x2 - k2
+        while (x2 < text1_length and y2 < text2_length and
+               text1[-x2 - 1] == text2[-y2 - 1]):
+          x2 += 1
+          y2 += 1
+        v2[k2_offset] = x2
+        if x2 > text1_length:
+          # Ran off the left of the graph.
+          k2end += 2
+        elif y2 > text2_length:
+          # Ran off the top of the graph.
+          k2start += 2
+        elif not front:
+          k1_offset = v_offset + delta - k2
+          if k1_offset >= 0 and k1_offset < v_length and v1[k1_offset] != -1:
+            x1 = v1[k1_offset]
+            y1 = v_offset + x1 - k1_offset
+            # Mirror x2 onto top-left coordinate system.
+            x2 = text1_length - x2
+            if x1 >= x2:
+              # Overlap detected.
+              return self.diff_bisectSplit(text1, text2, x1, y1, deadline)
+
+    if max_d <= self.Bisect_VectorFrom:
+      # Number of diffs equals number of characters, no commonality at all.
+      return [(self.DIFF_DELETE, text1), (self.DIFF_INSERT, text2)]
+
+    # The frontier is now wide enough to walk every diagonal at once.
+    codes1 = _codes(text1)
+    codes2 = _codes(text2)
+    # The reverse path compares the texts from their ends.
+    rcodes1 = codes1[::-1]
+    rcodes2 = codes2[::-1]
+    # The arrays have an extra element at each end, so that both neighbours
+    # of every diagonal can be read at once.  Diagonal k is at v_offset + k + 1.
+    v1 = numpy.array([-1] + v1 + [-1], dtype=numpy.int64)
+    v2 = numpy.array([-1] + v2 + [-1], dtype=numpy.int64)
+    for d in xrange(self.Bisect_VectorFrom, max_d):
+      # Bail out if deadline is reached.
+      if time.time() > deadline:
+        break
+
+      # Walk the front path one step.
+      k1 = numpy.arange(-d + k1start, d + 1 - k1end, 2, dtype=numpy.int64)
+      if len(k1):
+        x1 = self._bisectStep(v1, v_offset, k1, d, codes1, codes2)
+        y1 = x1 - k1
+        off_right = x1 > text1_length
+        off_bottom = (y1 > text2_length) & ~off_right
+        k1end += 2 * int(off_right.sum())
+        k1start += 2 * int(off_bottom.sum())
+        if front:
+          k2_offset = v_offset + delta - k1
+          overlap = ~off_right & ~off_bottom
+          overlap &= (k2_offset >= 0) & (k2_offset < v_length)
+          v2_values = v2[numpy.clip(k2_offset, -1, v_length) + 1]
+          overlap &= v2_values != -1
+          # Mirror x2 onto top-left coordinate system.
+          overlap &= x1 >= text1_length - v2_values
+          if overlap.any():
+            # Overlap detected.
+            i = int(overlap.argmax())
+            return self.diff_bisectSplit(text1, text2, int(x1[i]), int(y1[i]),
+                                         deadline)
+
+      # Walk the reverse path one step.
+      k2 = numpy.arange(-d + k2start, d + 1 - k2end, 2, dtype=numpy.int64)
+      if len(k2):
+        x2 = self._bisectStep(v2, v_offset, k2, d, rcodes1, rcodes2)
+        y2 = x2 - k2
+        off_left = x2 > text1_length
+        off_top = (y2 > text2_length) & ~off_left
+        k2end += 2 * int(off_left.sum())
+        k2start += 2 * int(off_top.sum())
+        if not front:
+          k1_offset = v_offset + delta - k2
+          overlap = ~off_left & ~off_top
+          overlap &= (k1_offset >= 0) & (k1_offset < v_length)
+          x1 = v1[numpy.clip(k1_offset, -1, v_length) + 1]
+          overlap &= x1 != -1
+          # Mirror x2 onto top-left coordinate system.
+          overlap &= x1 >= text1_length - x2
+          if overlap.any():
+            # Overlap detected.
+            i = int(overlap.argmax())
+            x = int(x1[i])
+            y = int(v_offset + x - k1_offset[i])
+            return self.diff_bisectSplit(text1, text2, x, y, deadline)
+
+    # Diff took too long and hit the deadline or
+    # number of diffs equals number of characters, no commonality at all.
+    return [(self.DIFF_DELETE, text1), (self.DIFF_INSERT, text2)]
+
+  def _bisectStep(self, v, v_offset, k, d, codes1, codes2):
+    """Advance every diagonal in k by one step of the Myers algorithm and
+    follow its snake.  Updates v and returns the new x values.
+
+    Args:
+      v: Array of furthest reaching x values for each diagonal.
+      v_offset: Offset of diagonal 0 in v, not including the padding element.
+      k: Array of diagonals to advance.
+      d: Current edit distance.
+      codes1: Character codes of the (possibly reversed) old text.
+      codes2: Character codes of the (possibly reversed) new text.
+
+    Returns:
+      Array of x values, one for each diagonal in k.
+    """
+    k_offset = v_offset + k + 1
+    from_above = v[k_offset + 1]
+    from_left = v[k_offset - 1]
+    use_above = (k == -d) | ((k != d) & (from_left < from_above))
+    x = numpy.where(use_above, from_above, from_left + 1)
+    y = x - k
+
+    # Follow the snakes, first a few steps for every diagonal at once.
+    length1 = len(codes1)
+    length2 = len(codes2)
+    active = numpy.flatnonzero((x < length1) & (y < length2))
+    for _ in xrange(self.Bisect_SnakeSteps):
+      if not len(active):
+        break
+      equal = codes1[x[active]] == codes2[y[active]]
+      active = active[equal]
+      x[active] += 1
+      y[active] += 1
+      active = active[(x[active] < length1) & (y[active] < length2)]
+    # Then the remaining (long) snakes individually.
+    for i in active:
+      x[i] += _commonRun(codes1, codes2, int(x[i]), int(y[i]))
+
+    v[k_offset] = x
+    return x
+
+  def match_bitap(self, text, pattern, loc):
+    """Locate the best instance of 'pattern' in 'text' near 'loc' using the
+    Bitap algorithm.
+
+    Args:
+      text: The text to search.
+      pattern: The pattern to search for.
+      loc: The location to search around.
+
+    Returns:
+      Best match index or -1.
+    """
+    # The bit arrays are held in 64 bit integers.
+    if not pattern or len(pattern) > 63 or type(text) != type(pattern):
+      return diff_match_patch.match_bitap(self, text, pattern, loc)
+
+    # Initialise the alphabet.
+    s = self.match_alphabet(pattern)
+
+    def match_bitapScore(e, x):
+      """Compute and return the score for a match with e errors and x location.
+      Accesses loc and pattern through being a closure.
+
+      Args:
+        e: Number of errors in match.
+        x: Location of match.
+
+      Returns:
+        Overall score for match (0.0 = good, 1.0 = bad).
+      """
+      accuracy = float(e) / len(pattern)
+      proximity = abs(loc - x)
+      if not self.Match_Distance:
+        # Dodge divide by zero error.
+        return proximity and 1.0 or accuracy
+      return accuracy + (proximity / float(self.Match_Distance))
+
+    # Highest score beyond which we give up.
+    score_threshold = self.Match_Threshold
+    # Is there a nearby exact match? (speedup)
+    best_loc = text.find(pattern, loc)
+    if best_loc != -1:
+      score_threshold = min(match_bitapScore(0, best_loc), score_threshold)
+      # What about in the other direction? (speedup)
+      best_loc = text.rfind(pattern, loc + len(pattern))
+      if best_loc != -1:
+        score_threshold = min(match_bitapScore(0, best_loc), score_threshold)
+
+    # Initialise the bit arrays.  Only the lowest len(pattern) bits are ever
+    # tested and bits only move upwards, so everything is kept masked to them.
+    mask = (1 << len(pattern)) - 1
+    matchmask = 1 << (len(pattern) - 1)
+    best_loc = -1
+
+    bin_max = len(pattern) + len(text)
+    # The previous bit array, covering indices last_start to its end.
+    last_rd = None
+    last_start = 0
+    for d in xrange(len(pattern)):
+      # Scan for the best match each iteration allows for one more error.
+      # Run a binary search to determine how far from 'loc' we can stray at
+      # this error level.
+      bin_min = 0
+      bin_mid = bin_max
+      while bin_min < bin_mid:
+        if match_bitapScore(d, loc + bin_mid) <= score_threshold:
+          bin_min = bin_mid
+        else:
+          bin_max = bin_mid
+        bin_mid = (bin_max - bin_min) // 2 + bin_min
+
+      # Use the result from this iteration as the maximum for the next.
+      bin_max = bin_mid
+      start = max(1, loc - bin_mid + 1)
+      finish = min(loc + bin_mid, len(text)) + len(pattern)
+
+      # rd[j] for j from start to finish + 1.  The final element (and any
+      # element not reached below) keeps the reference's initial value.
+      rd = numpy.arange(start, finish + 2, dtype=numpy.uint64)
+      rd[-1] = (1 << min(d, 63)) - 1
+      rd &= numpy.uint64(mask)
+      if finish >= start:
+        computed = self._bitapScan(text, s, start, finish, d, mask,
+                                   last_rd, last_start, rd[-1])
+        # Find the matches in the same order as the reference, which walks
+        # from finish down to start.
+        hits = numpy.flatnonzero(computed & numpy.uint64(matchmask))
+        stop = len(computed)
+        for i in hits:
+          j = finish - int(i)
+          score = match_bitapScore(d, j - 1)
+          # This match will almost certainly be better than any existing
+          # match.  But check anyway.
+          if score <= score_threshold:
+            # Told you so.
+            score_threshold = score
+            best_loc = j - 1
+            if best_loc <= loc:
+              # Already passed loc, downhill from here on in.
+              stop = int(i) + 1
+              break
+        # computed is in the order finish, finish - 1, ..., start.
+        rd[finish + 1 - stop - start:finish + 1 - start] = computed[:stop][::-1]
+      # No hope for a (better) match at greater error levels.
+      if match_bitapScore(d + 1, loc) > score_threshold:
+        break
+      last_rd = rd
+      last_start = start
+    return best_loc
+
+  def _bitapScan(self, text, s, start, finish, d, mask, last_rd, last_start,
+                 initial):
+    """Compute one bitap bit array for error level d.
+
+    Each step of the reference loop is a function of the previous element,
+    rd[j] = ((rd[j + 1] << 1) & c) | b, and a composition of such functions
+    is another of the same form, r -> ((r << shift) & c) | b.  So the array
+    can be computed with a parallel prefix scan.
+
+    Args:
+      text: The text to search.
+      s: Alphabet from match_alphabet.
+      start: Lowest index of the bit array to compute.
+      finish: Highest index of the bit array to compute.
+      d: Number of errors.
+      mask: Mask of the bits which matter.
+      last_rd: Bit array from the previous error level (starting at index
+          last_start) or None.
+      last_start: Index of the first element of last_rd.
+      initial: Value of rd[finish + 1].
+
+    Returns:
+      Array of rd[j] for j from finish down to start.
+    """
+    bits = numpy.uint64(mask)
+    one = numpy.uint64(1)
+
+    # Character matches for text[j - 1], zero when out of range.
+    chars = _codes(text[start - 1:finish])
+    char_match = numpy.zeros(finish - start + 1, dtype=numpy.uint64)
+    for char, value in s.iteritems():
+      char_match[:len(chars)][chars == ord(char)] = value
+    char_match &= bits
+    char_match = char_match[::-1]
+
+    # The functions in the order they are applied, starting with j = finish.
+    shift = numpy.ones(len(char_match), dtype=numpy.uint64)
+    c = char_match & (bits ^ one)
+    b = char_match & one
+    if d != 0:
+      # The fuzzy terms for j from finish down to start.
+      last_j = last_rd[start - last_start:finish + 1 - last_start][::-1]
+      last_j1 = last_rd[start + 1 - last_start:finish + 2 - last_start][::-1]
+      b |= ((((last_j1 | last_j) << one) | one) | last_j1) & bits
+
+    width = numpy.uint64(mask.bit_length())
+    step = 1
+    while step < len(shift):
+      # Compose each function with the one step before it.
+      outer_shift = shift[step:]
+      new_shift = numpy.minimum(shift[:-step] + outer_shift, width)
+      new_c = (c[:-step] << outer_shift) & c[step:]
+      new_b = ((b[:-step] << outer_shift) & c[step:]) | b[step:]
+      shift[step:] = new_shift
+      c[step:] = new_c
+      b[step:] = new_b
+      step *= 2
+
+    return ((numpy.uint64(initial) << shift) & c) | b
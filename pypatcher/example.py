@@ -50,6 +50,29 @@ except patcher.Error:
     #not anything that invalidates the install process
     pass
 
+#------------------------------------------------------------------------------
+#The same, but with the server publishing a manifest of the versions and the
+#patches between them (see patchgraph.py). The patcher picks the patches
+#that should download the quickest
+import patchgraph
+try:
+    pb = patcher.BackgroundProgramPatcher()
+    if pb.needsPatching():
+        pb.patchProgram()
+    else:
+        graph = patchgraph.PatchGraph.fromFile('manifest.json')
+        pb.downloadAndPrePatchGraph(os.getcwd(),
+                                    os.path.abspath('patcher'),
+                                    os.path.abspath('dlpatches'),
+                                    graph,
+
+                                    #the version currently installed
+                                    '1.0')
+except patcher.BrokenError:
+    pass
+except patcher.Error:
+    pass
+
 #------------------------------------------------------------------------------
 #Simple example without the more complex downloader
 try:
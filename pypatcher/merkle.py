@@ -0,0 +1,161 @@
+"""
+A merkle tree of a directory, so two trees (such as a client's install
+and a release) can be compared by their roots and then only the
+subtrees that differ descended into.
+
+Each file is described by its md5, size and mtime, and each directory by
+the md5 of the sorted names and digests of its entries. The tree is saved
+as json, and when it is rebuilt the md5 of a file whose size and mtime
+haven't changed is reused rather than read again
+"""
+
+import os
+import sys
+import json
+import hashlib
+
+import patchdiff
+
+TREE_VERSION = 1
+
+class TreeError(Exception):
+    """
+    Raised when a saved tree is invalid
+    """
+    pass
+
+def _dirDigest(node):
+    #the names are unicode, as are the digests of a tree read from json,
+    #so each line is made as unicode and encoded once
+    h = hashlib.md5()
+    for name in sorted(node['dirs']):
+        h.update((u'd %s %s\n' % (name, node['dirs'][name]['digest']))
+                    .encode('utf-8'))
+    for name in sorted(node['files']):
+        h.update((u'f %s %s\n' % (name, node['files'][name]['md5']))
+                    .encode('utf-8'))
+    return h.hexdigest()
+
+def _fsEncoding():
+    return sys.getfilesystemencoding() or 'utf-8'
+
+def _decodeName(name):
+    """
+    Returns the name of a file (as given by os.listdir for a str path) as
+    unicode. Names that aren't in the filesystem encoding (such as any
+    non ascii name when it is ascii) are taken to be utf-8
+    """
+    try:
+        return name.decode(_fsEncoding())
+    except UnicodeDecodeError:
+        return name.decode('utf-8', 'replace')
+
+def buildTree(d, previous=None):
+    """
+    Returns the tree of the directory d
+
+    previous - An earlier tree of d. The md5s of the files in it that
+               have the same size and mtime are reused
+    """
+    #the directory is listed as bytes, so names that can't be decoded
+    #still give usable paths
+    if isinstance(d, unicode):
+        d = d.encode(_fsEncoding())
+    node = {
+        'dirs' : {},
+        'files' : {},
+    }
+    for rawName in os.listdir(d):
+        path = os.path.join(d, rawName)
+        name = _decodeName(rawName)
+        if os.path.isdir(path):
+            prev = previous['dirs'].get(name) if previous else None
+            node['dirs'][name] = buildTree(path, prev)
+            continue
+
+        st = os.stat(path)
+        prev = previous['files'].get(name) if previous else None
+        if (prev is not None and prev['size'] == st.st_size
+                and prev['mtime'] == st.st_mtime):
+            md5 = prev['md5']
+        else:
+            md5 = patchdiff._getFileMd5(path)
+        node['files'][name] = {
+            'md5' : md5,
+            'size' : st.st_size,
+            'mtime' : st.st_mtime,
+        }
+    node['digest'] = _dirDigest(node)
+    return node
+
+def writeTree(filePath, tree):
+    with open(filePath, 'w') as f:
+        f.write(json.dumps({
+            'version' : TREE_VERSION,
+            'root' : tree,
+        }))
+
+def readTree(filePath):
+    try:
+        with open(filePath) as f:
+            saved = json.loads(f.read())
+        if saved['version'] > TREE_VERSION:
+            raise TreeError('The tree is too new to read')
+        return saved['root']
+    except (ValueError, KeyError, TypeError):
+        raise TreeError(filePath + ' isn\'t a valid tree')
+
+def updateTree(d, filePath):
+    """
+    Rebuilds the tree of d, reusing the tree saved in filePath (if there
+    is a valid one), and saves it to filePath. Returns the tree
+    """
+    previous = None
+    if os.path.exists(filePath):
+        try:
+            previous = readTree(filePath)
+        except TreeError:
+            pass
+    tree = buildTree(d, previous)
+    writeTree(filePath, tree)
+    return tree
+
+def _allFiles(node, prefix):
+    files = [os.path.join(prefix, name) for name in node['files']]
+    for name, sub in node['dirs'].iteritems():
+        files += _allFiles(sub, os.path.join(prefix, name))
+    return files
+
+def compare(old, new, prefix=''):
+    """
+    Returns the (changed, added, removed) files between two trees, as
+    sorted lists of paths. Only directories whose digests differ are
+    descended into
+    """
+    changed, added, removed = [], [], []
+    if old['digest'] == new['digest']:
+        return changed, added, removed
+
+    for name, info in new['files'].iteritems():
+        path = os.path.join(prefix, name)
+        if name not in old['files']:
+            added.append(path)
+        elif old['files'][name]['md5'] != info['md5']:
+            changed.append(path)
+    removed += [os.path.join(prefix, name) for name in old['files']
+                    if name not in new['files']]
+
+    for name, sub in new['dirs'].iteritems():
+        path = os.path.join(prefix, name)
+        if name in old['dirs']:
+            c, a, r = compare(old['dirs'][name], sub, path)
+            changed += c
+            added += a
+            removed += r
+        else:
+            added += _allFiles(sub, path)
+    for name, sub in old['dirs'].iteritems():
+        if name not in new['dirs']:
+            removed += _allFiles(sub, os.path.join(prefix, name))
+
+    return sorted(changed), sorted(added), sorted(removed)
@@ -4,7 +4,7 @@ import urllib
 import time
 import sqlite3
 import Queue as queue
-from threading import Thread
+from threading import Thread, Lock
 
 class LockError(Exception):
     """
@@ -23,6 +23,25 @@ class PartialUrlOpener(urllib.FancyURLopener):
         pass
 
 
+def openRange(url, start, length):
+    """
+    Opens url to read the length bytes from start, using a Range request
+    (as used to resume downloads). Returns a file like object. If the
+    server sends the whole file the data before start is skipped
+    """
+    dl = PartialUrlOpener()
+    dl.addheader('Range', 'bytes=%d-%d' % (start, start + length - 1))
+    src = dl.open(url)
+    if src.getcode() != 206:
+        skip = start
+        while skip:
+            data = src.read(min(skip, 1024*1024))
+            if not data:
+                break
+            skip -= len(data)
+    return src
+
+
 class PartialDownloader(Thread):
     """
     This allows us to resume downloads, so we should be able to cope
@@ -41,11 +60,27 @@ class PartialDownloader(Thread):
         self.cfg = configFile
 
         #using a seperate connection for the threaded functions
-        #isn't required due to the GIL
-        self.con = sqlite3.connect(self.cfg)
+        #isn't required due to the GIL, but as files can be downloaded
+        #by more than one thread at a time it is only used with sqlLock held
+        self.con = sqlite3.connect(self.cfg, check_same_thread=False)
         self.con.row_factory = sqlite3.Row
+        self.sqlLock = Lock()
         
         self.toDownload = queue.Queue()
+        self.workers = 1
+
+        #measured while downloading, see throughput() and latency().
+        #timeDownloading is the wall clock time (from clock) during which at
+        #least one worker was reading data, rather than sleeping to keep to
+        #the limit or passing it to onData
+        self.bytesDownloaded = 0
+        self.timeDownloading = 0.0
+        self.requests = 0
+        self.timeRequesting = 0.0
+        self.statsLock = Lock()
+        self.clock = time.time
+        self.activeWorkers = 0
+        self.activeSince = None
 
         self._sqlCreateTbl()
         self._sqlCleanDb()
@@ -74,20 +109,31 @@ class PartialDownloader(Thread):
                     ''')
         return cur.fetchall()
 
-    def add(self, urlsrc, filePath, partialExt='.par'):
+    def add(self, urlsrc, filePath, partialExt='.par', onData=None):
         """
         Adds a file that needs downloading. This can be called from 
         outside the thread even when the thread is running
+
+        onData - Called (from the thread) with each block of the file as it
+                 is downloaded, so it can be used before the download has
+                 finished. If the download is resumed it is first called
+                 with what had already been downloaded. It isn't stored
+                 in the database, so isn't used for downloads resumed by
+                 another instance
         """
         #add to queue. Queue copes with threads fine
         self.toDownload.put({
             'src' : urlsrc,
             'tmp' : filePath + partialExt,
-            'dst' : filePath 
+            'dst' : filePath,
+            'ondata' : onData,
         }) 
 
-        #add to db in case we need to resume
-        self._sqlAddDl(urlsrc, filePath + partialExt, filePath)
+        #add to db in case we need to resume. Committed straight away so it
+        #isn't lost if the process is killed
+        with self.sqlLock:
+            self._sqlAddDl(urlsrc, filePath + partialExt, filePath)
+            self.con.commit()
 
     def _sqlSetActive(self, dst, active):
         """
@@ -142,8 +188,11 @@ class PartialDownloader(Thread):
 
     def _sqlAddDl(self, src, tmp, dst):
         cur = self.con.cursor()
-        cur.execute('''INSERT INTO 'downloads'
-                       VALUES (?,?,?)''',
+        #if it is already there it is being resumed (and may be being
+        #downloaded by another instance)
+        cur.execute('''INSERT OR IGNORE INTO 'downloads'
+                       (lock, src, tmp, dst)
+                       VALUES (0,?,?,?)''',
                     (src, tmp, dst))
 
     def _sqlRemoveDl(self, dst):
@@ -168,48 +217,87 @@ class PartialDownloader(Thread):
                                dst varchar(255) PRIMARY KEY
                            )''')
 
-    def startDownload(self, limit=0, callback=None):
+    def startDownload(self, limit=0, callback=None, workers=1):
         """
         Starts downloading the queued files. 
         limit - The limit in kb/s that can be downloaded each second
         callback - The callback when the downloads are compleat. The
                     first argument to the callback is a list of downloaded
                     files
+        workers - The number of files that are downloaded at once, in the
+                  order they were added. They share the limit
         """
         self.callback = callback
         self.limit = limit
+        self.workers = workers
         self.start()
 
     def run(self):
         downloadedFiles = []
-        while not self.toDownload.empty():
-            dlInfo = self.toDownload.get()
+        threads = [Thread(target=self._work, args=(downloadedFiles,))
+                   for i in xrange(self.workers - 1)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        self._work(downloadedFiles)
+        for t in threads:
+            t.join()
+
+        with self.sqlLock:
+            self.con.commit()
+        if self.callback:
+            self.callback(downloadedFiles)
+
+    def _work(self, downloadedFiles):
+        """
+        Downloads queued files until there are none left
+        """
+        while True:
+            try:
+                dlInfo = self.toDownload.get_nowait()
+            except queue.Empty:
+                break
 
-            if self._sqlIsActive(dlInfo['dst']):
-                continue
+            with self.sqlLock:
+                #gone if it was queued twice and has been downloaded
+                if (not self.hasDst(dlInfo['dst'])
+                        or self._sqlIsActive(dlInfo['dst'])):
+                    continue
+                self._sqlSetActive(dlInfo['dst'], True)
+                self.con.commit()
 
-            self._sqlSetActive(dlInfo['dst'], True)
-            self._downloadFile(dlInfo['src'], dlInfo['tmp'])
-            self._sqlSetActive(dlInfo['dst'], False)
+            onData = dlInfo['ondata'] if 'ondata' in dlInfo.keys() else None
+            self._downloadFile(dlInfo['src'], dlInfo['tmp'], onData)
 
             shutil.move(dlInfo['tmp'], dlInfo['dst'])
-            self._sqlRemoveDl(dlInfo['dst'])
+            with self.sqlLock:
+                self._sqlSetActive(dlInfo['dst'], False)
+                self._sqlRemoveDl(dlInfo['dst'])
+                self.con.commit()
             downloadedFiles.append(dlInfo['dst'])
 
-        if self.callback:
-            self.callback(downloadedFiles)
-
-    def _downloadFile(self, src, dest):
+    def _downloadFile(self, src, dest, onData=None):
         dl = PartialUrlOpener()
         curSize = -1
         if os.path.exists(dest):
+            if onData:
+                with open(dest, 'rb') as f:
+                    while True:
+                        data = f.read(1024*1024)
+                        if not data:
+                            break
+                        onData(data)
             out = open(dest,"ab")
             curSize = os.path.getsize(dest)
             dl.addheader("Range","bytes=%s-" % (curSize))
         else:
             out = open(dest,"wb")
 
+        requestStartTime = time.time()
         src = dl.open(src)
+        with self.statsLock:
+            self.requests += 1
+            self.timeRequesting += time.time() - requestStartTime
         if int(src.headers['Content-Length']) == curSize: 
             return
 
@@ -217,18 +305,63 @@ class PartialDownloader(Thread):
             dlSize = 10*1000
             dlStartTime = time.time()
 
-            data = src.read(dlSize)
+            self._setDownloading(True)
+            try:
+                data = src.read(dlSize)
+                if data:
+                    out.write(data)
+                    with self.statsLock:
+                        self.bytesDownloaded += len(data)
+            finally:
+                self._setDownloading(False)
             if not data:
                 break
-            out.write(data)
+            #not counted as downloading, as it may be slow (such as merging
+            #a patch as it downloads)
+            if onData:
+                onData(data)
 
             #limiter, sleeps if required
             if self.limit:
                 dlTimeTaken = time.time() - dlStartTime
-                minDlTime = dlSize/(self.limit*1000.0)
-                if dlTimeTaken > minDlTime:
-                    time.sleep(dlTimeTaken-minDlTime)
+                minDlTime = dlSize/(self.limit*1000.0/self.workers)
+                if dlTimeTaken < minDlTime:
+                    time.sleep(minDlTime-dlTimeTaken)
 
         src.close()
         out.close()
 
+    def _setDownloading(self, downloading):
+        """
+        Marks a worker as starting or stopping downloading, adding the wall
+        clock time any worker was downloading for to timeDownloading
+        """
+        with self.statsLock:
+            if downloading:
+                if not self.activeWorkers:
+                    self.activeSince = self.clock()
+                self.activeWorkers += 1
+            else:
+                self.activeWorkers -= 1
+                if not self.activeWorkers:
+                    self.timeDownloading += self.clock() - self.activeSince
+
+    def throughput(self):
+        """
+        Returns the measured download speed in bytes/second, over the wall
+        clock time that files were downloading for (so downloads in parallel
+        aren't counted twice), leaving out any time spent sleeping to keep
+        to the limit. None if nothing has been downloaded
+        """
+        if not self.bytesDownloaded or not self.timeDownloading:
+            return None
+        return self.bytesDownloaded / self.timeDownloading
+
+    def latency(self):
+        """
+        Returns the measured average time (in seconds) taken to start a
+        download. None if no downloads have been started
+        """
+        if not self.requests:
+            return None
+        return self.timeRequesting / self.requests
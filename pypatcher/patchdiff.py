@@ -5,10 +5,10 @@ It is a wrapper around bsdiff and bspatch, for lack of a better
 method of doing it in python. This means that it is expcected that
 bsdiff.exe and bspath.exe are on the path
 
-the patch file is compressed into a simple .zip which holds
-a config file (listing deleted files and how each patch file
-was generated) a load of patch files (in PATCH_DIR) and a load
-of new files in NEW_DIR
+the patch file is compressed into a simple .zip (or a container,
+see container.py) which holds a config file (listing deleted files
+and how each patch file was generated) a load of patch files (in
+PATCH_DIR) and a load of new files in NEW_DIR
 
 The design of this is intedned so you can apply multiple patches
 to a set of files in a directory and save to an output directory.
@@ -18,16 +18,38 @@ you merge the temp directory and the origanal source directory
 """
 
 import os
+import sys
+import errno
 import shutil
 import tempfile
 import zipfile
 import json
 import hashlib
+import time
 import string
+import struct
+import bisect
+import multiprocessing
+import multiprocessing.pool
+import zlib
+import bz2
+import contextlib
+import threading
+import mmap
 
 from diffmatchpatch import diff_match_patch 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from partialdl import PartialDownloader
+import container
+import rsyncdelta
 
 #the binary patching/dif files
 BSDIFF = 'bsdiff'
@@ -41,6 +63,128 @@ PATCH_DIR = 'patchfs'
 NEW_DIR = 'newfs'
 MERGED_FILES = 'files'
 
+#dir (in an extracted patch) the files other paths are patched from are
+#copied to before a patch is applied
+STAGE_DIR = 'stage'
+
+#the keys in the patch config that are not files
+CFG_KEYS = ('deleted', 'deleteddirs', 'solid')
+
+#text files at least this size (in bytes) are split into regions that are
+#diffed in parallel when generateDiff is given more than one diff worker.
+#Regions are split at lines unique to both files, and are at least
+#PARALLEL_DIFF_REGION_SIZE bytes
+PARALLEL_DIFF_MIN_SIZE = 1024*1024
+PARALLEL_DIFF_REGION_SIZE = 128*1024
+
+#the least time (in seconds) a text diff is given when generateDiff has a
+#time budget. diff_match_patch treats 0 as no time limit
+MIN_DIFF_TIMEOUT = 0.01
+
+#the patch types that are applied using only the old file and the config,
+#so have nothing in PATCH_DIR
+NO_PAYLOAD_TYPES = ('copy', 'pycheader')
+
+#the magic number at the start of a .pyc file gives the python version that
+#wrote it, and so the length of its header. Python 2 magic numbers are all
+#at least PYC_PY2_MAGIC and have 8 byte headers. Python 3.3 added the source
+#size to the header (PYC_SIZE_MAGIC) and 3.7 added a flags field
+#(PYC_FLAGS_MAGIC)
+PYC_EXTS = ('.pyc', '.pyo')
+PYC_SIZE_MAGIC = 3230
+PYC_FLAGS_MAGIC = 3390
+PYC_PY2_MAGIC = 20121
+PYC_MAX_HEADER_LENGTH = 16
+
+#a new file that doesn't exist in the old tree is patched against a removed
+#old file with the same extension whose size is within this fraction of
+#its size, as long as the patch is smaller than the file
+NEAR_DUPLICATE_SIZE_RATIO = 0.1
+
+#the size of the blocks (in bytes) files are read in when compressing them
+ZIP_CHUNK_SIZE = 1024*1024
+
+#the records of a zip, for _writeZip. Their layouts are those zipfile uses
+ZIP_LOCAL_MAGIC = 'PK\x03\x04'
+ZIP_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+ZIP_CENTRAL_MAGIC = 'PK\x01\x02'
+ZIP_CENTRAL_HEADER = struct.Struct('<4s6H3L5H2L')
+ZIP_END_MAGIC = 'PK\x05\x06'
+ZIP_END = struct.Struct('<4s4H2LH')
+ZIP_VERSION = 20
+ZIP_CREATE_VERSION = ((0 if sys.platform == 'win32' else 3) << 8) | ZIP_VERSION
+ZIP_UTF8_FLAG = 0x800
+ZIP_MAX_ENTRIES = 0xFFFF
+#an upper bound on the size of the records for an entry (other than its
+#data), used to check the zip won't need zip64
+ZIP_MAX_HEADER_SIZE = 2*(ZIP_CENTRAL_HEADER.size + 0xFFFF)
+
+#the member of the patch zip holding the entries (no larger than
+#SOLID_MAX_ENTRY_SIZE) that are compressed together when a patch is
+#generated with solid set. It is bzip2 compressed
+SOLID_BLOCK = 'solid.bz2'
+SOLID_MAX_ENTRY_SIZE = 64*1024
+
+#entries that aren't worth compressing on their own are left out of the
+#solid block, unless they are no larger than this, as then they are
+#likely to only be incompressible because they are so small
+SOLID_STORED_MAX_SIZE = 1024
+
+#the codecs entries in a patch can be compressed with, by the name they are
+#given in the config. Each entry is given the codec that suits it by
+#compressing samples from it: CODEC_SAMPLE_SIZE bytes from its start, middle
+#and end. If that doesn't shrink them below CODEC_STORE_RATIO of their size
+#it is stored
+CODECS = {
+    'stored' : zipfile.ZIP_STORED,
+    'deflate' : zipfile.ZIP_DEFLATED,
+}
+CODEC_SAMPLE_SIZE = 16*1024
+CODEC_STORE_RATIO = 0.9
+
+#the size of the blocks (in bytes) files are read in when comparing them
+COMPARE_CHUNK_SIZE = 64*1024
+
+#a patch can be split into shards, which are patches that can be downloaded
+#and merged in any order. They are listed in an index, which is a json file
+#that should be given this extension so that it is recognised as one
+SHARD_INDEX_EXT = '.shards'
+SHARD_KEYS = ('file', 'size', 'md5')
+
+#files larger than this (in bytes) are never read into memory whole. They
+#aren't given the text type (diff_match_patch works on whole texts) and are
+#binary patched by _bspatch, which maps the old file and writes the new one
+#a block at a time, as bspatch needs memory for both files. Zips with larger
+#members are bsdiffed as a whole, as rebuilding them needs each member in
+#memory
+MEMORY_CEILING = 64*1024*1024
+
+#binary files at least this size (in bytes) are given the rsync type (see
+#rsyncdelta.py) rather than bsdiff, as bsdiff needs memory many times the
+#size of the files. BINARY_TYPES maps file extensions (lower case, with the
+#dot) to the type ('bsdiff' or 'rsync') binary files with them are given
+#whatever their size
+RSYNC_MIN_SIZE = 32*1024*1024
+BINARY_TYPES = {}
+
+#bsdiff patches start with this, then the lengths of the compressed control
+#and diff blocks and the size of the new file
+BSDIFF_MAGIC = 'BSDIFF40'
+BSDIFF_HEADER_SIZE = 32
+
+#the number of threads the source files are checked with before a merge
+#starts (hashlib releases the GIL, so they hash in parallel)
+VERIFY_WORKERS = 4
+
+#the ioctl that makes a file share the data of another until either is
+#changed (a reflink), on filesystems that support it such as btrfs and xfs
+FICLONE = 0x40049409
+
+#outputs are written to a file with this extension next to where they are
+#going, then renamed over it, so files (which may be hardlinks) are never
+#changed in place
+TMP_EXT = '.pypatch-tmp'
+
 def _getFileContents(filePath, mode='r'):
     f = open(filePath, mode)
     contents = f.read()
@@ -49,7 +193,12 @@ def _getFileContents(filePath, mode='r'):
 
 def _getFileMd5(filePath):
     h = hashlib.md5()
-    h.update(_getFileContents(filePath))
+    with open(filePath, 'rb') as f:
+        while True:
+            data = f.read(ZIP_CHUNK_SIZE)
+            if not data:
+                break
+            h.update(data)
     return h.hexdigest()
 
 def _mkdirs(d):
@@ -60,16 +209,69 @@ def _mkdirs(d):
     if not os.path.exists(d):
         os.makedirs(d)
 
-def _createCopy2(src, dst):
+def _createCopy2(src, dst, link=False):
     """
     Creates a of a file but ensures directories
     exist and overwrites the dst if it exists
+
+    The copy is a reflink if the filesystem supports them. Otherwise if
+    link is true it is a hardlink (so it must never be changed in place)
+    and the data is only copied if neither can be made
     """
     _mkdirs(os.path.dirname(dst))
     if os.path.exists(dst):
         os.remove(dst)
+    if _reflink(src, dst):
+        shutil.copystat(src, dst)
+        return
+    if link and hasattr(os, 'link'):
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
     shutil.copy2(src, dst)
 
+def _reflink(src, dst):
+    """
+    Makes dst a reflink of src, returning False if the filesystem (or
+    platform) doesn't support them
+    """
+    if fcntl is None:
+        return False
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+        except (IOError, OSError):
+            pass
+    os.remove(dst)
+    return False
+
+def _moveFile(src, dst):
+    """
+    Moves src to dst, replacing dst. It is renamed if they are on the same
+    device, otherwise it is copied (see _createCopy2) next to dst and then
+    renamed, so dst is never changed in place
+    """
+    _mkdirs(os.path.dirname(dst))
+    try:
+        _replaceFile(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    tmp = dst + TMP_EXT
+    _createCopy2(src, tmp)
+    _replaceFile(tmp, dst)
+    os.remove(src)
+
+def _replaceFile(src, dst):
+    #os.rename can't replace a file on windows
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
 #------------------------------------------------------------------------------
 #Patch functions
 
@@ -79,135 +281,699 @@ class PatchError(Exception):
     """
     pass
 
+class SourceError(PatchError):
+    """
+    Raised when files the patches are applied to are missing or have
+    changed. files is the list of them
+    """
+    def __init__(self, files):
+        PatchError.__init__(self, ('The files ' + ', '.join(files)
+                                 + ' are missing or have changed so cannot'
+                                 + ' be patched'))
+        self.files = files
+
 
 def applyPatchDirectory(srcDir, patchDir):
     """
     Given a soruce directory and a directory generated using
     mergePatches, this merges srcDir and patchDir, deleing
-    the files listed in the cfg file
+    the files and directories listed in the cfg file
+
+    The deletions are run first so that a deleted file or directory
+    can be replaced with a directory or file of the same name
     """
+    #run deletions
+    fh = open(os.path.join(patchDir,PATCH_CFG))
+    cfg = json.loads(fh.read())
+    fh.close()
+    _deleteFiles(srcDir, cfg['deleted'], cfg.get('deleteddirs', []))
+
     filesDir = os.path.join(patchDir, MERGED_FILES)
     for root, dirs, files in os.walk(filesDir):
         for f in files:
             absFn = os.path.join(root, f) 
             fn = absFn[len(filesDir)+len(os.sep):]
             toAbsFn = os.path.join(srcDir, fn)
+            _moveFile(absFn, toAbsFn)
 
-            if os.path.exists(toAbsFn):
-                os.remove(toAbsFn)
-            shutil.move(absFn, toAbsFn)
+def _deleteFiles(srcDir, files, dirs):
+    """
+    Deletes the files and then the directories (deepest first) from srcDir.
+    Files that have already gone are skipped, as are directories that have
+    gone or are not empty
+    """
+    for f in sorted(files):
+        try:
+            os.remove(os.path.join(srcDir, f))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise PatchError('Could not delete the file ' + f)
 
-    #run deletions
-    fh = open(os.path.join(patchDir,PATCH_CFG))
-    cfg = json.loads(fh.read())
-    fh.close()
-    for f in cfg['deleted']:
-        os.remove(os.path.join(srcDir, f))
+    for d in sorted(dirs, key=lambda d: d.count(os.sep), reverse=True):
+        try:
+            os.rmdir(os.path.join(srcDir, d))
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTEMPTY, errno.EEXIST):
+                raise PatchError('Could not delete the directory ' + d)
 
-def mergePatches(srcDir, outDir, patchFiles):
+def mergePatches(srcDir, outDir, patchFiles, repair=None):
     """
     This when given a set of pages and a source directory applies the
     patches and puts the output in a output directory.
+
+    repair - As for PatchMerger
     """
-    _mkdirs(outDir)
+    PatchMerger(srcDir, outDir, repair).finish(patchFiles)
 
-    delList = []
-    for f in patchFiles:
-        tmpDir = tempfile.mkdtemp() 
+class PatchMerger:
+    """
+    Merges patches into an output directory one at a time, as mergePatches
+    does. Patches that are containers can also be merged while they are
+    downloading: each entry is applied as soon as it has arrived (see
+    stream), so the patch is never extracted from the downloaded file
+    """
+    def __init__(self, srcDir, outDir, repair=None):
+        """
+        Anything merged into outDir before is removed, as the merge starts
+        again from srcDir
 
-        _extract(f, tmpDir)
-        _applyPatch(srcDir, outDir, tmpDir, delList)
+        repair - Called with a list of the files that the patches are
+                 applied to that are missing or have changed, and the
+                 directory to write fixed copies of them to (so the merge
+                 continues rather than failing). Any it doesn't fix are
+                 raised as a SourceError
+        """
+        self.srcDir = srcDir
+        self.outDir = outDir
+        self.repair = repair
+        self.delSet = set()
+        self.delDirSet = set()
+        #maps the sources verify checked to their (md5, path), so they
+        #aren't hashed again when they are patched
+        self.verified = {}
+        self.streams = []
+        #set if a stream failed after it had changed outDir
+        self.dirty = False
+        #streams can be fed from different threads, but only one is merged
+        #at a time
+        self.lock = threading.Lock()
+        self._reset()
 
-        shutil.rmtree(tmpDir)
+    def _reset(self):
+        if os.path.exists(os.path.join(self.outDir, MERGED_FILES)):
+            shutil.rmtree(os.path.join(self.outDir, MERGED_FILES))
+        _mkdirs(self.outDir)
+        self.delSet.clear()
+        self.delDirSet.clear()
+        self.verified.clear()
 
-    fh = open(os.path.join(outDir,PATCH_CFG), 'w') 
-    fh.write(json.dumps({'deleted' : delList}))
-    fh.close()
+    def addPatch(self, patchFile):
+        """
+        Merges the patch in patchFile, which can be a shard index (in which
+        case the shards it lists are merged)
+        """
+        if _isShardIndex(patchFile):
+            for shard in readShardIndex(patchFile):
+                self.addPatch(os.path.join(os.path.dirname(patchFile),
+                                           shard['file']))
+            return
+
+        tmpDir = tempfile.mkdtemp()
+        try:
+            _extract(patchFile, tmpDir)
+            _applyPatch(self.srcDir, self.outDir, tmpDir,
+                        self.delSet, self.delDirSet, self.verified)
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def verify(self, patchFiles):
+        """
+        Checks every file the patches in patchFiles (which are merged after
+        anything already merged) are applied to, before any are merged, so
+        a missing or changed file is found without wasting the merge.
+        They are repaired if they can be, otherwise a SourceError listing
+        all of them is raised
+        """
+        cfgs = []
+        for f in patchFiles:
+            cfgs += _readPatchCfgs(f)
+        sources = _requiredSources(cfgs)
+        if not sources:
+            return
+
+        pool = multiprocessing.pool.ThreadPool(min(VERIFY_WORKERS,
+                                                   len(sources)))
+        try:
+            paths = pool.map(_checkSourceArgs,
+                             [(self.srcDir, self.outDir) + source
+                                 for source in sources])
+        finally:
+            pool.close()
+            pool.join()
+        bad = [source for source, path in zip(sources, paths) if path is None]
+        if bad and self.repair is not None:
+            self.repair([source[0] for source in bad],
+                        os.path.join(self.outDir, MERGED_FILES))
+            repaired = [_checkSourceArgs((self.srcDir, self.outDir) + source)
+                            for source in bad]
+            sources += bad
+            paths += repaired
+            bad = [source for source, path in zip(bad, repaired)
+                      if path is None]
+        for (fn, md5, md5Func), path in zip(sources, paths):
+            if path is not None:
+                self.verified[fn] = (md5, path)
+        if bad:
+            raise SourceError([source[0] for source in bad])
+
+    def stream(self, group=None):
+        """
+        Returns a PatchStream for the next patch. The patches have to be
+        streamed in the order they are merged in, a patch that arrives
+        before the ones before it have all been merged isn't streamed (it
+        is merged from its file by finish instead)
+
+        group - Consecutive patches with the same group (which aren't None)
+                can be merged in any order, such as the shards of a patch
+        """
+        stream = PatchStream(self, group)
+        self.streams.append(stream)
+        return stream
+
+    def _canStream(self, stream):
+        i = self.streams.index(stream)
+        return (not self.dirty
+                and all(s.finished for s in self.streams[:i]
+                        if s.group is None or s.group != stream.group))
+
+    def finish(self, patchFiles):
+        """
+        Merges the patches in patchFiles that haven't already been merged
+        by streaming them and writes the merged config
+
+        patchFiles - All of the patches to merge, in order, including any
+                     that were streamed
+        """
+        #a stream that was merging when it stopped can't be trusted either
+        if self.dirty or any(s.cfg is not None and not s.finished
+                             for s in self.streams):
+            self._reset()
+            self.streams = []
+        toMerge = [f for i, f in enumerate(patchFiles)
+                     if i >= len(self.streams) or not self.streams[i].finished]
+        self.verify(toMerge)
+        for f in toMerge:
+            self.addPatch(f)
+
+        with open(os.path.join(self.outDir, PATCH_CFG), 'w') as fh:
+            fh.write(json.dumps({
+                'deleted' : sorted(self.delSet),
+                'deleteddirs' : sorted(self.delDirSet),
+            }))
+
+class PatchStream:
+    """
+    Applies a patch that is a container as its data arrives (feed is meant
+    to be passed as the onData of a PartialDownloader download). Anything
+    that isn't a container, or that arrives out of order, is ignored
+    so that it is merged from its file once it has downloaded
+    """
+    def __init__(self, merger, group=None):
+        self.merger = merger
+        self.group = group
+        self.finished = False
+        self.failed = False
+        self.patchDir = None
+        self.reader = None
+        self.cfg = None
+
+    def feed(self, data):
+        with self.merger.lock:
+            self._feed(data)
+
+    def _feed(self, data):
+        if self.finished or self.failed:
+            return
+        try:
+            if self.reader is None:
+                if (not data.startswith(container.MAGIC[:len(data)])
+                        or not self.merger._canStream(self)):
+                    self.failed = True
+                    return
+                self.patchDir = tempfile.mkdtemp()
+                self.reader = container.StreamReader(self.patchDir,
+                                                     self._onEntry)
+            self.reader.feed(data)
+            if self.reader.done():
+                self._finish()
+        except (container.ContainerError, PatchError, EnvironmentError):
+            #the file is merged again (which will fail the same way if it
+            #really is corrupt) but anything this merged can't be trusted
+            self.failed = True
+            if self.cfg is not None:
+                self.merger.dirty = True
+            self._close()
+
+    def _onEntry(self, name, path):
+        merger = self.merger
+        if self.cfg is None:
+            if name != PATCH_CFG:
+                raise PatchError('The patch config isn\'t first in the patch')
+            with open(path) as cfgFile:
+                self.cfg = json.loads(cfgFile.read())
+            self.staged = _stageSources(merger.srcDir, merger.outDir,
+                                        self.patchDir, self.cfg,
+                                        merger.verified)
+            self.pending = {}
+            for fn, filecfg in _fileCfgs(self.cfg):
+                member = _payloadMember(fn, filecfg)
+                if member is None:
+                    self._apply(fn, filecfg)
+                else:
+                    self.pending[member] = fn
+        elif name == SOLID_BLOCK:
+            _expandSolid(self.patchDir)
+            for member, offset, length in self.cfg['solid']:
+                self._applyMember(member)
+        else:
+            self._applyMember(name.replace('/', os.sep))
+
+    def _applyMember(self, member):
+        if member not in self.pending:
+            raise PatchError('The patch has the unexpected entry ' + member)
+        fn = self.pending.pop(member)
+        self._apply(fn, self.cfg[fn])
+        #not needed anymore, so there is only ever one payload on disk.
+        #new files have already been moved out
+        if os.path.exists(os.path.join(self.patchDir, member)):
+            os.remove(os.path.join(self.patchDir, member))
+
+    def _apply(self, fn, filecfg):
+        merger = self.merger
+        _applyFile(merger.srcDir, merger.outDir, self.patchDir, fn, filecfg,
+                   self.staged, merger.delSet, merger.delDirSet,
+                   merger.verified)
+
+    def _finish(self):
+        if self.cfg is None or self.pending:
+            raise PatchError('The patch is missing entries')
+        _finishPatch(self.merger.outDir, self.cfg,
+                     self.merger.delSet, self.merger.delDirSet)
+        self.finished = True
+        self._close()
+
+    def _close(self):
+        if self.reader is not None:
+            self.reader.close()
+        if self.patchDir is not None:
+            shutil.rmtree(self.patchDir, ignore_errors=True)
+            self.patchDir = None
 
 def _extract(inputFile, destDir):
+    """
+    Extracts a patch, which may be a zip or a container
+    """
     assert ( os.path.isfile(inputFile) )
-    with zipfile.ZipFile(inputFile) as zf:
-        zf.extractall(destDir)
+    if container.isContainer(inputFile):
+        try:
+            with container.ContainerReader(inputFile) as reader:
+                reader.extractAll(destDir)
+        except container.ContainerError as e:
+            raise PatchError(str(e))
+    else:
+        with zipfile.ZipFile(inputFile) as zf:
+            zf.extractall(destDir)
+    _expandSolid(destDir)
 
-def _applyPatch(srcDir, outDir, patchDir, delList):
+def _expandSolid(patchDir):
+    """
+    Extracts the entries in the solid block (if there is one) of an extracted
+    patch to where they would be if they weren't in the block
+    """
+    with open(os.path.join(patchDir, PATCH_CFG)) as cfgFile:
+        cfg = json.loads(cfgFile.read())
+    if 'solid' not in cfg:
+        return
+
+    block = os.path.join(patchDir, SOLID_BLOCK)
+    with contextlib.closing(bz2.BZ2File(block)) as f:
+        for member, offset, length in cfg['solid']:
+            dst = os.path.join(patchDir, member)
+            _mkdirs(os.path.dirname(dst))
+            with open(dst, 'wb') as out:
+                while length:
+                    data = f.read(min(length, ZIP_CHUNK_SIZE))
+                    if not data:
+                        raise PatchError('The solid block in the patch is'
+                                       + ' too short')
+                    out.write(data)
+                    length -= len(data)
+    os.remove(block)
+
+def _applyPatch(srcDir, outDir, patchDir, delSet, delDirSet, verified=None):
     """
     Given two directories, this applies the patch to srcdir from patchdir
     If the file to be patched already exists in ouputDir, then the patch
     will be run on the file in outputDir.
 
-    delList is a list of files that have been deleted. If a file
-    that had been deleted is again created then it is removed
-    from the deleted list
+    Files that are patched from (or are copies of) a file at another path
+    use the file as it was before this patch. As this patch may overwrite
+    those files, they are copied out of the way before anything is written
+
+    delSet is a set of files that have been deleted and delDirSet a set
+    of directories that have been deleted. If a file that had been deleted
+    is again created then it (and the directories it is in) are removed
+    from the deleted sets
+
+    verified - Maps files that have already been checked to their (md5,
+               path), see PatchMerger.verify
     """
+    if verified is None:
+        verified = {}
     with open(os.path.join(patchDir, PATCH_CFG)) as cfgFile:
         cfg = json.loads(cfgFile.read())
 
-    #move all new files
-    newFilesDir = os.path.join(patchDir, NEW_DIR)
-    for root, dirs, files in os.walk(newFilesDir):
-        for f in files:
-            absFn = os.path.join(root, f) 
-            fn = absFn[len(newFilesDir)+len(os.sep):]
-            outAbsFn = os.path.join(outDir, MERGED_FILES, fn)
-            if os.path.exists(outAbsFn):
-                os.remove(outAbsFn)
-            _createCopy2(absFn, outAbsFn)
-
-            if fn in delList:
-                delList.remove(fn)
-
-    #apply all patch files
-    patchFilesDir = os.path.join(patchDir, PATCH_DIR)
-    for root, dirs, files in os.walk(patchFilesDir):
-        #root contains patchdir, which we don't want
-        for f in files:
-            patchAbsFn = os.path.join(root, f) 
-            fn = patchAbsFn[len(patchFilesDir)+len(os.sep):]
-            srcAbsFn = os.path.join(srcDir, fn)
-            outAbsFn = os.path.join(outDir, MERGED_FILES, fn)
+    staged = _stageSources(srcDir, outDir, patchDir, cfg, verified)
+    for fn, filecfg in _fileCfgs(cfg):
+        _applyFile(srcDir, outDir, patchDir, fn, filecfg, staged,
+                   delSet, delDirSet, verified)
+    _finishPatch(outDir, cfg, delSet, delDirSet)
+
+def _stageSources(srcDir, outDir, patchDir, cfg, verified):
+    """
+    Copies the files that files at other paths are patched from into
+    patchDir, returning a dict mapping their names to the copies
+    """
+    staged = {}
+    for fn, filecfg in _fileCfgs(cfg):
+        src = filecfg.get('src')
+        if src is not None and src not in staged:
+            staged[src] = os.path.join(patchDir, STAGE_DIR, str(len(staged)))
+            _createCopy2(_getPatchSource(srcDir, outDir, src,
+                                         filecfg['oldmd5'],
+                                         verified=verified),
+                         staged[src], link=True)
+    return staged
 
-            filecfg = cfg[fn]
+def _applyFile(srcDir, outDir, patchDir, fn, filecfg, staged,
+               delSet, delDirSet, verified):
+    """
+    Applies the patch for the file fn (see _applyPatch)
+    """
+    outAbsFn = os.path.join(outDir, MERGED_FILES, fn)
+    patchType = filecfg.get('type')
 
-            if os.path.exists(outAbsFn):
-                toPatchAbsFn = outAbsFn
-            else:
-                toPatchAbsFn = srcAbsFn
-                
-            if os.path.exists(toPatchAbsFn):
-                if _getFileMd5(toPatchAbsFn) != filecfg['oldmd5']:
-                    raise PatchError(('The file ' + toPatchAbsFn + ' has changed'
-                                    + ' so cannot be patched'))
-            else:
-                raise PatchError(('The file ' + toPatchAbsFn + ' doesn\' exist'
-                                + ' so cannot be patched'))
-                
-
-            if filecfg['type'] == 'bsdiff':
-                func = _patchBin
-            elif filecfg['type'] == 'text':
-                func = _patchText
+    if patchType is None:
+        #a new file, which isn't needed in the extracted patch anymore
+        _moveFile(os.path.join(patchDir, NEW_DIR, fn), outAbsFn)
+    else:
+        if 'src' in filecfg:
+            toPatchAbsFn = staged[filecfg['src']]
+        elif patchType == 'pycheader':
+            #the header of the local file may well differ from the one
+            #the patch was made from, as python rewrites .pyc files
+            toPatchAbsFn = _getPatchSource(srcDir, outDir, fn,
+                                           filecfg['oldbodymd5'],
+                                           _getPycBodyMd5, verified)
+        else:
+            toPatchAbsFn = _getPatchSource(srcDir, outDir, fn,
+                                           filecfg['oldmd5'],
+                                           verified=verified)
+        patchAbsFn = os.path.join(patchDir, PATCH_DIR, fn)
+        tmpAbsFn = outAbsFn + TMP_EXT
+        _mkdirs(os.path.dirname(tmpAbsFn))
+        if os.path.exists(tmpAbsFn):
+            os.remove(tmpAbsFn)
+
+        if patchType == 'copy':
+            _createCopy2(toPatchAbsFn, tmpAbsFn)
+        elif patchType == 'bsdiff':
+            _patchBin(toPatchAbsFn, tmpAbsFn, patchAbsFn)
+        elif patchType == 'text':
+            _patchText(toPatchAbsFn, tmpAbsFn, patchAbsFn)
+        elif patchType == 'zip':
+            _patchZip(toPatchAbsFn, tmpAbsFn, patchAbsFn)
+        elif patchType == 'rsync':
+            _patchRsync(toPatchAbsFn, tmpAbsFn, patchAbsFn)
+        elif patchType == 'pycheader':
+            _patchPycHeader(toPatchAbsFn, tmpAbsFn,
+                            filecfg['header'].decode('hex'))
+        else:
+            raise PatchError('Unknown type')
+
+        if not os.path.exists(tmpAbsFn):
+            raise PatchError('The output from patching: ' + outAbsFn + ' doesn\'t exist')
+
+        if _getFileMd5(tmpAbsFn) != filecfg['patchedmd5']:
+            os.remove(tmpAbsFn)
+            raise PatchError('There was an error patching the file: ' + toPatchAbsFn)
+        _replaceFile(tmpAbsFn, outAbsFn)
+    verified.pop(fn, None)
+
+    delSet.discard(fn)
+    d = os.path.dirname(fn)
+    while d:
+        delDirSet.discard(d)
+        d = os.path.dirname(d)
+
+def _finishPatch(outDir, cfg, delSet, delDirSet):
+    """
+    Adds the files and directories a patch deletes to the deleted sets
+    """
+    #add deleted, removing any files earlier patches created
+    for fn in cfg['deleted']:
+        delSet.add(fn)
+        mergedFn = os.path.join(outDir, MERGED_FILES, fn)
+        if os.path.isfile(mergedFn):
+            os.remove(mergedFn)
+    delDirSet.update(cfg.get('deleteddirs', []))
+
+def _readPatchCfgs(patchFile):
+    """
+    Returns the configs of a patch, which is a list of the config of each
+    shard if it is a shard index
+    """
+    if _isShardIndex(patchFile):
+        cfgs = []
+        for shard in readShardIndex(patchFile):
+            cfgs += _readPatchCfgs(os.path.join(os.path.dirname(patchFile),
+                                                shard['file']))
+        return cfgs
+
+    if container.isContainer(patchFile):
+        try:
+            with container.ContainerReader(patchFile) as reader:
+                return [json.loads(reader.read(PATCH_CFG))]
+        except container.ContainerError as e:
+            raise PatchError(str(e))
+    with zipfile.ZipFile(patchFile) as zf:
+        return [json.loads(zf.read(PATCH_CFG))]
+
+def _requiredSources(cfgs):
+    """
+    Returns a list of (filename, md5, md5Func) for the files that patches
+    with the given configs (applied in order) need as they are before any
+    of the patches, skipping those an earlier patch writes or deletes
+    """
+    sources = []
+    seen = set()
+    for cfg in cfgs:
+        for fn, filecfg in _fileCfgs(cfg):
+            patchType = filecfg.get('type')
+            if patchType is None:
+                continue
+            src = filecfg.get('src', fn)
+            if src in seen:
+                continue
+            seen.add(src)
+            if patchType == 'pycheader' and 'src' not in filecfg:
+                sources.append((src, filecfg['oldbodymd5'], _getPycBodyMd5))
             else:
-                raise PatchError('Unknown type')
-            func(toPatchAbsFn, outAbsFn, patchAbsFn)
+                sources.append((src, filecfg['oldmd5'], _getFileMd5))
+        seen.update(fn for fn, filecfg in _fileCfgs(cfg))
+        seen.update(cfg['deleted'])
+    return sources
 
-            if not os.path.exists(outAbsFn):
-                raise PatchError('The output from patching: ' + outAbsFn + ' doesn\'t exist')
+def _checkSourceArgs(args):
+    """
+    Returns the path of a source if it is as expected, otherwise None
+    """
+    srcDir, outDir, fn, md5, md5Func = args
+    try:
+        return _getPatchSource(srcDir, outDir, fn, md5, md5Func)
+    except (PatchError, EnvironmentError):
+        return None
 
-            if _getFileMd5(outAbsFn) != filecfg['patchedmd5']:
-                raise PatchError('There was an error patching the file: ' + toPatchAbsFn)
-    
-    #add deleted
-    delList.extend(cfg['deleted'])
+def _getPatchSource(srcDir, outDir, fn, md5, md5Func=None,
+                    verified=None):
+    """
+    Returns the path of the file fn as it is before the patch being applied,
+    which is in outDir if an earlier patch wrote it. Raises a PatchError if
+    it doesn't exist or doesn't have the md5 the patch expects
+
+    md5Func - The function used to get the md5 of the file, _getFileMd5
+              if None
+    verified - Maps files that have already been checked to their (md5,
+               path). The file isn't hashed again if it is in it
+    """
+    toPatchAbsFn = os.path.join(outDir, MERGED_FILES, fn)
+    if not os.path.exists(toPatchAbsFn):
+        toPatchAbsFn = os.path.join(srcDir, fn)
+
+    if not os.path.exists(toPatchAbsFn):
+        raise PatchError(('The file ' + toPatchAbsFn + ' doesn\' exist'
+                        + ' so cannot be patched'))
+    if verified and verified.get(fn) == (md5, toPatchAbsFn):
+        return toPatchAbsFn
+    if (md5Func or _getFileMd5)(toPatchAbsFn) != md5:
+        raise PatchError(('The file ' + toPatchAbsFn + ' has changed'
+                        + ' so cannot be patched'))
+    return toPatchAbsFn
 
 def _patchBin(src, out, patch):
     assert ( os.path.exists(src) )
     assert ( os.path.exists(patch) )
 
     _mkdirs(os.path.dirname(out))
+    ctrlLength, diffLength, newSize = _bsdiffHeader(patch)
+    if os.path.getsize(src) + newSize > MEMORY_CEILING:
+        _bspatch(src, out, patch)
+        return
+
     e = os.spawnlp(os.P_WAIT, BSPATCH, BSPATCH, src, out, patch)
     if e != 0:
         raise PatchError('Error when using ' + BSPATCH + ' to patch ' + src)
-    
+
+def _patchRsync(src, out, patch):
+    _mkdirs(os.path.dirname(out))
+    try:
+        rsyncdelta.patch(src, out, patch)
+    except rsyncdelta.DeltaError as e:
+        raise PatchError('Error patching ' + src + ': ' + str(e))
+
+def _offtin(data):
+    """
+    Reads a number in bsdiff's format, 8 bytes of little endian magnitude
+    with the sign in the top bit
+    """
+    sign = ord(data[7]) & 0x80
+    value, = struct.unpack('<Q', data[:7] + chr(ord(data[7]) & 0x7f))
+    return -value if sign else value
+
+def _bsdiffHeader(patch):
+    """
+    Returns the (control block length, diff block length, new file size)
+    from the header of a bsdiff patch
+    """
+    with open(patch, 'rb') as f:
+        header = f.read(BSDIFF_HEADER_SIZE)
+    if len(header) < BSDIFF_HEADER_SIZE or not header.startswith(BSDIFF_MAGIC):
+        raise PatchError('The patch ' + patch + ' isn\'t a bsdiff patch')
+    lengths = [_offtin(header[i:i + 8]) for i in (8, 16, 24)]
+    if min(lengths) < 0:
+        raise PatchError('The patch ' + patch + ' is corrupt')
+    return lengths
+
+class _Bz2Reader:
+    """
+    Reads a bzip2 compressed block of a file a part at a time
+    """
+    def __init__(self, filePath, offset, length):
+        self.f = open(filePath, 'rb')
+        self.f.seek(offset)
+        self.left = length
+        self.decompressor = bz2.BZ2Decompressor()
+        self.buf = ''
+
+    def read(self, n):
+        """
+        Returns the next n bytes, raising a PatchError if there aren't n
+        """
+        parts = [self.buf]
+        available = len(self.buf)
+        while available < n and self.left:
+            data = self.f.read(min(self.left, COMPARE_CHUNK_SIZE))
+            if not data:
+                break
+            self.left -= len(data)
+            try:
+                data = self.decompressor.decompress(data)
+            except (IOError, EOFError):
+                raise PatchError('A block of the patch is corrupt')
+            parts.append(data)
+            available += len(data)
+        data = ''.join(parts)
+        if len(data) < n:
+            raise PatchError('A block of the patch is too short')
+        self.buf = data[n:]
+        return data[:n]
+
+    def close(self):
+        self.f.close()
+
+def _addBytes(a, b):
+    """
+    Returns the bytes of a added to the bytes of b (modulo 256)
+    """
+    if a.count('\0') == len(a):
+        return b
+    if numpy is not None:
+        return (numpy.frombuffer(a, numpy.uint8)
+                + numpy.frombuffer(b, numpy.uint8)).tostring()
+    return str(bytearray((x + y) & 0xff
+                         for x, y in zip(bytearray(a), bytearray(b))))
+
+def _oldBytes(old, pos, n):
+    """
+    Returns n bytes of old from pos, where the bytes outside of old are 0
+    """
+    start = max(pos, 0)
+    end = min(pos + n, len(old))
+    if start >= end:
+        return '\0' * n
+    return '\0' * (start - pos) + old[start:end] + '\0' * (pos + n - end)
+
+def _bspatch(src, out, patch):
+    """
+    Applies a bsdiff patch the way bspatch does, but with the old file
+    mapped rather than read and the new file written a block at a time,
+    so it doesn't need much memory whatever the size of the files
+    """
+    ctrlLength, diffLength, newSize = _bsdiffHeader(patch)
+    blocks = []
+    offset = BSDIFF_HEADER_SIZE
+    for length in (ctrlLength, diffLength,
+                   os.path.getsize(patch) - offset - ctrlLength - diffLength):
+        blocks.append(_Bz2Reader(patch, offset, length))
+        offset += length
+    ctrl, diff, extra = blocks
+
+    with open(src, 'rb') as fsrc, open(out, 'wb') as fout:
+        old = ''
+        if os.path.getsize(src):
+            old = mmap.mmap(fsrc.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            oldPos = newPos = 0
+            while newPos < newSize:
+                x, y, z = [_offtin(ctrl.read(8)) for i in xrange(3)]
+                if x < 0 or y < 0 or newPos + x + y > newSize:
+                    raise PatchError('The patch ' + patch + ' is corrupt')
+
+                for i in xrange(0, x, ZIP_CHUNK_SIZE):
+                    n = min(ZIP_CHUNK_SIZE, x - i)
+                    fout.write(_addBytes(diff.read(n),
+                                         _oldBytes(old, oldPos + i, n)))
+                for i in xrange(0, y, ZIP_CHUNK_SIZE):
+                    fout.write(extra.read(min(ZIP_CHUNK_SIZE, y - i)))
+
+                newPos += x + y
+                oldPos += x + z
+        finally:
+            if old:
+                old.close()
+            for block in blocks:
+                block.close()
+
 def _patchText(src, out, patch):
     o = diff_match_patch()
     txt = _getFileContents(src)
@@ -256,65 +1022,837 @@ def _isText(filePath):
         return float(len(tran))/len(out) < 0.3
     return False
 
-def generateDiff(oldDir, newDir, outputFile):
+def generateDiff(oldDir, newDir, outputFile, diffWorkers=1, timeBudget=None,
+                 cache=None, solid=False, useContainer=False, shards=1,
+                 compressWorkers=1):
     """
     Generates a patch containing the diff between two directories
+
+    diffWorkers - The number of processes used to diff each large text file
+    timeBudget - The number of seconds that diffing all the text files
+                 should take. Each file is given a share of what is left
+                 according to its size and how similar the old and new
+                 versions look. If None, each file gets diff_match_patch's
+                 default timeout
+    cache - A deltacache.DeltaCache. Deltas are taken from it rather
+            than generated where possible, and generated ones are added
+            (other than text deltas that ran out of time)
+    solid - If true, small entries are compressed together in one block
+            (see _planSolid), which is much smaller when there are lots of
+            them
+    useContainer - If true, the patch is written as a container (see
+                   container.py) rather than a zip
+    shards - If more than 1, the patch is split into up to this many shards
+             of about the same size (see _planShards). They are written to
+             outputFile + '.0', outputFile + '.1' etc. and outputFile is the
+             index listing them (see readShardIndex)
+    compressWorkers - The number of processes the entries of the patch are
+                      compressed in. The patch is the same whatever the number
+
+    Returns a report dict. report['timedout'] maps the text files whose diff
+    ran out of time (and so may be larger than it needs to be) to the number
+    of seconds they were given
     """
     assert os.path.isdir(oldDir)
     assert os.path.isdir(newDir)
 
-    cfg = {
-        'deleted' : [],
+    cfg = _planDiff(oldDir, newDir, _hashTree(newDir))
+    report = {
+        'timedout' : {},
     }
+    pool = None
+    if diffWorkers > 1:
+        pool = multiprocessing.Pool(diffWorkers)
+
     tmpDir = tempfile.mkdtemp() 
-    for root, dirs, files in os.walk(newDir):
+    textFiles = []
+    for fn, filecfg in _fileCfgs(cfg):
+        patchfn = os.path.join(tmpDir, PATCH_DIR , fn)
+        if filecfg.get('type') in (None,) + NO_PAYLOAD_TYPES:
+            pass
+        elif _getCachedDelta(cache, filecfg, patchfn):
+            pass
+        elif filecfg['type'] == 'text':
+            #diffed below, once the time for each is known
+            textFiles.append(fn)
+        else:
+            _genDelta((filecfg['type'],
+                       _oldPath(oldDir, fn, filecfg),
+                       os.path.join(newDir, fn),
+                       patchfn))
+            _cacheDelta(cache, filecfg, patchfn)
+
+    #the time budget is only shared between the files that need diffing
+    weights = {}
+    for fn in textFiles:
+        weights[fn] = _diffWeight(
+                        os.path.getsize(_oldPath(oldDir, fn, cfg[fn])),
+                        os.path.getsize(os.path.join(newDir, fn)))
+    remainingWeight = sum(weights.itervalues())
+    remainingTime = timeBudget
+
+    #smallest first, so any time they don't use goes to the larger files
+    textFiles.sort(key=lambda fn: weights[fn])
+    for fn in textFiles:
+        if timeBudget is None:
+            timeout = diff_match_patch().Diff_Timeout
+        else:
+            share = weights[fn] / float(max(remainingWeight, 1))
+            timeout = max(MIN_DIFF_TIMEOUT, remainingTime * share)
+
+        patchfn = os.path.join(tmpDir, PATCH_DIR , fn)
+        timeTaken = _genTextPatch(_oldPath(oldDir, fn, cfg[fn]),
+                                  os.path.join(newDir, fn),
+                                  patchfn,
+                                  pool,
+                                  timeout)
+
+        #a delta that ran out of time may be much worse than one made with
+        #more, so isn't cached to be used by later runs
+        if timeTaken >= timeout:
+            report['timedout'][fn] = timeout
+        else:
+            _cacheDelta(cache, cfg[fn], patchfn)
+        if timeBudget is not None:
+            remainingTime = max(0, remainingTime - timeTaken)
+            remainingWeight -= weights[fn]
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    for fn, filecfg in _fileCfgs(cfg):
+        patchfn = os.path.join(tmpDir, PATCH_DIR , fn)
+        if not _isUsefulDelta(filecfg, patchfn, os.path.join(newDir, fn)):
+            os.remove(patchfn)
+            _makeNewFile(filecfg)
+        if 'type' not in filecfg:
+            _createCopy2(os.path.join(newDir, fn),
+                         os.path.join(tmpDir, NEW_DIR , fn), link=True)
+
+    for fn, filecfg in _fileCfgs(cfg):
+        member = _payloadMember(fn, filecfg)
+        if member is not None:
+            filecfg['codec'] = _chooseCodec(os.path.join(tmpDir, member))
+
+    if shards > 1:
+        _writeShards(tmpDir, cfg, outputFile, shards, solid, useContainer,
+                     compressWorkers)
+    else:
+        _writePatchDir(tmpDir, cfg, outputFile, solid, useContainer,
+                       compressWorkers)
+
+    assert ( os.path.exists(outputFile) )
+    assert ( os.path.isfile(outputFile) )
+
+    shutil.rmtree(tmpDir)
+    return report
+
+def _writePatchDir(patchDir, cfg, outputFile, solid, useContainer,
+                   workers=1):
+    """
+    Writes the patch with the config cfg and the payloads in patchDir (with
+    the codecs given in cfg) to outputFile
+    """
+    codecs = {}
+    for fn, filecfg in _fileCfgs(cfg):
+        member = _payloadMember(fn, filecfg)
+        if member is not None:
+            codecs[member] = CODECS[filecfg['codec']]
+
+    if solid:
+        solidPaths = _planSolid(cfg,
+                                lambda member: os.path.join(patchDir, member))
+        if solidPaths:
+            _writeSolid(solidPaths, os.path.join(patchDir, SOLID_BLOCK))
+            for path in solidPaths:
+                os.remove(path)
+            codecs[SOLID_BLOCK] = zipfile.ZIP_STORED
+
+    _writeCfg(patchDir, cfg)
+    _writePatchFile(patchDir, outputFile, codecs=codecs,
+                    useContainer=useContainer, workers=workers)
+
+def _writeShards(patchDir, cfg, outputFile, count, solid, useContainer,
+                 workers=1):
+    """
+    Writes the patch with the config cfg and the payloads in patchDir as
+    shards, and the index listing them to outputFile
+    """
+    index = []
+    for i, shardCfg in enumerate(_planShards(cfg, patchDir, count)):
+        shardDir = tempfile.mkdtemp()
+        try:
+            for fn, filecfg in _fileCfgs(shardCfg):
+                member = _payloadMember(fn, filecfg)
+                if member is not None:
+                    _mkdirs(os.path.dirname(os.path.join(shardDir, member)))
+                    os.rename(os.path.join(patchDir, member),
+                              os.path.join(shardDir, member))
+            shardFile = '%s.%d' % (outputFile, i)
+            _writePatchDir(shardDir, shardCfg, shardFile, solid, useContainer,
+                           workers)
+        finally:
+            shutil.rmtree(shardDir)
+        index.append({
+            'file' : os.path.basename(shardFile),
+            'size' : os.path.getsize(shardFile),
+            'md5' : _getFileMd5(shardFile),
+        })
+
+    with open(outputFile, 'w') as f:
+        f.write(json.dumps({'shards' : index}))
+
+def _planShards(cfg, patchDir, count):
+    """
+    Splits the patch config cfg into the configs of up to count shards, so
+    that the total size of the payloads in each is about the same. Shards of
+    the same patch can be merged in any order, so a file is put in the same
+    shard as the file it is patched from (if that is changed or deleted by
+    the patch). Empty shards are left out
+    """
+    #union find over the files, so that chains of sources stay together
+    parent = {}
+    def find(fn):
+        while parent.get(fn, fn) != fn:
+            fn = parent[fn]
+        return fn
+    for fn, filecfg in _fileCfgs(cfg):
+        src = filecfg.get('src')
+        if src is not None and (src in cfg or src in cfg['deleted']):
+            a, b = sorted((find(fn), find(src)))
+            if a != b:
+                parent[b] = a
+
+    groups = {}
+    for fn, filecfg in _fileCfgs(cfg):
+        groups.setdefault(find(fn), []).append(fn)
+    for fn in cfg['deleted']:
+        groups.setdefault(find(fn), []).append(fn)
+
+    def size(fn):
+        member = fn in cfg and _payloadMember(fn, cfg[fn])
+        if not member:
+            return 0
+        return os.path.getsize(os.path.join(patchDir, member))
+    sizes = dict((root, sum(size(fn) for fn in fns))
+                 for root, fns in groups.iteritems())
+
+    #largest first, each into the shard with the least in it so far
+    shards = [{'deleted' : [], 'deleteddirs' : []} for i in xrange(count)]
+    totals = [0] * count
+    for root in sorted(groups, key=lambda root: (-sizes[root], root)):
+        i = totals.index(min(totals))
+        totals[i] += sizes[root]
+        for fn in groups[root]:
+            if fn in cfg:
+                shards[i][fn] = cfg[fn]
+            else:
+                shards[i]['deleted'].append(fn)
+
+    #no file can be added to a deleted directory, so these can go anywhere
+    shards[0]['deleteddirs'] = cfg.get('deleteddirs', [])
+    for shard in shards:
+        shard['deleted'].sort()
+    return [shard for i, shard in enumerate(shards)
+            if i == 0 or len(shard) > 2 or shard['deleted']]
+
+def readShardIndex(filePath):
+    """
+    Returns the list of shards in the shard index filePath, each a dict with
+    the name of the shard's 'file' (relative to the index) and its 'size'
+    and 'md5'. Raises a PatchError if it isn't a valid index
+    """
+    try:
+        with open(filePath) as f:
+            shards = json.loads(f.read())['shards']
+    except (ValueError, KeyError, TypeError):
+        raise PatchError(filePath + ' isn\'t a shard index')
+    for shard in shards:
+        if not isinstance(shard, dict) or not set(SHARD_KEYS) <= set(shard):
+            raise PatchError(filePath + ' has an invalid shard')
+        if os.path.basename(shard['file']) != shard['file']:
+            raise PatchError('The shard ' + shard['file']
+                           + ' isn\'t next to the index')
+    return shards
+
+def _isShardIndex(filePath):
+    with open(filePath, 'rb') as f:
+        return f.read(1) == '{'
+
+def generateDiffs(oldDirs, newDir, outputFiles, workers=1, cache=None,
+                  solid=False, useContainer=False):
+    """
+    Generates a patch from each of a list of old directories to the same new
+    directory, so outputFiles[i] is the patch generateDiff(oldDirs[i], newDir,
+    outputFiles[i]) would generate. This is much cheaper than calling
+    generateDiff for each old directory, as the new directory is only hashed
+    once, a delta needed by more than one patch is only generated once and a
+    file that is in more than one patch is only compressed once.
+
+    workers - The number of processes the work is shared between. Text files
+              are diffed with diff_match_patch's default timeout
+    cache - A deltacache.DeltaCache, used as it is by generateDiff
+    solid - As for generateDiff. The solid block of each patch is
+            compressed separately
+    useContainer - As for generateDiff
+
+    Returns a list holding the report (see generateDiff) for each patch
+    """
+    assert len(oldDirs) == len(outputFiles)
+    assert os.path.isdir(newDir)
+    for oldDir in oldDirs:
+        assert os.path.isdir(oldDir)
+
+    pool = None
+    mapFunc = map
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        mapFunc = pool.map
+
+    newMd5s = _hashTree(newDir)
+    cfgs = mapFunc(_planDiffArgs,
+                   [(oldDir, newDir, newMd5s) for oldDir in oldDirs])
+
+    #work out what goes into each patch. Payloads are keyed by their content
+    #so that anything shared by patches is only generated and compressed once
+    tmpDir = tempfile.mkdtemp()
+    payloads = {}
+    deltaJobs = []
+    deltaCfgs = []
+    for oldDir, cfg in zip(oldDirs, cfgs):
+        for fn, filecfg in _fileCfgs(cfg):
+            key = _payloadKey(filecfg)
+            if (key in payloads
+                    or filecfg.get('type') in (None,) + NO_PAYLOAD_TYPES):
+                continue
+            patchfn = os.path.join(tmpDir, PATCH_DIR, str(len(payloads)))
+            payloads[key] = patchfn
+            if not _getCachedDelta(cache, filecfg, patchfn):
+                deltaJobs.append((filecfg['type'],
+                                  _oldPath(oldDir, fn, filecfg),
+                                  os.path.join(newDir, fn),
+                                  patchfn))
+                deltaCfgs.append(filecfg)
+
+    timedout = set()
+    timeout = diff_match_patch().Diff_Timeout
+    for job, filecfg, timeTaken in zip(deltaJobs, deltaCfgs,
+                                       mapFunc(_genDelta, deltaJobs)):
+        if filecfg['type'] == 'text' and timeTaken >= timeout:
+            #not cached, see generateDiff
+            timedout.add(_payloadKey(filecfg))
+        else:
+            _cacheDelta(cache, filecfg, job[3])
+
+    used = set()
+    for cfg in cfgs:
+        for fn, filecfg in _fileCfgs(cfg):
+            key = _payloadKey(filecfg)
+            if key in payloads and not _isUsefulDelta(filecfg, payloads[key],
+                                                      os.path.join(newDir, fn)):
+                _makeNewFile(filecfg)
+                key = _payloadKey(filecfg)
+            if 'type' not in filecfg:
+                payloads[key] = os.path.join(newDir, fn)
+            used.add(key)
+
+    keys = sorted(used.intersection(payloads))
+    compressed = dict(zip(keys, mapFunc(_compressFileArgs,
+        [(payloads[key], os.path.join(tmpDir, 'compressed', str(i)))
+            for i, key in enumerate(keys)])))
+
+    reports = []
+    writeJobs = []
+    for i, (cfg, outputFile) in enumerate(zip(cfgs, outputFiles)):
+        report = {
+            'timedout' : {},
+        }
+        members = {}
+        uncompressed = {}
+        for fn, filecfg in _fileCfgs(cfg):
+            key = _payloadKey(filecfg)
+            member = _payloadMember(fn, filecfg)
+            if member is None:
+                continue
+            members[member] = compressed[key]
+            uncompressed[member] = payloads[key]
+            filecfg['codec'] = compressed[key]['codec']
+            if key in timedout:
+                report['timedout'][fn] = timeout
+
+        solidPaths = []
+        if solid:
+            solidPaths = _planSolid(cfg, uncompressed.get)
+            for member, offset, length in cfg.get('solid', []):
+                del members[member]
+
+        cfgDir = os.path.join(tmpDir, 'cfg', str(i))
+        _writeCfg(cfgDir, cfg)
+        writeJobs.append((cfgDir, outputFile, members, solidPaths,
+                          useContainer))
+        reports.append(report)
+    mapFunc(_writePatchArgs, writeJobs)
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    shutil.rmtree(tmpDir)
+    return reports
+
+def _hashTree(d):
+    """
+    Returns a dict mapping the path (relative to d) of every file in d
+    to its md5
+    """
+    md5s = {}
+    for root, dirs, files in os.walk(d):
         for f in files:
             absfn = os.path.join(root, f)
-            fn = absfn[len(newDir) + len(os.sep):]
-            oldfn = os.path.join(oldDir, fn)
+            md5s[absfn[len(d) + len(os.sep):]] = _getFileMd5(absfn)
+    return md5s
 
-            filecfg = cfg[fn] = {}
+def _planDiff(oldDir, newDir, newMd5s):
+    """
+    Works out how each file in newDir will be patched, returning the patch
+    config. Files given a type are patched with a delta against (or are a
+    copy of) a file in oldDir, the rest are new files. Files that are the
+    same in both directories are left out
 
-            filecfg['patchedmd5'] = _getFileMd5(absfn)
-            if not os.path.exists(oldfn):
-                _createCopy2(absfn,
-                             os.path.join(tmpDir, NEW_DIR , fn))
-            else:
-                filecfg['oldmd5'] = _getFileMd5(oldfn)
-
-                if _isText(absfn):
-                    filecfg['type'] = 'text'
-                    func = _genTextPatch
-                else: #use bsdiff for anything with think is binary
-                    filecfg['type'] = 'bsdiff'
-                    func = _genBinPatch
-
-                func(os.path.join(oldDir, fn),
-                     os.path.join(newDir, fn),
-                     os.path.join(tmpDir, PATCH_DIR , fn))
-    
-    cfgOut = os.path.join(tmpDir, PATCH_CFG)
+    A file is copied from a file at another path in oldDir with the same
+    md5 if there is one. Otherwise it is patched against the file at the
+    same path in oldDir or, if there isn't one, against a similar sized
+    file that was removed from newDir (see _findSimilar)
+
+    The files and directories in oldDir that aren't in newDir are listed
+    in cfg['deleted'] and cfg['deleteddirs'] (deepest first)
+
+    newMd5s - The md5s of the files in newDir, from _hashTree
+    """
+    oldSizes = _fileSizes(oldDir)
+    newSizes = _fileSizes(newDir)
+    oldDirs = sorted(_listDirs(oldDir))
+    cfg = {
+        'deleted' : _sortedDifference(sorted(oldSizes), sorted(newMd5s)),
+        'deleteddirs' : sorted(_sortedDifference(oldDirs,
+                                                 sorted(_listDirs(newDir))),
+                               key=lambda d: d.count(os.sep),
+                               reverse=True),
+    }
+
+    #unchanged files are found by comparing them, which stops at the first
+    #difference, so they never need hashing
+    oldMd5s = {}
+    changed = []
+    for fn in sorted(newMd5s):
+        if (oldSizes.get(fn) == newSizes[fn]
+                and _filesEqual(os.path.join(oldDir, fn),
+                                os.path.join(newDir, fn))):
+            oldMd5s[fn] = newMd5s[fn]
+        else:
+            changed.append(fn)
+
+    #a changed file can only be copied from an old file of the same size,
+    #so only they are hashed to look for copies (other changed files are
+    #hashed when they are patched from)
+    changedSizes = set(newSizes[fn] for fn in changed)
+    oldByMd5 = {}
+    for fn, size in oldSizes.iteritems():
+        if size in changedSizes:
+            if fn not in oldMd5s:
+                oldMd5s[fn] = _getFileMd5(os.path.join(oldDir, fn))
+            oldByMd5.setdefault(oldMd5s[fn], []).append(fn)
+
+    #the files that are no longer in the new tree are the ones that
+    #are likely to have been renamed
+    removed = sorted((oldSizes[fn], fn) for fn in cfg['deleted'])
+
+    for fn in changed:
+        md5 = newMd5s[fn]
+        filecfg = cfg[fn] = {}
+        filecfg['patchedmd5'] = md5
+
+        src = fn
+        if md5 in oldByMd5:
+            src = _bestSource(fn, oldByMd5[md5], newMd5s)
+        elif fn not in oldSizes:
+            src = _findSimilar(fn, newSizes[fn], removed)
+        if src is None:
+            continue
+        if src != fn:
+            filecfg['src'] = src
+
+        if src not in oldMd5s:
+            oldMd5s[src] = _getFileMd5(os.path.join(oldDir, src))
+        filecfg['oldmd5'] = oldMd5s[src]
+        if filecfg['oldmd5'] == md5:
+            filecfg['type'] = 'copy'
+        elif (_isText(os.path.join(newDir, fn))
+                and newSizes[fn] <= MEMORY_CEILING
+                and oldSizes[src] <= MEMORY_CEILING):
+            filecfg['type'] = 'text'
+        elif _planPycHeader(os.path.join(oldDir, src),
+                            os.path.join(newDir, fn),
+                            filecfg):
+            pass
+        elif (_isZip(os.path.join(newDir, fn))
+                and _isZip(os.path.join(oldDir, src))):
+            filecfg['type'] = 'zip'
+        else: #use bsdiff for anything with think is binary
+            filecfg['type'] = _binaryType(fn, max(oldSizes[src],
+                                                  newSizes[fn]))
+    return cfg
+
+def _binaryType(fn, size):
+    """
+    Returns the patch type for the binary file fn, the larger of the old
+    and new versions of which is size bytes
+    """
+    ext = os.path.splitext(fn)[1].lower()
+    if ext in BINARY_TYPES:
+        return BINARY_TYPES[ext]
+    return 'rsync' if size >= RSYNC_MIN_SIZE else 'bsdiff'
+
+def _fileSizes(d):
+    """
+    Returns a dict mapping the path (relative to d) of every file in d
+    to its size
+    """
+    sizes = {}
+    for root, dirs, files in os.walk(d):
+        for f in files:
+            absfn = os.path.join(root, f)
+            sizes[absfn[len(d) + len(os.sep):]] = os.path.getsize(absfn)
+    return sizes
+
+def _filesEqual(a, b):
+    """
+    Returns true if the two files have the same contents, stopping at the
+    first difference
+    """
+    if os.path.getsize(a) != os.path.getsize(b):
+        return False
+    with open(a, 'rb') as fa, open(b, 'rb') as fb:
+        while True:
+            dataA = fa.read(COMPARE_CHUNK_SIZE)
+            if dataA != fb.read(COMPARE_CHUNK_SIZE):
+                return False
+            if not dataA:
+                return True
+
+def _bestSource(fn, candidates, newMd5s):
+    """
+    Picks which of the old files with the same content as the new file
+    fn to copy from. Files that have been removed from the new tree are
+    preferred (as then the file has been moved), then files with the
+    same name
+    """
+    return min(candidates,
+               key=lambda c: (c in newMd5s,
+                              os.path.basename(c) != os.path.basename(fn),
+                              c))
+
+def _findSimilar(fn, size, removed):
+    """
+    Returns the old file that the new file fn was most likely renamed
+    from, or None if there doesn't look to be one. Only removed old files
+    with the same extension and a size within NEAR_DUPLICATE_SIZE_RATIO of
+    the new file's are considered, preferring those with the same name
+    and then the closest size
+
+    removed - A sorted list of (size, filename) of the removed old files
+    """
+    slack = int(size * NEAR_DUPLICATE_SIZE_RATIO)
+    lo = bisect.bisect_left(removed, (size - slack,))
+    hi = bisect.bisect_left(removed, (size + slack + 1,))
+
+    ext = os.path.splitext(fn)[1]
+    candidates = [(os.path.basename(c) != os.path.basename(fn),
+                   abs(s - size), c)
+                    for s, c in removed[lo:hi]
+                        if os.path.splitext(c)[1] == ext]
+    if not candidates:
+        return None
+    return min(candidates)[2]
+
+def _listDirs(d):
+    """
+    Returns a set of the paths (relative to d) of the directories in d
+    """
+    dirs = set()
+    for root, subdirs, files in os.walk(d):
+        for sd in subdirs:
+            dirs.add(os.path.join(root, sd)[len(d) + len(os.sep):])
+    return dirs
+
+def _sortedDifference(a, b):
+    """
+    Returns the items of the sorted list a that aren't in the sorted list b,
+    walking both lists in step
+    """
+    diff = []
+    i = 0
+    for item in a:
+        while i < len(b) and b[i] < item:
+            i += 1
+        if i == len(b) or b[i] != item:
+            diff.append(item)
+    return diff
+
+def _planDiffArgs(args):
+    return _planDiff(*args)
+
+def _fileCfgs(cfg):
+    """
+    Returns a sorted list of (filename, filecfg) for the files in a patch
+    config, skipping the entries that are not files
+    """
+    return sorted((fn, filecfg) for fn, filecfg in cfg.iteritems()
+                    if fn not in CFG_KEYS)
+
+def _payloadKey(filecfg):
+    """
+    Returns a key for the content a file needs in the patch, which is the
+    same for any files (in any patch) that need the same content
+    """
+    if 'type' not in filecfg:
+        return ('new', filecfg['patchedmd5'])
+    return ('delta', filecfg['oldmd5'], filecfg['patchedmd5'], filecfg['type'])
+
+def _oldPath(oldDir, fn, filecfg):
+    """
+    Returns the path of the old file the file fn is patched against
+    """
+    return os.path.join(oldDir, filecfg.get('src', fn))
+
+def _isUsefulDelta(filecfg, patch, new):
+    """
+    Returns False if the file is patched against a file at another path
+    that turned out to be too different, so that the delta isn't smaller
+    than the new file
+    """
+    if 'src' not in filecfg or filecfg['type'] in NO_PAYLOAD_TYPES:
+        return True
+    return os.path.getsize(patch) < os.path.getsize(new)
+
+def _makeNewFile(filecfg):
+    """
+    Changes the config for a file so that it is a new file
+    """
+    for key in ('type', 'src', 'oldmd5'):
+        filecfg.pop(key, None)
+
+def _payloadMember(fn, filecfg):
+    """
+    Returns the name of the member of the patch zip holding the content for
+    a file, or None if it doesn't need any
+    """
+    patchType = filecfg.get('type')
+    if patchType is None:
+        return os.path.join(NEW_DIR, fn)
+    elif patchType in NO_PAYLOAD_TYPES:
+        return None
+    return os.path.join(PATCH_DIR, fn)
+
+def _chooseCodec(filePath):
+    """
+    Returns the name of the codec (a key of CODECS) a file should be stored
+    in the patch with. Files that samples show don't compress well (such
+    as bsdiff patches, which are already compressed) are stored as they are
+    """
+    size = os.path.getsize(filePath)
+    with open(filePath, 'rb') as f:
+        if size <= CODEC_SAMPLE_SIZE * 3:
+            data = f.read()
+        else:
+            samples = []
+            for offset in (0, (size - CODEC_SAMPLE_SIZE) / 2,
+                           size - CODEC_SAMPLE_SIZE):
+                f.seek(offset)
+                samples.append(f.read(CODEC_SAMPLE_SIZE))
+            data = ''.join(samples)
+    if not data:
+        return 'stored'
+    ratio = len(zlib.compress(data, 1)) / float(len(data))
+    if ratio > CODEC_STORE_RATIO:
+        return 'stored'
+    return 'deflate'
+
+def _writeCfg(d, cfg):
+    cfgOut = os.path.join(d, PATCH_CFG)
     _mkdirs(os.path.dirname(cfgOut))
     with open(cfgOut, 'w') as f:
         f.write(json.dumps(cfg))
-    _zipDir(tmpDir, outputFile)
 
-    assert ( os.path.exists(outputFile) )
-    assert ( os.path.isfile(outputFile) )
+def _genDelta(args):
+    """
+    Generates a delta using the strategy named by the patch type, returning
+    the number of seconds it took (for text, the seconds spent diffing, see
+    _genTextPatch)
 
-    shutil.rmtree(tmpDir)
+    args - A tuple of (type, old, new, patch)
+    """
+    patchType, old, new, patch = args
+    startTime = time.time()
+    if patchType == 'text':
+        return _genTextPatch(old, new, patch)
+    elif patchType == 'zip':
+        _genZipPatch(old, new, patch)
+    elif patchType == 'rsync':
+        _mkdirs(os.path.dirname(patch))
+        rsyncdelta.generate(old, new, patch)
+    else:
+        _genBinPatch(old, new, patch)
+    return time.time() - startTime
 
-def _genTextPatch(old, new, patch):
+def _getCachedDelta(cache, filecfg, patch):
+    """
+    Copies the delta for a file to patch from the cache, returning False if
+    there is no cache or it doesn't hold the delta
+    """
+    if cache is None:
+        return False
+    return cache.get(filecfg['oldmd5'], filecfg['patchedmd5'],
+                     filecfg['type'], patch)
+
+def _cacheDelta(cache, filecfg, patch):
+    if cache is not None:
+        cache.put(filecfg['oldmd5'], filecfg['patchedmd5'],
+                  filecfg['type'], patch)
+
+def _diffWeight(oldSize, newSize):
+    """
+    How much of a time budget diffing a text file should get. This is its
+    size, scaled down when the sizes of the versions are very different as
+    that suggests a rewrite which a better diff won't shrink by much
+    """
+    if not oldSize or not newSize:
+        return 0
+    return (oldSize + newSize) * min(oldSize, newSize) / float(max(oldSize, newSize))
+
+def _genTextPatch(old, new, patch, pool=None, timeout=None):
+    """
+    Generates a diff_match_patch patch. If a pool of worker processes is
+    given then large files are split into regions which are diffed in
+    parallel
+
+    timeout - The number of seconds diffing should take (in total for all
+              regions). If None, diff_match_patch's default is used
+
+    Returns the number of seconds spent diffing, which (like the timeout)
+    doesn't include reading the files or writing the patch
+    """
     oldTxt = _getFileContents(old)
     newTxt = _getFileContents(new)
-    
-    o = diff_match_patch()
-    patchTxt = o.patch_toText(o.patch_make(oldTxt, newTxt))
+
+    startTime = time.time()
+    deadline = None
+    if timeout is not None:
+        deadline = startTime + timeout
+
+    if pool and len(oldTxt) + len(newTxt) >= PARALLEL_DIFF_MIN_SIZE:
+        regions = _splitOnAnchors(oldTxt, newTxt, PARALLEL_DIFF_REGION_SIZE)
+        regions = [r + (deadline,) for r in regions]
+        patchTxt = ''.join(pool.map(_diffRegion, regions))
+    else:
+        patchTxt = _diffRegion((oldTxt, newTxt, 0, deadline))
+    timeTaken = time.time() - startTime
 
     _mkdirs(os.path.dirname(patch))
     f = open(patch, 'w')
     f.write(patchTxt)
     f.close()
+    return timeTaken
+
+def _diffRegion(args):
+    """
+    Creates the patch text for a region of a file. offset is the position
+    of the region in the new file, which is where the region starts once
+    the patches for all earlier regions have been applied. deadline is the
+    time at which diffing gives up (or None for the default timeout)
+    """
+    oldTxt, newTxt, offset, deadline = args
+    o = diff_match_patch()
+    #the same as patch_make(oldTxt, newTxt), but with a deadline
+    diffs = o.diff_main(oldTxt, newTxt, True, deadline)
+    if len(diffs) > 2:
+        o.diff_cleanupSemantic(diffs)
+        o.diff_cleanupEfficiency(diffs)
+    patches = o.patch_make(oldTxt, diffs)
+    for p in patches:
+        p.start1 += offset
+        p.start2 += offset
+    return o.patch_toText(patches)
+
+def _findAnchors(oldLines, newLines):
+    """
+    Finds lines that occur exactly once in both the old and the new lines
+    (as patience diff does) and returns the longest run of them that is in
+    the same order in both, as a list of (oldIndex, newIndex) pairs
+    """
+    counts = {}
+    for i, line in enumerate(oldLines):
+        c = counts.setdefault(line, [0, 0, i])
+        c[0] += 1
+    for i, line in enumerate(newLines):
+        c = counts.get(line)
+        if c:
+            c[1] += 1
+            c.append(i)
+
+    unique = sorted((c[2], c[3]) for c in counts.itervalues()
+                                 if c[0] == 1 and c[1] == 1)
+
+    #longest increasing subsequence of the new indexes, by patience sorting
+    tails = []
+    tailIndexes = []
+    prev = [None]*len(unique)
+    for i, (oldIdx, newIdx) in enumerate(unique):
+        pile = bisect.bisect_left(tails, newIdx)
+        if pile:
+            prev[i] = tailIndexes[pile - 1]
+        if pile == len(tails):
+            tails.append(newIdx)
+            tailIndexes.append(i)
+        else:
+            tails[pile] = newIdx
+            tailIndexes[pile] = i
+
+    anchors = []
+    i = tailIndexes[-1] if tailIndexes else None
+    while i is not None:
+        anchors.append(unique[i])
+        i = prev[i]
+    anchors.reverse()
+    return anchors
+
+def _splitOnAnchors(oldTxt, newTxt, regionSize):
+    """
+    Splits two texts into regions of at least regionSize bytes (of the old
+    text), where each split is just after a line that is unique to both
+    texts. Returns a list of arguments for _diffRegion
+    """
+    oldLines = oldTxt.splitlines(True)
+    newLines = newTxt.splitlines(True)
+
+    regions = []
+    oldStart = newStart = 0 #line indexes
+    oldPos = newPos = 0 #character offsets of the line indexes
+    oldRegionPos = newRegionPos = 0
+    for oldIdx, newIdx in _findAnchors(oldLines, newLines):
+        oldPos += sum(len(l) for l in oldLines[oldStart:oldIdx + 1])
+        newPos += sum(len(l) for l in newLines[newStart:newIdx + 1])
+        oldStart = oldIdx + 1
+        newStart = newIdx + 1
+        if oldPos - oldRegionPos >= regionSize:
+            regions.append((oldTxt[oldRegionPos:oldPos],
+                            newTxt[newRegionPos:newPos],
+                            newRegionPos))
+            oldRegionPos = oldPos
+            newRegionPos = newPos
+    regions.append((oldTxt[oldRegionPos:], newTxt[newRegionPos:], newRegionPos))
+    return regions
 
 def _genBinPatch(old, new, patch):
     assert ( os.path.exists(old) and os.path.isfile(old) )
@@ -330,11 +1868,496 @@ def _genBinPatch(old, new, patch):
         raise DiffError((BSDIFF + ' did not run sucessfully when generating'
                        + ' patches: ' + old + ' ' + new + ' ' + patch))
 
-def _zipDir(srcDir, outputFile):
-    assert os.path.isdir(srcDir)
-    with zipfile.ZipFile(outputFile, "w", zipfile.ZIP_DEFLATED) as z:
-        for root, dirs, files in os.walk(srcDir):
-            for fn in files:
-                absfn = os.path.join(root, fn)
-                zfn = absfn[len(srcDir)+len(os.sep):]
-                z.write(absfn, zfn)
+def _writePatchFile(srcDir, outputFile, compressed=None, codecs=None,
+                    useContainer=False, workers=1):
+    """
+    Writes the patch in srcDir (plus any compressed members, see _zipDir)
+    to outputFile, as a zip or a container
+
+    codecs - A dict mapping member names to the zipfile compression type
+             to use for them. Other members are deflated in a zip, and
+             given the codec _chooseCodec picks in a container
+    workers - The number of processes the members are compressed in. The
+              output is the same whatever the number
+    """
+    members = dict(compressed or {})
+    blobDir = tempfile.mkdtemp()
+    try:
+        members.update(_compressDir(srcDir, blobDir, codecs or {},
+                                    None if useContainer else 'deflate',
+                                    workers))
+        if not useContainer:
+            _zipDir(members, outputFile)
+            return
+
+        #the config first, as it is needed before anything else
+        names = sorted(members, key=lambda zfn: (zfn != PATCH_CFG, zfn))
+        container.write(outputFile,
+                        [(zfn.replace(os.sep, '/'),
+                          members[zfn]['path'],
+                          members[zfn]['codec'],
+                          members[zfn]['size']) for zfn in names])
+    finally:
+        shutil.rmtree(blobDir)
+
+def _compressDir(srcDir, blobDir, codecs, defaultCodec, workers=1):
+    """
+    Compresses the files in srcDir into blobDir (see _compressFile),
+    returning a dict mapping their names to the compressed files
+
+    codecs - A dict mapping names to the zipfile compression type to use
+    defaultCodec - The codec for the files not in codecs, None to pick one
+    workers - The number of processes to compress in
+    """
+    codecNames = dict((v, k) for k, v in CODECS.iteritems())
+    names = []
+    for root, dirs, files in os.walk(srcDir):
+        for fn in files:
+            names.append(os.path.join(root, fn)[len(srcDir)+len(os.sep):])
+    names.sort()
+
+    jobs = [(os.path.join(srcDir, zfn),
+             os.path.join(blobDir, str(i)),
+             codecNames[codecs[zfn]] if zfn in codecs else defaultCodec)
+            for i, zfn in enumerate(names)]
+    if workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            #in order, so the result doesn't depend on which finishes first
+            infos = pool.map(_compressFileArgs, jobs, 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        infos = map(_compressFileArgs, jobs)
+    return dict(zip(names, infos))
+
+def _zipDir(members, outputFile):
+    """
+    Writes the members to the zip outputFile, in order of their names
+
+    members - A dict mapping the names of the members to the compressed
+              files (from _compressFile) holding them
+    """
+    members = sorted(members.iteritems())
+    if (len(members) >= ZIP_MAX_ENTRIES
+            or sum(info['compressedsize'] + ZIP_MAX_HEADER_SIZE
+                   for zfn, info in members) >= zipfile.ZIP64_LIMIT):
+        #zip64 is needed, which _writeZip doesn't write, so the members
+        #are compressed again by zipfile
+        with zipfile.ZipFile(outputFile, 'w', allowZip64=True) as z:
+            for zfn, info in members:
+                z.write(info['src'], zfn, CODECS[info['codec']])
+        return
+    _writeZip(members, outputFile)
+
+def _writePatchArgs(args):
+    """
+    Writes a patch for generateDiffs
+
+    args - A tuple of (cfgDir, outputFile, members, solidPaths, useContainer)
+    """
+    cfgDir, outputFile, members, solidPaths, useContainer = args
+    codecs = {}
+    if solidPaths:
+        _writeSolid(solidPaths, os.path.join(cfgDir, SOLID_BLOCK))
+        codecs[SOLID_BLOCK] = zipfile.ZIP_STORED
+    _writePatchFile(cfgDir, outputFile, members, codecs, useContainer)
+
+def _planSolid(cfg, payloadPath):
+    """
+    Picks the entries of a patch to go in its solid block, which are those
+    no larger than SOLID_MAX_ENTRY_SIZE that are worth compressing (or too
+    small to tell, see SOLID_STORED_MAX_SIZE). Their
+    codec is set to 'solid' and cfg['solid'] is set to the index of the
+    block, a list of [member, offset, length] in the order they are in it.
+    Returns the list of the files to put in the block
+
+    payloadPath - A function returning the file holding a member
+    """
+    index = []
+    paths = []
+    offset = 0
+    for fn, filecfg in _fileCfgs(cfg):
+        member = _payloadMember(fn, filecfg)
+        if member is None:
+            continue
+        path = payloadPath(member)
+        size = os.path.getsize(path)
+        if (size > SOLID_MAX_ENTRY_SIZE
+                or (filecfg['codec'] == 'stored'
+                    and size > SOLID_STORED_MAX_SIZE)):
+            continue
+        filecfg['codec'] = 'solid'
+        index.append([member, offset, size])
+        paths.append(path)
+        offset += size
+    if index:
+        cfg['solid'] = index
+    return paths
+
+def _writeSolid(paths, out):
+    """
+    Writes the solid block holding the files in paths
+    """
+    compressor = bz2.BZ2Compressor()
+    with open(out, 'wb') as fout:
+        for path in paths:
+            with open(path, 'rb') as fin:
+                while True:
+                    data = fin.read(ZIP_CHUNK_SIZE)
+                    if not data:
+                        break
+                    fout.write(compressor.compress(data))
+        fout.write(compressor.flush())
+
+def _compressFile(src, dst, codec=None):
+    """
+    Compresses src into dst the way zipfile does, with the codec picked by
+    _chooseCodec (if codec is None), so it can be written to any number of
+    zips without compressing it again. Files that are stored aren't copied
+    to dst. Returns the details _zipDir needs
+    """
+    st = os.stat(src)
+    if codec is None:
+        codec = _chooseCodec(src)
+    crc = 0
+    if codec == 'stored':
+        with open(src, 'rb') as fin:
+            while True:
+                data = fin.read(ZIP_CHUNK_SIZE)
+                if not data:
+                    break
+                crc = zlib.crc32(data, crc)
+        dst = src
+    else:
+        _mkdirs(os.path.dirname(dst))
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                      zlib.DEFLATED, -15)
+        with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+            while True:
+                data = fin.read(ZIP_CHUNK_SIZE)
+                if not data:
+                    break
+                crc = zlib.crc32(data, crc)
+                fout.write(compressor.compress(data))
+            fout.write(compressor.flush())
+    return {
+        'src' : src,
+        'path' : dst,
+        'codec' : codec,
+        'crc' : crc & 0xffffffff,
+        'size' : st.st_size,
+        'compressedsize' : os.path.getsize(dst),
+        'mtime' : st.st_mtime,
+        'mode' : st.st_mode,
+    }
+
+def _compressFileArgs(args):
+    return _compressFile(*args)
+
+def _dosTime(mtime):
+    """
+    Returns the (time, date) of mtime as they are in a zip
+    """
+    t = time.localtime(mtime)
+    year = max(t.tm_year, 1980)
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+def _writeZip(members, outputFile):
+    """
+    Writes a zip of members that have already been compressed by
+    _compressFile, copying their data rather than compressing it again
+    (which zipfile can't do). The zip is laid out as zipfile lays it out,
+    but without zip64 records, so the zip and its entries must be smaller
+    than zipfile.ZIP64_LIMIT and there must be fewer than ZIP_MAX_ENTRIES
+
+    members - A sorted list of (name, the details from _compressFile)
+    """
+    central = []
+    with open(outputFile, 'wb') as f:
+        for zfn, info in members:
+            name = zfn.replace(os.sep, '/')
+            flags = 0
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+                flags |= ZIP_UTF8_FLAG
+            dosTime, dosDate = _dosTime(info['mtime'])
+            fields = (ZIP_VERSION, flags, CODECS[info['codec']],
+                      dosTime, dosDate, info['crc'], info['compressedsize'],
+                      info['size'], len(name))
+            central.append((fields, (info['mode'] & 0xFFFF) << 16,
+                            f.tell(), name))
+
+            f.write(ZIP_LOCAL_HEADER.pack(ZIP_LOCAL_MAGIC, *(fields + (0,))))
+            f.write(name)
+            with open(info['path'], 'rb') as fin:
+                shutil.copyfileobj(fin, f, ZIP_CHUNK_SIZE)
+
+        centralOffset = f.tell()
+        for fields, externalAttr, offset, name in central:
+            f.write(ZIP_CENTRAL_HEADER.pack(ZIP_CENTRAL_MAGIC,
+                                            ZIP_CREATE_VERSION,
+                                            *(fields + (0, 0, 0, 0,
+                                                        externalAttr,
+                                                        offset))))
+            f.write(name)
+        f.write(ZIP_END.pack(ZIP_END_MAGIC, 0, 0, len(central), len(central),
+                             f.tell() - centralOffset, centralOffset, 0))
+
+#------------------------------------------------------------------------------
+#Compiled python functions
+#
+#Recompiling a module that hasn't changed still changes the timestamp in the
+#header of its .pyc file. Such files are patched by rewriting the header,
+#after checking that the rest of the file (the marshalled code) is the same
+
+def _pycHeaderLength(data):
+    """
+    Returns the length of the header of the .pyc file data, or None if it
+    isn't a .pyc file
+    """
+    if len(data) < 4 or data[2:4] != '\r\n':
+        return None
+    magic = struct.unpack('<H', data[:2])[0]
+    if PYC_FLAGS_MAGIC <= magic < PYC_PY2_MAGIC:
+        length = 16
+    elif PYC_SIZE_MAGIC <= magic < PYC_PY2_MAGIC:
+        length = 12
+    else:
+        length = 8
+    if len(data) < length:
+        return None
+    return length
+
+def _readPycHeader(f):
+    """
+    Reads the header of the .pyc file open as f, leaving f at the start of
+    the body. Returns the header, or None if it isn't a .pyc file
+    """
+    data = f.read(PYC_MAX_HEADER_LENGTH)
+    length = _pycHeaderLength(data)
+    if length is None:
+        return None
+    f.seek(length)
+    return data[:length]
+
+def _getPycBodyMd5(filePath):
+    """
+    Returns the md5 of a .pyc file without its header, or None if it
+    isn't a .pyc file
+    """
+    h = hashlib.md5()
+    with open(filePath, 'rb') as f:
+        if _readPycHeader(f) is None:
+            return None
+        while True:
+            data = f.read(ZIP_CHUNK_SIZE)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+def _planPycHeader(old, new, filecfg):
+    """
+    If old and new are .pyc files that only differ in their headers, makes
+    filecfg a 'pycheader' patch and returns True
+    """
+    if os.path.splitext(new)[1].lower() not in PYC_EXTS:
+        return False
+    h = hashlib.md5()
+    with open(old, 'rb') as oldF, open(new, 'rb') as newF:
+        header = _readPycHeader(newF)
+        oldHeader = _readPycHeader(oldF)
+        if (header is None or oldHeader is None
+                or len(oldHeader) != len(header)):
+            return False
+        while True:
+            oldData = oldF.read(ZIP_CHUNK_SIZE)
+            if oldData != newF.read(ZIP_CHUNK_SIZE):
+                return False
+            if not oldData:
+                break
+            h.update(oldData)
+
+    filecfg['type'] = 'pycheader'
+    filecfg['header'] = header.encode('hex')
+    filecfg['oldbodymd5'] = h.hexdigest()
+    return True
+
+def _patchPycHeader(src, out, header):
+    with open(src, 'rb') as fin:
+        srcHeader = _readPycHeader(fin)
+        if srcHeader is None or len(srcHeader) != len(header):
+            raise PatchError('The file ' + src
+                             + ' has a different header length')
+        _mkdirs(os.path.dirname(out))
+        with open(out, 'wb') as fout:
+            fout.write(header)
+            shutil.copyfileobj(fin, fout, ZIP_CHUNK_SIZE)
+
+#------------------------------------------------------------------------------
+#Zip container functions
+#
+#Zip files (such as the library.zip of a frozen program) are patched member
+#by member, as a small change to the code changes most of the compressed
+#zip. The patch for a zip is itself a zip holding a nested patch (as made by
+#generateDiff) from the old members to the new members and the layout of
+#the new zip, which is what is needed to rebuild it byte for byte from its
+#members. Zips that can't be rebuilt exactly are patched with bsdiff, with
+#the bsdiff patch stored in the zip patch instead
+
+#the names of the members of a zip patch
+ZIP_LAYOUT = 'layout.json'
+ZIP_NESTED_PATCH = 'patch.zip'
+ZIP_BSDIFF_PATCH = 'bsdiff'
+
+#the ZipInfo attributes (other than those that need encoding) stored in the
+#layout of a zip
+ZIP_LAYOUT_ATTRS = ('compress_type', 'create_system', 'create_version',
+                    'extract_version', 'reserved', 'flag_bits', 'volume',
+                    'internal_attr', 'external_attr')
+
+def _isZip(filePath):
+    """
+    Returns true if the file is a zip file. Files with data before the zip
+    (such as self extracting exes) aren't counted
+    """
+    with open(filePath, 'rb') as f:
+        if f.read(4) != 'PK\x03\x04':
+            return False
+    return zipfile.is_zipfile(filePath)
+
+def _zipLayout(filePath):
+    """
+    Returns the layout of a zip, raising a DiffError if the members can't be
+    extracted to a directory without clashing
+    """
+    layout = {
+        'members' : [],
+    }
+    seen = set()
+    with zipfile.ZipFile(filePath) as z:
+        layout['comment'] = z.comment.encode('hex')
+        for info in z.infolist():
+            name = info.filename
+            parts = name.rstrip('/').split('/')
+            if (name.startswith('/') or '..' in parts or '' in parts
+                    or '\\' in name or ':' in name):
+                raise DiffError('The zip member ' + name + ' has an unsafe name')
+            #zip names are case sensitive but some file systems aren't
+            if name.lower() in seen:
+                raise DiffError('The zip has more than one member ' + name)
+            seen.add(name.lower())
+            #_rebuildZip writes each member from memory
+            if info.file_size > MEMORY_CEILING:
+                raise DiffError('The zip member ' + name + ' is too large'
+                                + ' to rebuild')
+
+            member = {
+                'name' : name,
+                'date_time' : info.date_time,
+                'extra' : info.extra.encode('hex'),
+                'comment' : info.comment.encode('hex'),
+            }
+            for attr in ZIP_LAYOUT_ATTRS:
+                member[attr] = getattr(info, attr)
+            layout['members'].append(member)
+    return layout
+
+def _extractZipMembers(filePath, destDir):
+    """
+    Extracts the members of a zip into destDir, keeping their names
+    exactly (unlike ZipFile.extractall)
+    """
+    _mkdirs(destDir)
+    with zipfile.ZipFile(filePath) as z:
+        for info in z.infolist():
+            dst = os.path.join(destDir, *info.filename.rstrip('/').split('/'))
+            if info.filename.endswith('/'):
+                _mkdirs(dst)
+                continue
+            _mkdirs(os.path.dirname(dst))
+            with z.open(info) as fin, open(dst, 'wb') as fout:
+                shutil.copyfileobj(fin, fout, ZIP_CHUNK_SIZE)
+
+def _rebuildZip(membersDir, layout, out):
+    """
+    Builds the zip with the given layout from the members in membersDir
+    """
+    _mkdirs(os.path.dirname(out))
+    with zipfile.ZipFile(out, 'w') as z:
+        for member in layout['members']:
+            name = member['name']
+            info = zipfile.ZipInfo(name, tuple(member['date_time']))
+            for attr in ZIP_LAYOUT_ATTRS:
+                setattr(info, attr, member[attr])
+            info.extra = member['extra'].decode('hex')
+            info.comment = member['comment'].decode('hex')
+            if name.endswith('/'):
+                data = ''
+            else:
+                data = _getFileContents(
+                            os.path.join(membersDir, *name.split('/')), 'rb')
+            z.writestr(info, data)
+        z.comment = layout['comment'].decode('hex')
+
+def _genZipPatch(old, new, patch):
+    """
+    Generates a patch between two zips, diffing their members
+    """
+    assert ( not os.path.exists(patch) )
+    _mkdirs(os.path.dirname(patch))
+
+    tmpDir = tempfile.mkdtemp()
+    try:
+        oldMembers = os.path.join(tmpDir, 'old')
+        newMembers = os.path.join(tmpDir, 'new')
+        rebuilt = os.path.join(tmpDir, 'rebuilt')
+        try:
+            layout = _zipLayout(new)
+            _zipLayout(old)
+            _extractZipMembers(old, oldMembers)
+            _extractZipMembers(new, newMembers)
+            _rebuildZip(newMembers, layout, rebuilt)
+            rebuildable = _getFileMd5(rebuilt) == _getFileMd5(new)
+        except (DiffError, zipfile.BadZipfile, IOError, OSError):
+            rebuildable = False
+
+        with zipfile.ZipFile(patch, 'w', zipfile.ZIP_STORED) as z:
+            if rebuildable:
+                nested = os.path.join(tmpDir, ZIP_NESTED_PATCH)
+                #zips tend to hold lots of small files
+                generateDiff(oldMembers, newMembers, nested, solid=True)
+                z.writestr(ZIP_LAYOUT, json.dumps(layout))
+                z.write(nested, ZIP_NESTED_PATCH)
+            else:
+                bsdiffPatch = os.path.join(tmpDir, ZIP_BSDIFF_PATCH)
+                _genBinPatch(old, new, bsdiffPatch)
+                z.write(bsdiffPatch, ZIP_BSDIFF_PATCH)
+    finally:
+        shutil.rmtree(tmpDir)
+
+def _patchZip(src, out, patch):
+    tmpDir = tempfile.mkdtemp()
+    try:
+        with zipfile.ZipFile(patch) as z:
+            names = z.namelist()
+            if ZIP_BSDIFF_PATCH in names:
+                z.extract(ZIP_BSDIFF_PATCH, tmpDir)
+                _patchBin(src, out, os.path.join(tmpDir, ZIP_BSDIFF_PATCH))
+                return
+            layout = json.loads(z.read(ZIP_LAYOUT))
+            z.extract(ZIP_NESTED_PATCH, tmpDir)
+
+        members = os.path.join(tmpDir, 'members')
+        merged = os.path.join(tmpDir, 'merged')
+        _extractZipMembers(src, members)
+        mergePatches(members, merged, [os.path.join(tmpDir, ZIP_NESTED_PATCH)])
+        applyPatchDirectory(members, merged)
+        _rebuildZip(members, layout, out)
+    except (zipfile.BadZipfile, KeyError, ValueError):
+        raise PatchError('The zip patch ' + patch + ' is corrupt')
+    finally:
+        shutil.rmtree(tmpDir)
@@ -3,11 +3,15 @@ import sys
 import hashlib
 import json
 import shutil
+import urllib
+import urlparse
 from threading import Thread
 import imp #for checking if frozen
 import traceback
 
 import patchdiff
+import patchgraph
+import chunksync
 from partialdl import PartialDownloader
 
 def _jsonFromFile(filePath):
@@ -21,6 +25,9 @@ def _jsonToFile(filePath, j):
     f.write(json.dumps(j))
     f.close()
 
+def _urlToName(url):
+    return hashlib.md5(url).hexdigest()
+
 class Error(Exception):
     pass
 
@@ -110,13 +117,19 @@ class ProgramPatcher:
             self._setBroken()
             raise BrokenError('There was an unknown error')
 
-    def prePatchProgram(self, srcDir, tmpDir, patches):
+    def prePatchProgram(self, srcDir, tmpDir, patches, merger=None):
         """
         This does work that can be done while the program is running
         such as generating the patched files
+
+        merger - A patchdiff.PatchMerger that has already merged some of
+                 the patches (by streaming them while they downloaded)
         """
         try:
-            patchdiff.mergePatches(srcDir, tmpDir, patches)
+            if merger is None:
+                patchdiff.mergePatches(srcDir, tmpDir, patches)
+            else:
+                merger.finish(patches)
         except patchdiff.PatchError:
             raise Error(( 'There was an error encounted generating '
                         + 'patch files'))
@@ -230,6 +243,16 @@ class BackgroundProgramPatcher(ProgramPatcher):
     it downloads the files in the background
     """
     CUR_DOWNLOADS = 'curdl'
+    CUR_MD5S = 'curdlmd5'
+
+    #the number of patches (or shards of a patch) downloaded at once
+    DL_WORKERS = 4
+
+    #the measured speed of the connection is kept in a file next to the
+    #config file (as the config file is removed after patching). Each new
+    #measurement is given this weight against the previous ones
+    NET_STATS_EXT = '.net'
+    NET_STATS_WEIGHT = 0.5
 
     def hasPatchesDownloading(self):
         if os.path.exists(self.cfgPath):
@@ -238,8 +261,71 @@ class BackgroundProgramPatcher(ProgramPatcher):
                     and not self.BROKE in cfg)
         return False
 
+    def downloadAndPrePatchGraph(self, srcDir, tmpDir, patchDest, graph,
+                                 version, targetVersion=None, dlLim=0,
+                                 repairUrl=None, repairManifest=None):
+        """
+        As downloadAndPrePatch, but the patches are picked from a
+        patchgraph.PatchGraph. The patches that should take the least
+        time to download (given the speed previously measured) are used,
+        or the fewest bytes if the speed hasn't been measured yet. The
+        downloaded patches are checked against the md5s in the graph
+
+        version - The version of the program in srcDir
+        targetVersion - The version to patch to, the latest if None
+        repairUrl, repairManifest - As for downloadAndPrePatch
+        """
+        def getPatches(cb):
+            throughput, latency = self._loadNetStats()
+            if throughput is not None and dlLim:
+                throughput = min(throughput, dlLim*1000.0)
+            try:
+                path = graph.shortestPath(version, targetVersion,
+                                          throughput, latency)
+            except patchgraph.PathError as e:
+                raise Error(str(e))
+            cb([p['url'] for p in path],
+               dict((p['url'], p['md5']) for p in path))
+
+        self.downloadAndPrePatch(srcDir, tmpDir, patchDest, getPatches, dlLim,
+                                 repairUrl, repairManifest)
+
+    def _netStatsPath(self):
+        return self.cfgPath + self.NET_STATS_EXT
+
+    def _loadNetStats(self):
+        """
+        Returns the measured (throughput, latency) of the connection. The
+        throughput is None if it has never been measured
+        """
+        try:
+            stats = _jsonFromFile(self._netStatsPath())
+            return stats['throughput'], stats['latency']
+        except (IOError, ValueError, KeyError):
+            return None, 0
+
+    def _saveNetStats(self, dl):
+        throughput = dl.throughput()
+        if throughput is None:
+            return
+        latency = dl.latency() or 0
+
+        oldThroughput, oldLatency = self._loadNetStats()
+        if oldThroughput is not None:
+            w = self.NET_STATS_WEIGHT
+            throughput = w*throughput + (1-w)*oldThroughput
+            latency = w*latency + (1-w)*oldLatency
+        try:
+            _jsonToFile(self._netStatsPath(), {
+                'throughput' : throughput,
+                'latency' : latency,
+            })
+        except IOError:
+            pass
+
     def downloadAndPrePatch(self, srcDir, tmpDir,  patchDest,
-                                  getPatchesFunc, dlLim=0):
+                                  getPatchesFunc, dlLim=0,
+                                  repairUrl=None, repairManifest=None):
         """
         This downloads patches and does the basic work that can be done while
         the program is running (i.e. doesn't require any files to be replaced)
@@ -251,6 +337,18 @@ class BackgroundProgramPatcher(ProgramPatcher):
         getPatchesFunc - This funciton should get a list of patch urls, in the
                          order they should be applied. This function should
                          call the function passed to it as its first argument
+                         with the list of urls, and optionally a dict mapping
+                         the urls to the md5s of the patches. A url ending
+                         with patchdiff.SHARD_INDEX_EXT is a shard index, and
+                         the shards it lists are downloaded instead
+        repairUrl - The url of a copy of the files of srcDir's version. If
+                    given, files in srcDir that the patches can't be applied
+                    to (as they are missing or have been changed) are
+                    fetched from repairUrl + their path rather than the
+                    patching failing
+        repairManifest - The url of a chunksync manifest of srcDir's
+                         version, in which case only the blocks of those
+                         files that differ are fetched
         """
         if self.isBroken():
             raise Error('Cannot download patchs if broken')
@@ -267,30 +365,90 @@ class BackgroundProgramPatcher(ProgramPatcher):
             os.makedirs(patchDest)
 
 
+        repair = None
+        if repairUrl is not None:
+            repair = self._repairer(srcDir, patchDest, repairUrl,
+                                    repairManifest, dlLim)
+
         #hack for partial function application
-        cb = lambda files: self._downloadPrePatch(srcDir,
-                                                  tmpDir,
-                                                  patchDest,
-                                                  files,
-                                                  dlLim)
+        cb = lambda files, md5s=None: self._downloadPrePatch(srcDir,
+                                                             tmpDir,
+                                                             patchDest,
+                                                             files,
+                                                             dlLim,
+                                                             md5s,
+                                                             repair)
         if os.path.exists(self.cfgPath):
             cfg = _jsonFromFile(self.cfgPath)
             if self.CUR_DOWNLOADS in cfg:
-                cb(cfg[self.CUR_DOWNLOADS])
+                cb(cfg[self.CUR_DOWNLOADS], cfg.get(self.CUR_MD5S))
             else:
                 getPatchesFunc(cb)
         else:
             getPatchesFunc(cb)
 
-    def _downloadPrePatch(self, srcDir, tmpDir, patchDest, files, limit):
+    def _repairer(self, srcDir, patchDest, baseUrl, manifestUrl, limit):
+        """
+        Returns a function for patchdiff.PatchMerger to repair files with
+        (see downloadAndPrePatch)
+        """
+        def repair(fns, destDir):
+            if manifestUrl is not None:
+                manifestFile = os.path.join(patchDest, _urlToName(manifestUrl))
+                try:
+                    self._download([(manifestUrl, manifestFile)], limit)
+                    manifest = chunksync.readManifest(manifestFile)
+                    os.remove(manifestFile)
+                    synced = [fn for fn in fns
+                                if fn.replace(os.sep, '/') in manifest['files']]
+                    chunksync.repair(srcDir, manifest, synced, destDir,
+                                     baseUrl)
+                    fns = [fn for fn in fns if fn not in synced]
+                except (chunksync.SyncError, EnvironmentError):
+                    pass
+            self._download([(baseUrl + urllib.quote(fn.replace(os.sep, '/')),
+                             os.path.join(destDir, fn)) for fn in fns], limit)
+        return repair
+
+    def _download(self, files, limit):
+        """
+        Downloads the (url, path) in files, waiting until they have finished
+        """
+        dl = PartialDownloader()
+        for url, dst in files:
+            patchdiff._mkdirs(os.path.dirname(dst))
+            if os.path.exists(dst):
+                os.remove(dst)
+            dl.add(url, dst)
+        dl.startDownload(limit, None, self.DL_WORKERS)
+        dl.join()
+
+    def _downloadPrePatch(self, srcDir, tmpDir, patchDest, files, limit,
+                          md5s=None, repair=None):
         if not files:
             return
 
         cfg = _jsonFromFile(self.cfgPath)
         cfg[self.CUR_DOWNLOADS] = files
+        if md5s:
+            cfg[self.CUR_MD5S] = md5s
         _jsonToFile(self.cfgPath, cfg)
 
-        urlToName = lambda x: hashlib.md5(x).hexdigest() 
+        if any(not isinstance(p, list)
+               and p.endswith(patchdiff.SHARD_INDEX_EXT) for p in files):
+            self._downloadShardIndexes(srcDir, tmpDir, patchDest, files,
+                                       limit, md5s, repair)
+            return
+
+        #the shards of a patch are given as a list of their urls, and are
+        #merged in whatever order they arrive
+        patches = []
+        for i, p in enumerate(files):
+            if isinstance(p, list):
+                patches.extend((shard, i) for shard in p)
+            else:
+                patches.append((p, None))
+
         def prePatch(dlFiles):
             """
             This is run in another another thread (the download thread) 
@@ -301,18 +459,91 @@ class BackgroundProgramPatcher(ProgramPatcher):
             be all the files as if another program is downloading some of them
             they won't be downloaded by this process. Hence it is required
             to check if the files exist 
+
+            A patch that doesn't match its md5 is removed, so that it is
+            downloaded again the next time
+
+            Patches that were streamed as they downloaded have already been
+            merged (and hashed) so aren't read again
             """
+            self._saveNetStats(dl)
+
             patchFiles = []
-            for p in files:
-                f = os.path.join(patchDest, urlToName(p))
+            for p, group in patches:
+                f = os.path.join(patchDest, _urlToName(p))
                 if not os.path.exists(f):
                     return
+                if md5s and p in md5s and downloadedMd5(p, f) != md5s[p]:
+                    os.remove(f)
+                    return
                 patchFiles.append(f)
 
-            self.prePatchProgram(srcDir, tmpDir, patchFiles)
+            self.prePatchProgram(srcDir, tmpDir, patchFiles, merger)
+
+        #each patch is hashed and merged as it downloads
+        merger = patchdiff.PatchMerger(srcDir, tmpDir, repair)
+        digests = {}
+        def receiver(p, group):
+            stream = merger.stream(group)
+            digest = digests[p] = [hashlib.md5(), 0]
+            def onData(data):
+                digest[0].update(data)
+                digest[1] += len(data)
+                stream.feed(data)
+            return onData
+
+        def downloadedMd5(p, f):
+            if p in digests and digests[p][1] == os.path.getsize(f):
+                return digests[p][0].hexdigest()
+            #downloaded before or by another process
+            return patchdiff._getFileMd5(f)
+
+        #setup downloader and download all required files. Those that
+        #finished downloading before aren't downloaded again
+        dl = PartialDownloader()
+        for update, group in patches:
+            onData = receiver(update, group)
+            dst = os.path.join(patchDest, _urlToName(update))
+            if not os.path.exists(dst):
+                dl.add(update, dst, onData=onData)
+        dl.startDownload(limit, prePatch, self.DL_WORKERS)
+
+    def _downloadShardIndexes(self, srcDir, tmpDir, patchDest, files, limit,
+                              md5s=None, repair=None):
+        """
+        Downloads the shard indexes in files, then downloads the patches
+        with each index replaced by the list of its shards
+        """
+        md5s = dict(md5s or {})
+        indexes = [p for p in files if not isinstance(p, list)
+                                       and p.endswith(patchdiff.SHARD_INDEX_EXT)]
+        def expand(dlFiles):
+            expanded = []
+            for p in files:
+                if p not in indexes:
+                    expanded.append(p)
+                    continue
+                f = os.path.join(patchDest, _urlToName(p))
+                if not os.path.exists(f):
+                    return
+                try:
+                    if p in md5s and patchdiff._getFileMd5(f) != md5s[p]:
+                        raise patchdiff.PatchError('The index is corrupt')
+                    shards = patchdiff.readShardIndex(f)
+                except patchdiff.PatchError:
+                    os.remove(f)
+                    return
+                urls = [urlparse.urljoin(p, shard['file']) for shard in shards]
+                for url, shard in zip(urls, shards):
+                    md5s[url] = shard['md5']
+                expanded.append(urls)
+
+            for p in indexes:
+                os.remove(os.path.join(patchDest, _urlToName(p)))
+            self._downloadPrePatch(srcDir, tmpDir, patchDest, expanded, limit,
+                                   md5s, repair)
 
-        #setup downloader and download all required files
         dl = PartialDownloader()
-        for update in files:
-            dl.add(update, os.path.join(patchDest, urlToName(update)))
-        dl.startDownload(limit, prePatch)
+        for p in indexes:
+            dl.add(p, os.path.join(patchDest, _urlToName(p)))
+        dl.startDownload(limit, expand)
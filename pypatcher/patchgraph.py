@@ -0,0 +1,142 @@
+"""
+This module describes the patches available for a program as a graph
+of versions, and picks which patches a client should download.
+
+The manifest is a json file listing the versions and the patches between
+them. Each patch is an edge from the version it applies to, to the version
+it produces, so a server can publish a chain of incremental patches along
+with cumulative patches that skip several versions:
+
+    {
+        "latest" : "1.2",
+        "versions" : ["1.0", "1.1", "1.2"],
+        "patches" : [
+            {"from" : "1.0", "to" : "1.1", "url" : "http://...",
+             "size" : 1024, "md5" : "..."},
+            {"from" : "1.1", "to" : "1.2", ...},
+            {"from" : "1.0", "to" : "1.2", ...}
+        ]
+    }
+
+The resolver finds the path from the client's version to the target
+version that downloads the fewest bytes or, given the measured throughput
+(and latency) of the client's connection, that should take the least time.
+"""
+
+import json
+import heapq
+
+class PathError(Exception):
+    """
+    Raised when there is no way to patch between two versions
+    """
+    pass
+
+class ManifestError(Exception):
+    pass
+
+class PatchGraph:
+    """
+    A graph of the versions of a program, with the patches as edges
+    """
+    PATCH_KEYS = ('from', 'to', 'url', 'size', 'md5')
+
+    def __init__(self, manifest):
+        """
+        manifest - The manifest as a dict (see the module docs)
+        """
+        self.latest = manifest.get('latest')
+        self.edges = {}
+        for version in manifest.get('versions', []):
+            self.edges.setdefault(version, [])
+
+        for patch in manifest.get('patches', []):
+            for key in self.PATCH_KEYS:
+                if key not in patch:
+                    raise ManifestError('A patch is missing the key ' + key)
+            if patch['from'] == patch['to']:
+                raise ManifestError(('The patch ' + patch['url']
+                                   + ' goes from a version to itself'))
+            self.edges.setdefault(patch['from'], []).append(patch)
+            self.edges.setdefault(patch['to'], [])
+
+        if self.latest is not None and self.latest not in self.edges:
+            raise ManifestError('The latest version isn\'t in the manifest')
+
+    @classmethod
+    def fromFile(cls, filePath):
+        with open(filePath) as f:
+            return cls.fromJson(f.read())
+
+    @classmethod
+    def fromJson(cls, text):
+        try:
+            return cls(json.loads(text))
+        except ValueError:
+            raise ManifestError('The manifest isn\'t valid json')
+
+    def versions(self):
+        return sorted(self.edges)
+
+    def patchesFrom(self, version):
+        """
+        Returns the patches that can be applied to version
+        """
+        return list(self.edges.get(version, []))
+
+    def shortestPath(self, version, targetVersion=None,
+                     throughput=None, latency=0):
+        """
+        Returns the list of patches (in the order they should be applied) that
+        take version to targetVersion (the latest version if None) for the
+        least cost. Ties are broken by the number of patches
+
+        throughput - The expected download speed in bytes/second. If None the
+                     cost of a patch is its size, otherwise it is the
+                     expected time taken to download it
+        latency - The expected time (in seconds) it takes to start each
+                  download. Only used if throughput is given
+        """
+        if targetVersion is None:
+            targetVersion = self.latest
+        if version not in self.edges:
+            raise PathError('The version ' + str(version) + ' is unknown')
+        if targetVersion not in self.edges:
+            raise PathError('The version ' + str(targetVersion)
+                          + ' is unknown')
+
+        #dijkstra, with the cost as a (cost, patch count) tuple
+        best = {version : (0, 0)}
+        prev = {}
+        heap = [(0, 0, version)]
+        while heap:
+            cost, hops, v = heapq.heappop(heap)
+            if v == targetVersion:
+                break
+            if (cost, hops) > best[v]:
+                continue
+            for patch in self.edges[v]:
+                nextCost = (cost + self._cost(patch, throughput, latency),
+                            hops + 1)
+                to = patch['to']
+                if to not in best or nextCost < best[to]:
+                    best[to] = nextCost
+                    prev[to] = patch
+                    heapq.heappush(heap, (nextCost[0], nextCost[1], to))
+
+        if targetVersion not in best:
+            raise PathError(('There are no patches from ' + str(version)
+                           + ' to ' + str(targetVersion)))
+
+        path = []
+        v = targetVersion
+        while v != version:
+            path.append(prev[v])
+            v = prev[v]['from']
+        path.reverse()
+        return path
+
+    def _cost(self, patch, throughput, latency):
+        if throughput is None:
+            return patch['size']
+        return latency + patch['size'] / float(throughput)
@@ -0,0 +1,223 @@
+"""
+Rolling checksum (rsync style) deltas between binary files.
+
+Unlike bsdiff, which needs memory many times the size of the files, the
+memory used to generate or apply a delta doesn't depend on the size of the
+files (beyond the signatures of the old file, of which there are at most
+MAX_BLOCKS). The old file is split into blocks, which are indexed by their
+adler32 and md5. The new file is then scanned with a window the size of
+a block, the adler32 of which is rolled along a byte at a time, and any
+window that matches a block is sent as a reference to the block rather
+than as data.
+
+The delta is
+
+    header - MAGIC, the block size (uint32) and the size of the new file
+             (uint64)
+    ops - Each either OP_COPY, the offset (uint64) and length (uint64) of
+          data to copy from the old file, or OP_DATA, the length (uint32)
+          of the data that follows. The last is OP_END
+"""
+
+import os
+import struct
+import hashlib
+import zlib
+
+MAGIC = 'PYRSYNC1'
+HEADER = struct.Struct('<8sIQ')
+
+OP_COPY = 'C'
+OP_DATA = 'D'
+OP_END = 'E'
+COPY = struct.Struct('<QQ')
+DATA = struct.Struct('<I')
+
+#the blocks are at least this size (in bytes), but large enough that there
+#are no more than MAX_BLOCKS of them
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCKS = 64*1024
+
+#the size of the blocks (in bytes) files are read and written in
+CHUNK_SIZE = 1024*1024
+
+#adler32 is modulo this
+ADLER_MOD = 65521
+
+class DeltaError(Exception):
+    """
+    Raised when a delta is corrupt or doesn't apply to a file
+    """
+    pass
+
+def blockSize(oldSize):
+    """
+    Returns the size of the blocks the old file is split into
+    """
+    return max(MIN_BLOCK_SIZE, -(-oldSize // MAX_BLOCKS))
+
+def blockDigests(filePath, size):
+    """
+    Yields the (adler32, md5 digest) of each whole block of the file
+    """
+    with open(filePath, 'rb') as f:
+        while True:
+            block = f.read(size)
+            if len(block) < size:
+                break
+            yield zlib.adler32(block) & 0xffffffff, hashlib.md5(block).digest()
+
+def _signatures(old, size):
+    """
+    Returns a dict mapping the adler32 of each whole block in the file old
+    to a dict mapping the md5s of the blocks with it to their offsets
+    """
+    signatures = {}
+    for i, (weak, strong) in enumerate(blockDigests(old, size)):
+        signatures.setdefault(weak, {}).setdefault(strong, i * size)
+    return signatures
+
+def scan(filePath, size, signatures):
+    """
+    Scans the file for windows that match blocks, yielding (data, match)
+    where data is the data since the last match (or the start) and match is
+    the value of the block the window after it matches. The last has a match
+    of None and the rest of the file as its data. The data is yielded in
+    parts no larger than CHUNK_SIZE (or twice size), with a match of None
+
+    signatures - A dict mapping the adler32s of the blocks to dicts mapping
+                 their md5 digests to their values (see _signatures)
+    """
+    chunkSize = max(CHUNK_SIZE, 2*size)
+    with open(filePath, 'rb') as f:
+        buf = ''
+        pos = 0
+        literalStart = 0
+        weak = None
+        eof = False
+        while True:
+            #the byte after the window is needed to roll it along
+            if len(buf) - pos <= size and not eof:
+                if pos > literalStart:
+                    yield buf[literalStart:pos], None
+                data = f.read(chunkSize)
+                eof = not data
+                buf = buf[pos:] + data
+                pos = literalStart = 0
+                continue
+            if len(buf) - pos < size:
+                break
+
+            if weak is None:
+                weak = zlib.adler32(buffer(buf, pos, size)) & 0xffffffff
+                a = weak & 0xffff
+                b = weak >> 16
+            if weak in signatures:
+                match = signatures[weak].get(
+                            hashlib.md5(buffer(buf, pos, size)).digest())
+                if match is not None:
+                    yield buf[literalStart:pos], match
+                    pos += size
+                    literalStart = pos
+                    weak = None
+                    continue
+
+            if len(buf) - pos == size:
+                break
+            out = ord(buf[pos])
+            a = (a - out + ord(buf[pos + size])) % ADLER_MOD
+            b = (b - size*out + a - 1) % ADLER_MOD
+            weak = (b << 16) | a
+            pos += 1
+
+        yield buf[literalStart:], None
+
+class _DeltaWriter:
+    """
+    Writes the ops of a delta, joining copies of consecutive blocks
+    """
+    def __init__(self, f):
+        self.f = f
+        self.copy = None
+
+    def copyOld(self, offset, length):
+        if self.copy is not None and sum(self.copy) == offset:
+            self.copy[1] += length
+            return
+        self._flushCopy()
+        self.copy = [offset, length]
+
+    def data(self, data):
+        if not data:
+            return
+        self._flushCopy()
+        self.f.write(OP_DATA + DATA.pack(len(data)))
+        self.f.write(data)
+
+    def end(self):
+        self._flushCopy()
+        self.f.write(OP_END)
+
+    def _flushCopy(self):
+        if self.copy is not None:
+            self.f.write(OP_COPY + COPY.pack(*self.copy))
+            self.copy = None
+
+def generate(old, new, delta, size=None):
+    """
+    Writes the delta that turns the file old into the file new to delta
+
+    size - The block size, picked from the size of old if None
+    """
+    if size is None:
+        size = blockSize(os.path.getsize(old))
+    signatures = _signatures(old, size)
+
+    with open(delta, 'wb') as fout:
+        fout.write(HEADER.pack(MAGIC, size, os.path.getsize(new)))
+        writer = _DeltaWriter(fout)
+        for data, offset in scan(new, size, signatures):
+            writer.data(data)
+            if offset is not None:
+                writer.copyOld(offset, size)
+        writer.end()
+
+def _copy(fin, fout, length):
+    while length:
+        data = fin.read(min(length, CHUNK_SIZE))
+        if not data:
+            raise DeltaError('The delta or old file is too short')
+        fout.write(data)
+        length -= len(data)
+
+def _read(f, length):
+    data = f.read(length)
+    if len(data) < length:
+        raise DeltaError('The delta is too short')
+    return data
+
+def patch(old, out, delta):
+    """
+    Applies the delta to the file old, writing the result to out
+    """
+    with open(delta, 'rb') as fdelta, open(old, 'rb') as fold:
+        magic, size, newSize = HEADER.unpack(_read(fdelta, HEADER.size))
+        if magic != MAGIC:
+            raise DeltaError(delta + ' isn\'t a delta')
+
+        with open(out, 'wb') as fout:
+            while True:
+                op = _read(fdelta, 1)
+                if op == OP_END:
+                    break
+                elif op == OP_COPY:
+                    offset, length = COPY.unpack(_read(fdelta, COPY.size))
+                    fold.seek(offset)
+                    _copy(fold, fout, length)
+                elif op == OP_DATA:
+                    length, = DATA.unpack(_read(fdelta, DATA.size))
+                    _copy(fdelta, fout, length)
+                else:
+                    raise DeltaError('The delta has an unknown op')
+            if fout.tell() != newSize:
+                raise DeltaError('The delta made a file of the wrong size')
@@ -0,0 +1,149 @@
+import os
+import shutil
+import random
+import urllib
+import unittest
+import tempfile
+import StringIO
+
+from .. import chunksync
+from .. import patchdiff
+
+class TestSimple(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp()
+        self.rand = random.Random(0)
+        self.old = os.path.join(self.wd, 'old')
+        self.new = os.path.join(self.wd, 'new')
+        self.out = os.path.join(self.wd, 'out')
+        self.manifest = os.path.join(self.wd, 'manifest.json')
+        self.fetched = []
+
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+
+    def _random(self, length):
+        return ''.join(chr(self.rand.randint(0, 255)) for i in xrange(length))
+
+    def _writeTree(self, d, files):
+        for fn, data in files.iteritems():
+            path = os.path.join(d, fn)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(data)
+
+    def _readTree(self, d):
+        files = {}
+        for fn in patchdiff._fileSizes(d):
+            with open(os.path.join(d, fn), 'rb') as f:
+                files[fn] = f.read()
+        return files
+
+    def _fetch(self, url, start, length):
+        """
+        Reads from the new tree rather than a server
+        """
+        self.fetched.append((url, start, length))
+        fn = urllib.unquote(url[len('http://example.com/'):])
+        with open(os.path.join(self.new, fn), 'rb') as f:
+            f.seek(start)
+            return StringIO.StringIO(f.read(length))
+
+    def _sync(self, unrelated={}):
+        """
+        Syncs the old tree to the new one, with the files in unrelated
+        (which aren't in either release) added to the old tree
+        """
+        oldManifest = os.path.join(self.wd, 'old.json')
+        chunksync.generateManifest(self.old, oldManifest, 512)
+        chunksync.generateManifest(self.new, self.manifest, 512)
+        self._writeTree(self.old, unrelated)
+        report = chunksync.sync(self.old,
+                                chunksync.readManifest(self.manifest),
+                                self.out, 'http://example.com/', self._fetch,
+                                chunksync.readManifest(oldManifest))
+        patchdiff.applyPatchDirectory(self.old, self.out)
+        expected = self._readTree(self.new)
+        expected.update(self._readTree(os.path.join(self.wd, 'unrelated'))
+                        if unrelated else {})
+        self.assertEqual(self._readTree(self.old), expected)
+        return report
+
+    def testSync(self):
+        """
+        Tests that only the changed bytes are fetched, including those of
+        a file that was moved and edited
+        """
+        big = self._random(64*1024)
+        moved = self._random(16*1024)
+        self._writeTree(self.old, {
+            'same' : 'unchanged',
+            'big' : big,
+            'a/moved' : moved,
+            'removed' : 'removed',
+        })
+        self._writeTree(self.new, {
+            'same' : 'unchanged',
+            'big' : big[:1000] + 'inserted' + big[1000:40000] + big[41000:],
+            'b/moved file' : moved[:8000] + self._random(10) + moved[8000:],
+            'new' : 'new',
+        })
+        report = self._sync()
+        self.assertTrue(report['fetched'] < 4000)
+        self.assertTrue(report['reused'] > 70*1024)
+        self.assertFalse(os.path.exists(os.path.join(self.old, 'a')))
+
+    def testUnrelatedFiles(self):
+        """
+        Tests that local files that aren't in the old release are kept
+        """
+        self._writeTree(self.old, {'file' : 'old', 'removed' : 'removed'})
+        self._writeTree(self.new, {'file' : 'new'})
+        unrelated = {
+            'patch.cfg' : '{}',
+            os.path.join('dlpatches', 'patch') : 'a patch',
+        }
+        self._writeTree(os.path.join(self.wd, 'unrelated'), unrelated)
+        self._sync(unrelated)
+        self.assertFalse(os.path.exists(os.path.join(self.old, 'removed')))
+
+    def testRepair(self):
+        """
+        Tests that only the damaged blocks of a file are fetched
+        """
+        data = self._random(16*1024)
+        self._writeTree(self.new, {'file' : data, 'other' : 'other'})
+        self._writeTree(self.old, {'file' : data[:5000] + 'damaged'
+                                            + data[5007:]})
+        chunksync.generateManifest(self.new, self.manifest, 512)
+        manifest = chunksync.readManifest(self.manifest)
+        report = chunksync.repair(self.old, manifest, ['file', 'missing'],
+                                  self.out, 'http://example.com/',
+                                  self._fetch)
+        self.assertEqual(report['fetched'], 512)
+        with open(os.path.join(self.out, 'file'), 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(os.listdir(self.out), ['file'])
+
+    def testCorrupt(self):
+        self._writeTree(self.old, {'file' : 'old'})
+        self._writeTree(self.new, {'file' : self._random(4096)})
+        chunksync.generateManifest(self.new, self.manifest, 512)
+        manifest = chunksync.readManifest(self.manifest)
+        fetch = lambda url, start, length: StringIO.StringIO('x' * length)
+        self.assertRaises(chunksync.SyncError, chunksync.sync,
+                          self.old, manifest, self.out,
+                          'http://example.com/', fetch)
+
+    def testBadManifest(self):
+        with open(self.manifest, 'w') as f:
+            f.write('{"version" : 1, "blocksize" : 512, "dirs" : [],'
+                    ' "files" : {"../x" : {"size" : 0, "md5" : "",'
+                    ' "blocks" : []}}}')
+        self.assertRaises(chunksync.SyncError,
+                          chunksync.readManifest, self.manifest)
+
+if __name__ == '__main__':
+    unittest.main()
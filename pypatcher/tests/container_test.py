@@ -0,0 +1,135 @@
+import os
+import bz2
+import zlib
+import shutil
+import unittest
+import tempfile
+
+from .. import container
+
+class TestSimple(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp()
+        self.fn = os.path.join(self.wd, 'test.container')
+
+        self.data = {
+            'stored' : 'some stored text',
+            'dir/deflated' : 'some deflated text ' * 100,
+            'dir/sub/bzipped' : 'some bzipped text ' * 100,
+            'empty' : '',
+        }
+        deflater = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                    zlib.DEFLATED, -15)
+        payloads = [
+            ('stored', 'stored', self.data['stored']),
+            ('dir/deflated', 'deflate',
+                deflater.compress(self.data['dir/deflated'])
+                + deflater.flush()),
+            ('dir/sub/bzipped', 'bz2', bz2.compress(self.data['dir/sub/bzipped'])),
+            ('empty', 'stored', ''),
+        ]
+        entries = []
+        for i, (name, codec, payload) in enumerate(payloads):
+            path = os.path.join(self.wd, str(i))
+            with open(path, 'wb') as f:
+                f.write(payload)
+            entries.append((name, path, codec, len(self.data[name])))
+        container.write(self.fn, entries)
+
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+
+    def testRead(self):
+        self.assertTrue(container.isContainer(self.fn))
+        with container.ContainerReader(self.fn) as reader:
+            self.assertEqual(reader.names(), ['stored', 'dir/deflated',
+                                              'dir/sub/bzipped', 'empty'])
+            for name, data in self.data.iteritems():
+                self.assertEqual(reader.read(name), data)
+                reader.verify(name)
+            for entry in reader.entries:
+                self.assertEqual(entry['offset'] % container.PAGE_SIZE, 0)
+
+    def testExtract(self):
+        out = os.path.join(self.wd, 'out')
+        with container.ContainerReader(self.fn) as reader:
+            reader.extractAll(out)
+        for name, data in self.data.iteritems():
+            with open(os.path.join(out, *name.split('/')), 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+    def testCorrupt(self):
+        """
+        Tests that a corrupt entry is detected without affecting the others
+        """
+        with container.ContainerReader(self.fn) as reader:
+            offset = reader.index['dir/deflated']['offset']
+        with open(self.fn, 'r+b') as f:
+            f.seek(offset + 3)
+            byte = f.read(1)
+            f.seek(offset + 3)
+            f.write(chr(ord(byte) ^ 0xff))
+
+        out = os.path.join(self.wd, 'out')
+        with container.ContainerReader(self.fn) as reader:
+            self.assertRaises(container.ContainerError,
+                              reader.verify, 'dir/deflated')
+            self.assertRaises(container.ContainerError,
+                              reader.extract, 'dir/deflated', out)
+            self.assertFalse(os.path.exists(os.path.join(out, 'dir',
+                                                         'deflated')))
+            self.assertEqual(reader.read('dir/sub/bzipped'),
+                             self.data['dir/sub/bzipped'])
+
+    def testStream(self):
+        """
+        Tests that entries are extracted as soon as they have arrived
+        """
+        with open(self.fn, 'rb') as f:
+            data = f.read()
+        with container.ContainerReader(self.fn) as reader:
+            ends = dict((e['name'], e['offset'] + e['length'])
+                        for e in reader.entries)
+
+        out = os.path.join(self.wd, 'out')
+        fed = [0]
+        extracted = []
+        def onEntry(name, path):
+            self.assertTrue(fed[0] >= ends[name])
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), self.data[name])
+            extracted.append(name)
+
+        stream = container.StreamReader(out, onEntry)
+        for i in xrange(0, len(data), 1000):
+            fed[0] = min(i + 1000, len(data))
+            stream.feed(data[i:i + 1000])
+            self.assertEqual(stream.done(), fed[0] == len(data))
+        self.assertEqual(extracted, ['stored', 'dir/deflated',
+                                     'dir/sub/bzipped', 'empty'])
+
+    def testStreamCorrupt(self):
+        with container.ContainerReader(self.fn) as reader:
+            offset = reader.index['dir/deflated']['offset']
+        with open(self.fn, 'rb') as f:
+            data = f.read()
+        data = data[:offset] + chr(ord(data[offset]) ^ 0xff) + data[offset+1:]
+
+        extracted = []
+        stream = container.StreamReader(os.path.join(self.wd, 'out'),
+                                        lambda name, path: extracted.append(name))
+        self.assertRaises(container.ContainerError, stream.feed, data)
+        stream.close()
+        self.assertEqual(extracted, ['stored'])
+
+    def testNotContainer(self):
+        fn = os.path.join(self.wd, 'other')
+        with open(fn, 'wb') as f:
+            f.write('PK\x03\x04 not a container at all')
+        self.assertFalse(container.isContainer(fn))
+        self.assertRaises(container.ContainerError,
+                          container.ContainerReader, fn)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import os
+import shutil
+import unittest
+import tempfile
+import filecmp
+
+from .. import deltacache
+from .. import patchdiff
+
+class TestSimple(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp()
+        self.cacheDir = os.path.join(self.wd, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+
+    def _write(self, fn, contents):
+        with open(fn, 'w') as f:
+            f.write(contents)
+
+    def testGetPut(self):
+        cache = deltacache.DeltaCache(self.cacheDir)
+        src = os.path.join(self.wd, 'delta')
+        dst = os.path.join(self.wd, 'out', 'delta')
+        self._write(src, 'delta')
+
+        self.assertFalse(cache.get('a', 'b', 'text', dst))
+        cache.put('a', 'b', 'text', src)
+        self.assertFalse(cache.get('a', 'b', 'bsdiff', dst))
+        self.assertTrue(cache.get('a', 'b', 'text', dst))
+        self.assertTrue(filecmp.cmp(src, dst, False))
+
+        #persists between instances
+        cache.close()
+        cache = deltacache.DeltaCache(self.cacheDir)
+        self.assertTrue(cache.get('a', 'b', 'text', dst))
+
+    def testEviction(self):
+        """
+        Tests that the least recently used deltas are evicted when
+        the cache is full
+        """
+        cache = deltacache.DeltaCache(self.cacheDir, maxSize=25)
+        src = os.path.join(self.wd, 'delta')
+        dst = os.path.join(self.wd, 'out')
+        self._write(src, '0123456789')
+
+        cache.put('1', '1', 'text', src)
+        cache.put('2', '2', 'text', src)
+        cache.get('1', '1', 'text', dst)
+        cache.put('3', '3', 'text', src)
+
+        self.assertTrue(cache.size() <= 25)
+        self.assertTrue(cache.get('1', '1', 'text', dst))
+        self.assertFalse(cache.get('2', '2', 'text', dst))
+        self.assertTrue(cache.get('3', '3', 'text', dst))
+
+    def testGenerateDiff(self):
+        """
+        Tests that generateDiff reuses cached deltas
+        """
+        orig = os.path.join(self.wd, 'orig')
+        new = os.path.join(self.wd, 'new')
+        os.makedirs(orig)
+        os.makedirs(new)
+        self._write(os.path.join(orig, 'patched.file'), 'some text')
+        self._write(os.path.join(new, 'patched.file'), 'some more text')
+
+        cache = deltacache.DeltaCache(self.cacheDir)
+        patchdiff.generateDiff(orig, new, os.path.join(self.wd, 'p1'),
+                               cache=cache)
+
+        genTextPatch = patchdiff._genTextPatch
+        def failGen(*args):
+            self.fail('The delta should have come from the cache')
+        patchdiff._genTextPatch = failGen
+        try:
+            patchdiff.generateDiff(orig, new, os.path.join(self.wd, 'p2'),
+                                   cache=cache)
+        finally:
+            patchdiff._genTextPatch = genTextPatch
+
+        temp = os.path.join(self.wd, 'temp')
+        patchdiff.mergePatches(orig, temp, [os.path.join(self.wd, 'p2')])
+        patchdiff.applyPatchDirectory(orig, temp)
+        self.assertTrue(filecmp.cmp(os.path.join(orig, 'patched.file'),
+                                    os.path.join(new, 'patched.file'),
+                                    False))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import random
+import time
+import unittest
+
+from ..diffmatchpatch import diff_match_patch, pure_diff_match_patch
+from ..diffmatchpatch import diff_match_patch_numpy
+
+class TestPatchApply(unittest.TestCase):
+
+    def setUp(self):
+        self.dmp = diff_match_patch()
+        self.old = ''.join('line %d of the old text\n' % i for i in range(200))
+        self.new = self.old.replace('line 5', 'LINE 5').replace('7 of', 'seven of')
+
+    def testOriginalsUnchanged(self):
+        """
+        Tests that applying patches doesn't change the patches passed in,
+        as the copies share their diffs with the originals
+        """
+        patches = self.dmp.patch_make(self.old, self.new)
+        before = self.dmp.patch_toText(patches)
+
+        result = self.dmp.patch_apply(patches, self.old)
+        self.assertEqual(result[0], self.new)
+        self.assertTrue(all(result[1]))
+        self.assertEqual(self.dmp.patch_toText(patches), before)
+
+    def testFuzzyApply(self):
+        """
+        Tests that patches still apply when the text has moved around
+        """
+        patches = self.dmp.patch_make(self.old, self.new)
+        moved = 'an extra line\n' + self.old.replace('line 100', 'line 1OO')
+
+        result = self.dmp.patch_apply(patches, moved)
+        self.assertTrue(all(result[1]))
+        self.assertEqual(result[0], 'an extra line\n'
+                                    + self.new.replace('line 100', 'line 1OO'))
+
+
+@unittest.skipIf(diff_match_patch_numpy is None, 'NumPy is not installed')
+class TestNumpyBackend(unittest.TestCase):
+    """
+    The NumPy backend must give exactly the same results as the pure python
+    reference implementation
+    """
+
+    def setUp(self):
+        self.rand = random.Random(0)
+        self.pure = pure_diff_match_patch()
+        self.fast = diff_match_patch_numpy()
+        #use the vectorized code paths even for small inputs
+        self.fast.Bisect_MinLength = 0
+        self.fast.Bisect_VectorFrom = 0
+
+    def _randomText(self, length, alphabet):
+        return ''.join(self.rand.choice(alphabet) for i in range(length))
+
+    def _mutate(self, text, edits, alphabet):
+        text = list(text)
+        for i in range(edits):
+            pos = self.rand.randint(0, len(text))
+            op = self.rand.randint(0, 2)
+            if op == 0:
+                text.insert(pos, self.rand.choice(alphabet))
+            elif pos < len(text):
+                if op == 1:
+                    del text[pos]
+                else:
+                    text[pos] = self.rand.choice(alphabet)
+        return ''.join(text)
+
+    def testSelected(self):
+        self.assertTrue(diff_match_patch is diff_match_patch_numpy)
+
+    def testBisect(self):
+        deadline = time.time() + 60
+        for i in range(150):
+            alphabet = self.rand.choice(['ab', 'abcd', 'abcdefgh \n'])
+            text1 = self._randomText(self.rand.randint(2, 300), alphabet)
+            text2 = self._mutate(text1, self.rand.randint(1, 80), alphabet)
+            if i % 3 == 0:
+                text1, text2 = unicode(text1), unicode(text2) + u'\u20ac'
+            self.assertEqual(self.pure.diff_bisect(text1, text2, deadline),
+                             self.fast.diff_bisect(text1, text2, deadline))
+
+    def testBitap(self):
+        for i in range(150):
+            text = self._randomText(self.rand.randint(1, 400), 'abcdefgh')
+            start = self.rand.randint(0, len(text) - 1)
+            pattern = self._mutate(text[start:start + self.rand.randint(1, 40)],
+                                   self.rand.randint(0, 5), 'abcdefgh')
+            if not pattern:
+                continue
+            for o in (self.pure, self.fast):
+                o.Match_Distance = [0, 10, 1000][i % 3]
+                o.Match_Threshold = [0.3, 0.5, 0.8][i % 3]
+            loc = self.rand.randint(0, len(text))
+            self.assertEqual(self.pure.match_bitap(text, pattern, loc),
+                             self.fast.match_bitap(text, pattern, loc))
+
+if __name__ == '__main__':
+    unittest.main()
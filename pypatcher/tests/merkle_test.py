@@ -0,0 +1,90 @@
+import os
+import shutil
+import unittest
+import tempfile
+
+from .. import merkle
+
+class TestSimple(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp()
+        self.tree = os.path.join(self.wd, 'tree')
+        self.saved = os.path.join(self.wd, 'tree.json')
+        self._writeTree({
+            'a' : 'a',
+            'dir/b' : 'b',
+            'dir/sub/c' : 'c',
+            'other/d' : 'd',
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+
+    def _writeTree(self, files):
+        for fn, data in files.iteritems():
+            path = os.path.join(self.tree, fn)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(data)
+
+    def testCompare(self):
+        old = merkle.updateTree(self.tree, self.saved)
+        self.assertEqual(merkle.compare(old, merkle.buildTree(self.tree)),
+                         ([], [], []))
+
+        self._writeTree({'dir/sub/c' : 'changed', 'dir/e' : 'e'})
+        os.remove(os.path.join(self.tree, 'a'))
+        shutil.rmtree(os.path.join(self.tree, 'other'))
+        new = merkle.buildTree(self.tree)
+        self.assertNotEqual(old['digest'], new['digest'])
+        self.assertEqual(old['dirs']['dir']['dirs']['sub']['files']['c']['md5'],
+                         merkle.readTree(self.saved)
+                             ['dirs']['dir']['dirs']['sub']['files']['c']['md5'])
+        self.assertEqual(merkle.compare(old, new),
+                         ([os.path.join('dir', 'sub', 'c')],
+                          [os.path.join('dir', 'e')],
+                          ['a', os.path.join('other', 'd')]))
+
+    def testReuse(self):
+        """
+        Tests that the md5 of a file whose stat hasn't changed isn't
+        read again, and that a file whose size has is
+        """
+        merkle.updateTree(self.tree, self.saved)
+        saved = merkle.readTree(self.saved)
+        saved['files']['a']['md5'] = 'stale'
+        saved['dirs']['dir']['files']['b']['md5'] = 'stale'
+        saved['dirs']['dir']['files']['b']['size'] = 0
+        merkle.writeTree(self.saved, saved)
+
+        tree = merkle.updateTree(self.tree, self.saved)
+        self.assertEqual(tree['files']['a']['md5'], 'stale')
+        self.assertNotEqual(tree['dirs']['dir']['files']['b']['md5'], 'stale')
+
+    def testNonAsciiName(self):
+        """
+        Tests that a tree with a non ascii name can be rebuilt from the
+        saved tree
+        """
+        self._writeTree({u'caf\xe9'.encode('utf-8') : 'coffee'})
+        first = merkle.updateTree(self.tree, self.saved)
+        second = merkle.updateTree(self.tree, self.saved)
+        self.assertEqual(first['digest'], second['digest'])
+        self.assertEqual(second['files'][u'caf\xe9']['md5'],
+                         first['files'][u'caf\xe9']['md5'])
+
+        self._writeTree({u'caf\xe9'.encode('utf-8') : 'tea'})
+        self.assertEqual(merkle.compare(second, merkle.buildTree(self.tree)),
+                         ([u'caf\xe9'], [], []))
+
+    def testBadTree(self):
+        with open(self.saved, 'w') as f:
+            f.write('{')
+        self.assertRaises(merkle.TreeError, merkle.readTree, self.saved)
+        merkle.updateTree(self.tree, self.saved)
+        self.assertTrue('a' in merkle.readTree(self.saved)['files'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,10 @@
+import os
+import urllib
 import unittest
 import shutil
+import sqlite3
 import tempfile
+import threading
 
 from .. import partialdl
 
@@ -24,5 +28,81 @@ class TestSimple(unittest.TestCase):
                           self.wd)
         
 
+class TestDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+
+    def testDownloadParallel(self):
+        """
+        Tests downloading several files at once, with the data passed
+        to onData as it arrives
+        """
+        dl = partialdl.PartialDownloader(os.path.join(self.wd, 'dl.sqlite'))
+        received = {}
+        for i in range(6):
+            src = os.path.join(self.wd, 'src%d' % i)
+            with open(src, 'wb') as f:
+                f.write(str(i) * (25*1000 + i))
+            dst = os.path.join(self.wd, 'dst%d' % i)
+            received[dst] = []
+            dl.add('file:' + urllib.pathname2url(src), dst,
+                   onData=received[dst].append)
+
+        done = threading.Event()
+        downloaded = []
+        def callback(files):
+            downloaded.extend(files)
+            done.set()
+        dl.startDownload(callback=callback, workers=3)
+        done.wait(30)
+
+        self.assertEqual(sorted(downloaded), sorted(received))
+        for i in range(6):
+            dst = os.path.join(self.wd, 'dst%d' % i)
+            with open(dst, 'rb') as f:
+                self.assertEqual(f.read(), str(i) * (25*1000 + i))
+            self.assertEqual(''.join(received[dst]), str(i) * (25*1000 + i))
+            self.assertFalse(dl.hasDst(dst))
+
+    def testAddCommitted(self):
+        """
+        Tests that a queued download is in the database straight away, so
+        it is resumed if the process is killed before it finishes
+        """
+        db = os.path.join(self.wd, 'dl.sqlite')
+        dl = partialdl.PartialDownloader(db)
+        dl.add('http://www.example.com/file', os.path.join(self.wd, 'dst'))
+        con = sqlite3.connect(db)
+        try:
+            rows = con.execute('SELECT src FROM downloads').fetchall()
+        finally:
+            con.close()
+        self.assertEqual(rows, [('http://www.example.com/file',)])
+
+    def testParallelTime(self):
+        """
+        Tests that time when several workers are downloading at once is
+        only counted once
+        """
+        dl = partialdl.PartialDownloader(os.path.join(self.wd, 'dl.sqlite'))
+        now = [0.0]
+        dl.clock = lambda: now[0]
+        dl._setDownloading(True)
+        dl._setDownloading(True)
+        now[0] += 1
+        dl._setDownloading(False)
+        now[0] += 1
+        dl._setDownloading(False)
+        #a worker sleeping for the limiter isn't counted
+        now[0] += 1
+        dl._setDownloading(True)
+        now[0] += 1
+        dl._setDownloading(False)
+        self.assertEqual(dl.timeDownloading, 3.0)
+
 if __name__ == '__main__':
     unittest.main()
@@ -3,9 +3,29 @@ import shutil
 import unittest
 import tempfile
 import filecmp
+import random
+import py_compile
+import struct
+import json
+import zipfile
+import bz2
+import hashlib
+import errno
+import time
 
 
 from .. import patchdiff
+from .. import container
+from .. import deltacache
+
+def _offtout(n):
+    """
+    Returns n in bsdiff's format
+    """
+    data = struct.pack('<Q', abs(n))
+    if n < 0:
+        data = data[:7] + chr(ord(data[7]) | 0x80)
+    return data
 
 class TestSimple(unittest.TestCase):
 
@@ -140,5 +160,1110 @@ class TestSimple(unittest.TestCase):
 
         self.assertTrue(filecmp.cmp(files[0], files[NUM_PATCHES], False))
 
+    def testParallelTextDiff(self):
+        """
+        Tests that a text file diffed in regions by multiple processes
+        is patched correctly
+        """
+        orig = os.path.join(self.wd, 'orig')
+        new = os.path.join(self.wd, 'new')
+
+        newF = os.path.join(new, 'patched.file')
+        origF = os.path.join(orig, 'patched.file')
+
+        patchF = os.path.join(self.wd, 'patch.file')
+        temp = os.path.join(self.wd, 'temp')
+
+        os.makedirs(orig)
+        os.makedirs(new)
+        lines = ['line %d\n' % i for i in range(2000)]
+        with open(origF, 'w') as f:
+            f.write(''.join(lines))
+
+        lines[10] = 'changed\n'
+        lines[900:950] = []
+        lines.insert(1500, 'line 3\n')
+        with open(newF, 'w') as f:
+            f.write(''.join(lines))
+
+        minSize = patchdiff.PARALLEL_DIFF_MIN_SIZE
+        regionSize = patchdiff.PARALLEL_DIFF_REGION_SIZE
+        patchdiff.PARALLEL_DIFF_MIN_SIZE = 0
+        patchdiff.PARALLEL_DIFF_REGION_SIZE = 1000
+        try:
+            patchdiff.generateDiff(orig, new, patchF, diffWorkers=2)
+        finally:
+            patchdiff.PARALLEL_DIFF_MIN_SIZE = minSize
+            patchdiff.PARALLEL_DIFF_REGION_SIZE = regionSize
+
+        patchdiff.mergePatches(orig, temp, [patchF])
+        patchdiff.applyPatchDirectory(orig, temp)
+
+        self.assertTrue(filecmp.cmp(origF, newF, False))
+
+    def testTimeBudget(self):
+        """
+        Tests that files diffed with a time budget are patched correctly
+        and that files which ran out of time are reported
+        """
+        orig = os.path.join(self.wd, 'orig')
+        new = os.path.join(self.wd, 'new')
+        patchF = os.path.join(self.wd, 'patch.file')
+        temp = os.path.join(self.wd, 'temp')
+
+        os.makedirs(orig)
+        os.makedirs(new)
+        for i in range(3):
+            with open(os.path.join(orig, str(i)), 'w') as f:
+                f.write('some text %d\n' % i * (i + 1))
+            with open(os.path.join(new, str(i)), 'w') as f:
+                f.write('some more text %d\n' % i * (i + 1))
+
+        report = patchdiff.generateDiff(orig, new, patchF, timeBudget=5)
+        self.assertEqual(report['timedout'], {})
+
+        patchdiff.mergePatches(orig, temp, [patchF])
+        patchdiff.applyPatchDirectory(orig, temp)
+        for i in range(3):
+            self.assertTrue(filecmp.cmp(os.path.join(orig, str(i)),
+                                        os.path.join(new, str(i)),
+                                        False))
+
+    def testTimedOutNotCached(self):
+        """
+        Tests that a text delta that ran out of time isn't cached, so a
+        later run with more time diffs the file again
+        """
+        orig = os.path.join(self.wd, 'orig')
+        new = os.path.join(self.wd, 'new')
+        patchF = os.path.join(self.wd, 'patch.file')
+        self._writeTree(orig, {'text.file' : 'some text\n' * 10})
+        self._writeTree(new, {'text.file' : 'some more text\n' * 10})
+        cache = deltacache.DeltaCache(os.path.join(self.wd, 'cache'))
+
+        calls = []
+        diffRegion = patchdiff._diffRegion
+        def slowDiffRegion(args):
+            calls.append(args)
+            time.sleep(patchdiff.MIN_DIFF_TIMEOUT * 2)
+            return diffRegion(args)
+        patchdiff._diffRegion = slowDiffRegion
+        try:
+            report = patchdiff.generateDiff(orig, new, patchF, timeBudget=0,
+                                            cache=cache)
+            self.assertEqual(report['timedout'].keys(), ['text.file'])
+            self.assertEqual(cache.size(), 0)
+
+            patchdiff.generateDiff(orig, new, patchF, cache=cache)
+            self.assertEqual(len(calls), 2)
+            self.assertTrue(cache.size() > 0)
+        finally:
+            patchdiff._diffRegion = diffRegion
+            cache.close()
+
+    def testTimeBudgetExcludesReads(self):
+        """
+        Tests that the time taken to read the files isn't counted against
+        their diff timeout
+        """
+        orig = os.path.join(self.wd, 'orig')
+        new = os.path.join(self.wd, 'new')
+        patchF = os.path.join(self.wd, 'patch.file')
+        self._writeTree(orig, {'text.file' : 'some text\n'})
+        self._writeTree(new, {'text.file' : 'some more text\n'})
+
+        getFileContents = patchdiff._getFileContents
+        def slowGetFileContents(*args):
+            time.sleep(0.1)
+            return getFileContents(*args)
+        patchdiff._getFileContents = slowGetFileContents
+        try:
+            report = patchdiff.generateDiff(orig, new, patchF,
+                                            timeBudget=0.1)
+        finally:
+            patchdiff._getFileContents = getFileContents
+        self.assertEqual(report['timedout'], {})
+
+    def testGenerateDiffs(self):
+        """
+        Tests that each patch generated in a batch takes its old directory
+        to the new one, and that deltas shared by patches are only generated
+        once
+        """
+        new = os.path.join(self.wd, 'new')
+        os.makedirs(new)
+        with open(os.path.join(new, 'text.file'), 'w') as f:
+            f.write('the newest text')
+        with open(os.path.join(new, 'new.file'), 'w') as f:
+            f.write('a new file')
+
+        olds = []
+        for i, text in enumerate(['old text', 'older text', 'old text']):
+            old = os.path.join(self.wd, 'old%d' % i)
+            os.makedirs(old)
+            with open(os.path.join(old, 'text.file'), 'w') as f:
+                f.write(text)
+            olds.append(old)
+        patches = [os.path.join(self.wd, 'patch%d' % i)
+                    for i in range(len(olds))]
+
+        calls = []
+        genTextPatch = patchdiff._genTextPatch
+        def countingGenTextPatch(*args):
+            calls.append(args)
+            return genTextPatch(*args)
+        patchdiff._genTextPatch = countingGenTextPatch
+        try:
+            reports = patchdiff.generateDiffs(olds, new, patches)
+        finally:
+            patchdiff._genTextPatch = genTextPatch
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(reports, [{'timedout' : {}}] * 3)
+
+        for i, (old, patchF) in enumerate(zip(olds, patches)):
+            temp = os.path.join(self.wd, 'temp%d' % i)
+            patchdiff.mergePatches(old, temp, [patchF])
+            patchdiff.applyPatchDirectory(old, temp)
+            for fn in ('text.file', 'new.file'):
+                self.assertTrue(filecmp.cmp(os.path.join(old, fn),
+                                            os.path.join(new, fn),
+                                            False))
+
+    def testGenerateDiffsParallel(self):
+        """
+        Tests that the batch is the same when shared between processes
+        """
+        new = os.path.join(self.wd, 'new')
+        os.makedirs(os.path.join(new, 'sub'))
+        with open(os.path.join(new, 'sub', 'sub.file'), 'w') as f:
+            f.write('a newer file in a sub directory')
+        with open(os.path.join(new, 'text.file'), 'w') as f:
+            f.write('some more text')
+
+        olds = []
+        for i in range(3):
+            old = os.path.join(self.wd, 'old%d' % i)
+            os.makedirs(os.path.join(old, 'sub'))
+            with open(os.path.join(old, 'sub', 'sub.file'), 'w') as f:
+                f.write('a file in a sub directory %d' % i)
+            olds.append(old)
+
+        serial = [os.path.join(self.wd, 'serial%d' % i) for i in range(3)]
+        parallel = [os.path.join(self.wd, 'parallel%d' % i) for i in range(3)]
+        patchdiff.generateDiffs(olds, new, serial)
+        patchdiff.generateDiffs(olds, new, parallel, workers=2)
+
+        for i, old in enumerate(olds):
+            with zipfile.ZipFile(serial[i]) as s:
+                with zipfile.ZipFile(parallel[i]) as p:
+                    self.assertEqual(s.namelist(), p.namelist())
+                    for name in s.namelist():
+                        self.assertEqual(s.read(name), p.read(name))
+
+            temp = os.path.join(self.wd, 'temp%d' % i)
+            patchdiff.mergePatches(old, temp, [parallel[i]])
+            patchdiff.applyPatchDirectory(old, temp)
+            for fn in (os.path.join('sub', 'sub.file'), 'text.file'):
+                self.assertTrue(filecmp.cmp(os.path.join(old, fn),
+                                            os.path.join(new, fn),
+                                            False))
+
+    def _writeTree(self, d, files):
+        for fn, text in files.iteritems():
+            path = os.path.join(d, fn)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(text)
+
+    def _assertSameTree(self, a, b):
+        listing = lambda d: sorted(os.path.join(root, f)[len(d):]
+                                    for root, dirs, files in os.walk(d)
+                                        for f in files)
+        self.assertEqual(listing(a), listing(b))
+        for fn in listing(a):
+            self.assertTrue(filecmp.cmp(a + fn, b + fn, False))
+
+    def testMoves(self):
+        """
+        Tests that moved, copied, swapped and renamed files are patched
+        from the old files rather than sent in full
+        """
+        orig = os.path.join(self.wd, 'orig')
+        new = os.path.join(self.wd, 'new')
+        patchF = os.path.join(self.wd, 'patch.file')
+        temp = os.path.join(self.wd, 'temp')
+
+        longText = ''.join('line %d of a long file\n' % i for i in range(500))
+        self._writeTree(orig, {
+            'moved' : 'moved text',
+            'kept' : 'kept text',
+            'a' : 'the text of a',
+            'b' : 'the text of b',
+            os.path.join('sub', 'renamed.txt') : longText,
+        })
+        self._writeTree(new, {
+            os.path.join('dir', 'moved') : 'moved text',
+            'kept' : 'kept text',
+            'copy' : 'kept text',
+            'a' : 'the text of b',
+            'b' : 'the text of a',
+            'renamed.txt' : longText.replace('line 5 ', 'line five '),
+        })
+
+        patchdiff.generateDiff(orig, new, patchF)
+        with zipfile.ZipFile(patchF) as z:
+            cfg = json.loads(z.read(patchdiff.PATCH_CFG))
+            self.assertEqual([n for n in z.namelist()
+                                if n.startswith(patchdiff.NEW_DIR)], [])
+        self.assertEqual(cfg[os.path.join('dir', 'moved')]['type'], 'copy')
+        self.assertEqual(cfg['copy']['src'], 'kept')
+        self.assertEqual(cfg['a']['src'], 'b')
+        self.assertEqual(cfg['renamed.txt']['src'],
+                         os.path.join('sub', 'renamed.txt'))
+        self.assertEqual(sorted(cfg['deleted']),
+                         ['moved', os.path.join('sub', 'renamed.txt')])
+
+        patchdiff.mergePatches(orig, temp, [patchF])
+        patchdiff.applyPatchDirectory(orig, temp)
+        self._assertSameTree(orig, new)
+
+    def testMultipleMoves(self):
+        """
+        Tests moving a file created by an earlier patch being merged
+        """
+        dirs = [os.path.join(self.wd, str(i)) for i in range(3)]
+        self._writeTree(dirs[0], {'kept' : 'kept text'})
+        self._writeTree(dirs[1], {'kept' : 'kept text', 'a' : 'some text'})
+        self._writeTree(dirs[2], {'kept' : 'kept text', 'b' : 'some text'})
+
+        patches = [os.path.join(self.wd, 'patch%d' % i) for i in range(2)]
+        for i in range(2):
+            patchdiff.generateDiff(dirs[i], dirs[i+1], patches[i])
+
+        temp = os.path.join(self.wd, 'temp')
+        patchdiff.mergePatches(dirs[0], temp, patches)
+        patchdiff.applyPatchDirectory(dirs[0], temp)
+        self._assertSameTree(dirs[0], dirs[2])
+
+    def testDeletions(self):
+        """
+        Tests that removed files and directories are deleted, including
+        a file replaced by a directory and a directory replaced by a file
+        """
+        orig = os.path.join(self.wd, 'orig')
+        new = os.path.join(self.wd, 'new')
+        patchF = os.path.join(self.wd, 'patch.file')
+        temp = os.path.join(self.wd, 'temp')
+
+        self._writeTree(orig, {
+            'kept' : 'kept text',
+            'gone' : 'removed text',
+            'file' : 'becomes a directory',
+            os.path.join('dir', 'x') : 'becomes a file',
+            os.path.join('a', 'b', 'c', 'deep') : 'removed with its dirs',
+            os.path.join('a', 'kept') : 'kept in a',
+        })
+        os.makedirs(os.path.join(orig, 'empty'))
+        self._writeTree(new, {
+            'kept' : 'kept text',
+            os.path.join('file', 'x') : 'in a new directory',
+            'dir' : 'a new file',
+            os.path.join('a', 'kept') : 'kept in a',
+        })
+
+        patchdiff.generateDiff(orig, new, patchF)
+        with zipfile.ZipFile(patchF) as z:
+            cfg = json.loads(z.read(patchdiff.PATCH_CFG))
+        self.assertEqual(cfg['deleted'],
+                         sorted([os.path.join('a', 'b', 'c', 'deep'),
+                                 os.path.join('dir', 'x'),
+                                 'file', 'gone']))
+        self.assertEqual(cfg['deleteddirs'],
+                         [os.path.join('a', 'b', 'c'),
+                          os.path.join('a', 'b'),
+                          'dir', 'empty'])
+
+        patchdiff.mergePatches(orig, temp, [patchF])
+        #already deleted files are skipped
+        os.remove(os.path.join(orig, 'gone'))
+        patchdiff.applyPatchDirectory(orig, temp)
+        self._assertSameTree(orig, new)
+        self.assertFalse(os.path.exists(os.path.join(orig, 'empty')))
+        self.assertFalse(os.path.exists(os.path.join(orig, 'a', 'b')))
+
+    def testDeleteRecreate(self):
+        """
+        Tests that a file deleted by one patch and created again by a later
+        one is kept, along with its directory
+        """
+        dirs = [os.path.join(self.wd, str(i)) for i in range(3)]
+        self._writeTree(dirs[0], {os.path.join('d', 'f') : 'some text'})
+        self._writeTree(dirs[1], {'other' : 'other text'})
+        self._writeTree(dirs[2], {os.path.join('d', 'f') : 'new text'})
+
+        patches = [os.path.join(self.wd, 'patch%d' % i) for i in range(2)]
+        for i in range(2):
+            patchdiff.generateDiff(dirs[i], dirs[i+1], patches[i])
+
+        temp = os.path.join(self.wd, 'temp')
+        patchdiff.mergePatches(dirs[0], temp, patches)
+        patchdiff.applyPatchDirectory(dirs[0], temp)
+        self._assertSameTree(dirs[0], dirs[2])
+
+    def _writeZip(self, path, members, comment=''):
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr(zipfile.ZipInfo('pkg/', (2012, 1, 1, 0, 0, 0)), '')
+            for name, data in members:
+                z.writestr(zipfile.ZipInfo(name, (2012, 1, 1, 0, 0, 0)), data)
+            z.comment = comment
+
+    def testPatchZip(self):
+        """
+        Tests that zips are patched member by member and rebuilt exactly
+        """
+        orig = os.path.join(self.wd, 'orig')
+        new = os.path.join(self.wd, 'new')
+        patchF = os.path.join(self.wd, 'patch.file')
+        temp = os.path.join(self.wd, 'temp')
+
+        module = lambda i: ''.join('def f%d_%d(): return %d\n' % (i, j, j)
+                                    for j in range(200))
+        members = [('pkg/mod%d.py' % i, module(i)) for i in range(10)]
+        self._writeZip(os.path.join(orig, 'library.zip'), members)
+
+        members[3] = ('pkg/mod3.py', members[3][1].replace('return 5', 'pass'))
+        members.pop(7)
+        members.append(('pkg/new.py', 'print "new"\n'))
+        self._writeZip(os.path.join(new, 'library.zip'), members, 'comment')
+
+        patchdiff.generateDiff(orig, new, patchF)
+        with zipfile.ZipFile(patchF) as z:
+            cfg = json.loads(z.read(patchdiff.PATCH_CFG))
+            patchSize = z.getinfo(os.path.join(patchdiff.PATCH_DIR,
+                                               'library.zip')).file_size
+        self.assertEqual(cfg['library.zip']['type'], 'zip')
+        self.assertTrue(patchSize * 4
+                        < os.path.getsize(os.path.join(new, 'library.zip')))
+
+        patchdiff.mergePatches(orig, temp, [patchF])
+        patchdiff.applyPatchDirectory(orig, temp)
+        self._assertSameTree(orig, new)
+
+    def testZipLayout(self):
+        """
+        Tests that zips whose members can't be extracted safely are refused
+        """
+        zipF = os.path.join(self.wd, 'test.zip')
+        self._writeZip(zipF, [('../escape', 'text')])
+        self.assertRaises(patchdiff.DiffError, patchdiff._zipLayout, zipF)
+        self._writeZip(zipF, [('pkg/a', 'text'), ('pkg/A', 'text')])
+        self.assertRaises(patchdiff.DiffError, patchdiff._zipLayout, zipF)
+        self._writeZip(zipF, [('pkg/a', 'text')])
+        self.assertEqual([m['name'] for m in
+                            patchdiff._zipLayout(zipF)['members']],
+                         ['pkg/', 'pkg/a'])
+
+    def testPycHeader(self):
+        """
+        Tests that a recompiled but unchanged .pyc only has its header
+        patched, even if the local file has a different header
+        """
+        orig = os.path.join(self.wd, 'orig')
+        new = os.path.join(self.wd, 'new')
+        patchF = os.path.join(self.wd, 'patch.file')
+        temp = os.path.join(self.wd, 'temp')
+
+        source = os.path.join(self.wd, 'mod.py')
+        with open(source, 'w') as f:
+            f.write('def f():\n    return 1\n')
+        for d, mtime in ((orig, 1000000000), (new, 1100000000)):
+            os.utime(source, (mtime, mtime))
+            os.makedirs(d)
+            py_compile.compile(source, os.path.join(d, 'mod.pyc'), 'mod.py')
+
+        patchdiff.generateDiff(orig, new, patchF)
+        with zipfile.ZipFile(patchF) as z:
+            cfg = json.loads(z.read(patchdiff.PATCH_CFG))
+            self.assertEqual(z.namelist(), [patchdiff.PATCH_CFG])
+        self.assertEqual(cfg['mod.pyc']['type'], 'pycheader')
+
+        #as if python recompiled the local file
+        os.utime(source, (1050000000, 1050000000))
+        py_compile.compile(source, os.path.join(orig, 'mod.pyc'), 'mod.py')
+
+        patchdiff.mergePatches(orig, temp, [patchF])
+        patchdiff.applyPatchDirectory(orig, temp)
+        self._assertSameTree(orig, new)
+
+    def testPycHeaderLength(self):
+        header = lambda magic: struct.pack('<H', magic) + '\r\n' + '\0' * 12
+        self.assertEqual(patchdiff._pycHeaderLength(header(62211)), 8)
+        self.assertEqual(patchdiff._pycHeaderLength(header(3180)), 8)
+        self.assertEqual(patchdiff._pycHeaderLength(header(3379)), 12)
+        self.assertEqual(patchdiff._pycHeaderLength(header(3413)), 16)
+        self.assertEqual(patchdiff._pycHeaderLength('not a pyc file'), None)
+
+    def testUnchanged(self):
+        """
+        Tests that files that haven't changed are left out of the patch
+        """
+        orig = os.path.join(self.wd, 'orig')
+        new = os.path.join(self.wd, 'new')
+        patchF = os.path.join(self.wd, 'patch.file')
+        temp = os.path.join(self.wd, 'temp')
+
+        files = dict(('file%d' % i, 'the text of file %d' % i)
+                        for i in range(10))
+        self._writeTree(orig, files)
+        files['file3'] = 'the text of file 3 has changed'
+        files['file4'] = 'the text of file 5'
+        self._writeTree(new, files)
+
+        patchdiff.generateDiff(orig, new, patchF)
+        with zipfile.ZipFile(patchF) as z:
+            cfg = json.loads(z.read(patchdiff.PATCH_CFG))
+            self.assertEqual(z.namelist(),
+                             [patchdiff.PATCH_CFG,
+                              os.path.join(patchdiff.PATCH_DIR, 'file3')])
+        self.assertEqual(sorted(patchdiff._fileCfgs(cfg)),
+                         [('file3', cfg['file3']), ('file4', cfg['file4'])])
+        self.assertEqual(cfg['file4']['type'], 'copy')
+
+        patchdiff.mergePatches(orig, temp, [patchF])
+        patchdiff.applyPatchDirectory(orig, temp)
+        self._assertSameTree(orig, new)
+
+    def testUnchangedNotHashed(self):
+        """
+        Tests that only the old files a changed file could be patched or
+        copied from are hashed when planning a patch
+        """
+        orig = os.path.join(self.wd, 'orig')
+        new = os.path.join(self.wd, 'new')
+        files = dict(('file%02d' % i, 'x' * (i + 1)) for i in range(20))
+        self._writeTree(orig, files)
+        files['file05'] = 'y' * 6
+        self._writeTree(new, files)
+        newMd5s = patchdiff._hashTree(new)
+
+        hashed = []
+        getFileMd5 = patchdiff._getFileMd5
+        def countingGetFileMd5(filePath):
+            hashed.append(filePath)
+            return getFileMd5(filePath)
+        patchdiff._getFileMd5 = countingGetFileMd5
+        try:
+            cfg = patchdiff._planDiff(orig, new, newMd5s)
+        finally:
+            patchdiff._getFileMd5 = getFileMd5
+        self.assertEqual(hashed, [os.path.join(orig, 'file05')])
+        self.assertEqual([fn for fn, filecfg in patchdiff._fileCfgs(cfg)],
+                         ['file05'])
+
+    def testFilesEqual(self):
+        self._writeTree(self.wd, {'a' : 'x' * 100, 'b' : 'x' * 99 + 'y',
+                                  'c' : 'x' * 100, 'd' : 'x'})
+        path = lambda fn: os.path.join(self.wd, fn)
+        self.assertTrue(patchdiff._filesEqual(path('a'), path('c')))
+        self.assertFalse(patchdiff._filesEqual(path('a'), path('b')))
+        self.assertFalse(patchdiff._filesEqual(path('a'), path('d')))
+
+    def testCodecs(self):
+        """
+        Tests that incompressible entries are stored rather than deflated,
+        by generateDiff and generateDiffs
+        """
+        orig = os.path.join(self.wd, 'orig')
+        new = os.path.join(self.wd, 'new')
+        rand = random.Random(0)
+        noise = ''.join(chr(rand.randint(0, 255)) for i in range(50000))
+        os.makedirs(orig)
+        self._writeTree(new, {'text' : 'some text\n' * 5000, 'noise' : noise})
+
+        patches = [os.path.join(self.wd, 'patch%d' % i) for i in range(2)]
+        patchdiff.generateDiff(orig, new, patches[0])
+        patchdiff.generateDiffs([orig], new, patches[1:])
+        for i, patchF in enumerate(patches):
+            with zipfile.ZipFile(patchF) as z:
+                cfg = json.loads(z.read(patchdiff.PATCH_CFG))
+                types = dict((fn, z.getinfo(os.path.join(patchdiff.NEW_DIR,
+                                                         fn)).compress_type)
+                                for fn in ('text', 'noise'))
+            self.assertEqual(cfg['text']['codec'], 'deflate')
+            self.assertEqual(cfg['noise']['codec'], 'stored')
+            self.assertEqual(types, {'text' : zipfile.ZIP_DEFLATED,
+                                     'noise' : zipfile.ZIP_STORED})
+
+            temp = os.path.join(self.wd, 'temp%d' % i)
+            dst = os.path.join(self.wd, 'dst%d' % i)
+            shutil.copytree(orig, dst)
+            patchdiff.mergePatches(dst, temp, [patchF])
+            patchdiff.applyPatchDirectory(dst, temp)
+            self._assertSameTree(dst, new)
+
+    def testZipDir(self):
+        """
+        Tests that the zips written from precompressed members are valid
+        """
+        rand = random.Random(0)
+        files = {
+            'text' : 'some text\n' * 5000,
+            'noise' : ''.join(chr(rand.randint(0, 255)) for i in range(50000)),
+            'empty' : '',
+            u'caf\xe9' : 'cafe',
+        }
+        members = {}
+        for i, (fn, data) in enumerate(sorted(files.iteritems())):
+            src = os.path.join(self.wd, 'src%d' % i)
+            with open(src, 'wb') as f:
+                f.write(data)
+            members[os.path.join('dir', fn)] = patchdiff._compressFile(
+                src, os.path.join(self.wd, 'dst%d' % i))
+
+        zipF = os.path.join(self.wd, 'out.zip')
+        patchdiff._zipDir(members, zipF)
+        with zipfile.ZipFile(zipF) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual(dict((name, z.read(name))
+                                    for name in z.namelist()),
+                             dict(('dir/' + fn, data)
+                                    for fn, data in files.iteritems()))
+            self.assertEqual(z.getinfo('dir/noise').compress_type,
+                             zipfile.ZIP_STORED)
+            self.assertEqual(z.getinfo('dir/text').compress_type,
+                             zipfile.ZIP_DEFLATED)
+
+    def testSolid(self):
+        """
+        Tests that a patch of lots of small changes is smaller when solid,
+        and is patched correctly
+        """
+        orig = os.path.join(self.wd, 'orig')
+        new = os.path.join(self.wd, 'new')
+        module = lambda i: ''.join('def f%d(x):\n    return x + %d\n' % (j, i)
+                                    for j in range(20))
+        self._writeTree(orig, dict(('mod%d.py' % i, module(i))
+                                    for i in range(50)))
+        self._writeTree(new, dict(('mod%d.py' % i,
+                                   module(i).replace('f5(', 'g5('))
+                                    for i in range(50)))
+
+        plainF = os.path.join(self.wd, 'plain')
+        solidF = os.path.join(self.wd, 'solid')
+        batchF = os.path.join(self.wd, 'batch')
+        patchdiff.generateDiff(orig, new, plainF)
+        patchdiff.generateDiff(orig, new, solidF, solid=True)
+        patchdiff.generateDiffs([orig], new, [batchF], solid=True)
+        self.assertTrue(os.path.getsize(solidF) * 2 < os.path.getsize(plainF))
+
+        for i, patchF in enumerate((solidF, batchF)):
+            with zipfile.ZipFile(patchF) as z:
+                cfg = json.loads(z.read(patchdiff.PATCH_CFG))
+                self.assertEqual(sorted(z.namelist()),
+                                 [patchdiff.PATCH_CFG, patchdiff.SOLID_BLOCK])
+            self.assertEqual(len(cfg['solid']), 50)
+            self.assertEqual(cfg['mod0.py']['codec'], 'solid')
+
+            temp = os.path.join(self.wd, 'temp%d' % i)
+            dst = os.path.join(self.wd, 'dst%d' % i)
+            shutil.copytree(orig, dst)
+            patchdiff.mergePatches(dst, temp, [patchF])
+            patchdiff.applyPatchDirectory(dst, temp)
+            self._assertSameTree(dst, new)
+
+    def testContainer(self):
+        """
+        Tests that patches written as containers are patched correctly
+        """
+        orig = os.path.join(self.wd, 'orig')
+        new = os.path.join(self.wd, 'new')
+        self._writeTree(orig, {
+            'changed' : 'some text\n' * 100,
+            'removed' : 'removed text',
+            os.path.join('sub', 'small') : 'a small file',
+        })
+        self._writeTree(new, {
+            'changed' : 'some text\n' * 50 + 'some more text\n' * 50,
+            'added' : 'a new file\n' * 100,
+            os.path.join('sub', 'small') : 'a small changed file',
+        })
+
+        for i, kwargs in enumerate([{}, {'solid' : True}]):
+            patchF = os.path.join(self.wd, 'patch%d' % i)
+            batchF = os.path.join(self.wd, 'batch%d' % i)
+            patchdiff.generateDiff(orig, new, patchF, useContainer=True,
+                                   **kwargs)
+            patchdiff.generateDiffs([orig], new, [batchF], useContainer=True,
+                                    **kwargs)
+            for j, f in enumerate((patchF, batchF)):
+                with container.ContainerReader(f) as reader:
+                    self.assertEqual(reader.names()[0], patchdiff.PATCH_CFG)
+                temp = os.path.join(self.wd, 'temp%d%d' % (i, j))
+                dst = os.path.join(self.wd, 'dst%d%d' % (i, j))
+                shutil.copytree(orig, dst)
+                patchdiff.mergePatches(dst, temp, [f])
+                patchdiff.applyPatchDirectory(dst, temp)
+                self._assertSameTree(dst, new)
+
+    def testStream(self):
+        """
+        Tests merging patches by streaming them, including one that can't
+        be streamed as the patch before it hasn't arrived
+        """
+        orig = os.path.join(self.wd, 'orig')
+        mid = os.path.join(self.wd, 'mid')
+        new = os.path.join(self.wd, 'new')
+        self._writeTree(orig, {
+            'changed' : 'some text\n' * 100,
+            'moved' : 'moved text\n' * 100,
+            os.path.join('sub', 'removed') : 'removed text',
+        })
+        self._writeTree(mid, {
+            'changed' : 'some text\n' * 50 + 'some more text\n' * 50,
+            'renamed' : 'moved text\n' * 100,
+            'added' : 'a new file\n' * 100,
+        })
+        self._writeTree(new, {
+            'changed' : 'some more text\n' * 100,
+            'renamed' : 'moved text\n' * 100,
+            'added' : 'a changed new file\n' * 100,
+        })
+        patches = [os.path.join(self.wd, 'patch1'),
+                   os.path.join(self.wd, 'patch2')]
+        patchdiff.generateDiff(orig, mid, patches[0], useContainer=True)
+        patchdiff.generateDiff(mid, new, patches[1], useContainer=True,
+                               solid=True)
+
+        def feed(stream, f):
+            with open(f, 'rb') as fh:
+                data = fh.read()
+            for i in xrange(0, len(data), 1000):
+                stream.feed(data[i:i + 1000])
+
+        for order in ([0, 1], [1, 0]):
+            dst = os.path.join(self.wd, 'dst%d' % order[0])
+            temp = os.path.join(self.wd, 'temp%d' % order[0])
+            shutil.copytree(orig, dst)
+            merger = patchdiff.PatchMerger(dst, temp)
+            streams = [merger.stream(), merger.stream()]
+            for i in order:
+                feed(streams[i], patches[i])
+            self.assertTrue(streams[0].finished)
+            self.assertEqual(streams[1].finished, order == [0, 1])
+            merger.finish(patches)
+            patchdiff.applyPatchDirectory(dst, temp)
+            self._assertSameTree(dst, new)
+
+    def testStreamCorrupt(self):
+        """
+        Tests that a patch that fails part way through being streamed is
+        merged again from the start
+        """
+        orig = os.path.join(self.wd, 'orig')
+        new = os.path.join(self.wd, 'new')
+        self._writeTree(orig, {'a' : 'old a\n' * 100, 'b' : 'old b\n' * 100})
+        self._writeTree(new, {'a' : 'new a\n' * 100, 'b' : 'new b\n' * 100})
+        patchF = os.path.join(self.wd, 'patch')
+        patchdiff.generateDiff(orig, new, patchF, useContainer=True)
+        with open(patchF, 'rb') as f:
+            data = f.read()
+        with container.ContainerReader(patchF) as reader:
+            offset = reader.entries[-1]['offset']
+
+        merger = patchdiff.PatchMerger(orig, os.path.join(self.wd, 'temp'))
+        stream = merger.stream()
+        stream.feed(data[:offset])
+        stream.feed(chr(ord(data[offset]) ^ 0xff) + data[offset + 1:])
+        self.assertTrue(stream.failed)
+        self.assertTrue(merger.dirty)
+
+        merger.finish([patchF])
+        patchdiff.applyPatchDirectory(orig, os.path.join(self.wd, 'temp'))
+        self._assertSameTree(orig, new)
+
+    def testVerify(self):
+        """
+        Tests that every changed source is reported before anything is
+        merged, and that files written by an earlier patch aren't checked
+        """
+        orig = os.path.join(self.wd, 'orig')
+        mid = os.path.join(self.wd, 'mid')
+        new = os.path.join(self.wd, 'new')
+        temp = os.path.join(self.wd, 'temp')
+        self._writeTree(orig, {'a' : 'old a\n' * 100, 'b' : 'old b\n' * 100,
+                               'c' : 'old c\n' * 100})
+        self._writeTree(mid, {'a' : 'mid a\n' * 100, 'b' : 'mid b\n' * 100,
+                              'c' : 'mid c\n' * 100, 'd' : 'mid d\n' * 100})
+        self._writeTree(new, {'a' : 'mid a\n' * 100, 'b' : 'mid b\n' * 100,
+                              'c' : 'mid c\n' * 100, 'd' : 'new d\n' * 100})
+        patch1 = os.path.join(self.wd, 'patch1')
+        patch2 = os.path.join(self.wd, 'patch2')
+        patchdiff.generateDiff(orig, mid, patch1)
+        patchdiff.generateDiff(mid, new, patch2, useContainer=True)
+
+        with open(os.path.join(orig, 'a'), 'w') as f:
+            f.write('changed')
+        os.remove(os.path.join(orig, 'b'))
+        try:
+            patchdiff.mergePatches(orig, temp, [patch1, patch2])
+            self.fail('The changed sources weren\'t found')
+        except patchdiff.SourceError as e:
+            self.assertEqual(e.files, ['a', 'b'])
+        self.assertFalse(os.path.exists(os.path.join(temp,
+                                                     patchdiff.MERGED_FILES)))
+
+        self._writeTree(orig, {'a' : 'old a\n' * 100, 'b' : 'old b\n' * 100})
+        patchdiff.mergePatches(orig, temp, [patch1, patch2])
+        patchdiff.applyPatchDirectory(orig, temp)
+        self._assertSameTree(orig, new)
+
+    def testVerifyHashesOnce(self):
+        """
+        Tests that the sources checked before merging aren't hashed again
+        when they are patched
+        """
+        orig = os.path.join(self.wd, 'orig')
+        new = os.path.join(self.wd, 'new')
+        temp = os.path.join(self.wd, 'temp')
+        self._writeTree(orig, {'a' : 'old a\n' * 100, 'b' : 'moved\n' * 100})
+        self._writeTree(new, {'a' : 'new a\n' * 100, 'c' : 'moved\n' * 100})
+        patchF = os.path.join(self.wd, 'patch')
+        patchdiff.generateDiff(orig, new, patchF)
+
+        hashed = []
+        getFileMd5 = patchdiff._getFileMd5
+        def countingGetFileMd5(filePath):
+            hashed.append(filePath)
+            return getFileMd5(filePath)
+        patchdiff._getFileMd5 = countingGetFileMd5
+        try:
+            patchdiff.mergePatches(orig, temp, [patchF])
+        finally:
+            patchdiff._getFileMd5 = getFileMd5
+        self.assertEqual(sorted(f for f in hashed if f.startswith(orig)),
+                         [os.path.join(orig, 'a'), os.path.join(orig, 'b')])
+        patchdiff.applyPatchDirectory(orig, temp)
+        self._assertSameTree(orig, new)
+
+    def testRepair(self):
+        """
+        Tests that changed sources are fetched by the repair function and
+        the merge continues, and that those it doesn't fix are raised
+        """
+        orig = os.path.join(self.wd, 'orig')
+        pristine = os.path.join(self.wd, 'pristine')
+        new = os.path.join(self.wd, 'new')
+        temp = os.path.join(self.wd, 'temp')
+        oldFiles = {'a' : 'old a\n' * 100, 'dir/b' : 'old b\n' * 100,
+                    'c' : 'old c\n' * 100}
+        self._writeTree(orig, oldFiles)
+        self._writeTree(pristine, oldFiles)
+        self._writeTree(new, {'a' : 'new a\n' * 100, 'dir/b' : 'new b\n' * 100,
+                              'c' : 'new c\n' * 100})
+        patchF = os.path.join(self.wd, 'patch')
+        patchdiff.generateDiff(orig, new, patchF)
+
+        with open(os.path.join(orig, 'a'), 'w') as f:
+            f.write('changed')
+        os.remove(os.path.join(orig, 'dir', 'b'))
+        repaired = []
+        def repair(fns, destDir):
+            repaired.extend(fns)
+            for fn in fns:
+                patchdiff._createCopy2(os.path.join(pristine, fn),
+                                       os.path.join(destDir, fn))
+        patchdiff.mergePatches(orig, temp, [patchF], repair)
+        self.assertEqual(repaired, ['a', os.path.join('dir', 'b')])
+        patchdiff.applyPatchDirectory(orig, temp)
+        self._assertSameTree(orig, new)
+
+        self._writeTree(orig, oldFiles)
+        with open(os.path.join(orig, 'c'), 'w') as f:
+            f.write('changed')
+        try:
+            patchdiff.mergePatches(orig, temp, [patchF], lambda *args: None)
+            self.fail('The unrepaired source wasn\'t found')
+        except patchdiff.SourceError as e:
+            self.assertEqual(e.files, ['c'])
+
+    def testMoveFile(self):
+        """
+        Tests that moving a file over a hardlink doesn't change the other
+        links, including when the move has to copy across devices
+        """
+        src = os.path.join(self.wd, 'src')
+        dst = os.path.join(self.wd, 'dir', 'dst')
+        linked = os.path.join(self.wd, 'linked')
+        self._writeTree(self.wd, {'src' : 'new', 'linked' : 'old'})
+        patchdiff._createCopy2(linked, dst, link=True)
+        patchdiff._moveFile(src, dst)
+        with open(dst) as f:
+            self.assertEqual(f.read(), 'new')
+        with open(linked) as f:
+            self.assertEqual(f.read(), 'old')
+        self.assertFalse(os.path.exists(src))
+
+        replaceFile = patchdiff._replaceFile
+        def crossDevice(a, b):
+            if a == src:
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            replaceFile(a, b)
+        patchdiff._replaceFile = crossDevice
+        try:
+            self._writeTree(self.wd, {'src' : 'newer'})
+            patchdiff._moveFile(src, dst)
+        finally:
+            patchdiff._replaceFile = replaceFile
+        with open(dst) as f:
+            self.assertEqual(f.read(), 'newer')
+        self.assertFalse(os.path.exists(src))
+        self.assertEqual(os.listdir(os.path.dirname(dst)), ['dst'])
+
+    def testShards(self):
+        """
+        Tests that the shards of a patch can be merged in any order, and that
+        files patched from other files are in the same shard as them
+        """
+        orig = os.path.join(self.wd, 'orig')
+        new = os.path.join(self.wd, 'new')
+        oldFiles = {}
+        newFiles = {}
+        for i in range(8):
+            oldFiles['file%d' % i] = 'old file %d\n' % i * (20 * (i + 1))
+            newFiles['file%d' % i] = 'new file %d\n' % i * (20 * (i + 1))
+        oldFiles['moved'] = 'moved text\n' * 100
+        newFiles['file0'] = oldFiles['moved']
+        newFiles['renamed'] = oldFiles['file1']
+        oldFiles[os.path.join('sub', 'removed')] = 'removed text'
+        self._writeTree(orig, oldFiles)
+        self._writeTree(new, newFiles)
+
+        index = os.path.join(self.wd, 'patch' + patchdiff.SHARD_INDEX_EXT)
+        patchdiff.generateDiff(orig, new, index, shards=3, useContainer=True)
+        shards = patchdiff.readShardIndex(index)
+        self.assertEqual(len(shards), 3)
+        shardFiles = [os.path.join(self.wd, s['file']) for s in shards]
+        for shard, f in zip(shards, shardFiles):
+            self.assertEqual(shard['md5'], patchdiff._getFileMd5(f))
+
+        #file1 is renamed so must be in the same shard as what it became
+        for f in shardFiles:
+            with container.ContainerReader(f) as reader:
+                cfg = json.loads(reader.read(patchdiff.PATCH_CFG))
+            self.assertEqual('file1' in cfg, 'renamed' in cfg)
+            self.assertEqual('file0' in cfg, 'moved' in cfg['deleted'])
+
+        for i, order in enumerate([[0, 1, 2], [2, 1, 0], None]):
+            dst = os.path.join(self.wd, 'dst%d' % i)
+            temp = os.path.join(self.wd, 'temp%d' % i)
+            shutil.copytree(orig, dst)
+            if order is None:
+                patchdiff.mergePatches(dst, temp, [index])
+            else:
+                patchdiff.mergePatches(dst, temp,
+                                       [shardFiles[j] for j in order])
+            patchdiff.applyPatchDirectory(dst, temp)
+            self._assertSameTree(dst, new)
+
+    def testStreamShards(self):
+        """
+        Tests streaming shards in any order, after the patch before them
+        """
+        orig = os.path.join(self.wd, 'orig')
+        mid = os.path.join(self.wd, 'mid')
+        new = os.path.join(self.wd, 'new')
+        self._writeTree(orig, {'a' : 'a\n' * 100, 'b' : 'b\n' * 100})
+        self._writeTree(mid, {'a' : 'aa\n' * 100, 'b' : 'bb\n' * 100})
+        self._writeTree(new, {'a' : 'aaa\n' * 100, 'b' : 'bbb\n' * 100,
+                              'c' : 'c\n' * 100})
+        first = os.path.join(self.wd, 'first')
+        index = os.path.join(self.wd, 'second' + patchdiff.SHARD_INDEX_EXT)
+        patchdiff.generateDiff(orig, mid, first, useContainer=True)
+        patchdiff.generateDiff(mid, new, index, shards=2, useContainer=True)
+        shardFiles = [os.path.join(self.wd, s['file'])
+                      for s in patchdiff.readShardIndex(index)]
+
+        merger = patchdiff.PatchMerger(orig, os.path.join(self.wd, 'temp'))
+        streams = [merger.stream(), merger.stream(1), merger.stream(1)]
+        for stream, f in reversed(zip(streams, [first] + shardFiles)):
+            with open(f, 'rb') as fh:
+                stream.feed(fh.read())
+        self.assertEqual([s.finished for s in streams], [True, False, False])
+
+        merger = patchdiff.PatchMerger(orig, os.path.join(self.wd, 'temp'))
+        streams = [merger.stream(), merger.stream(1), merger.stream(1)]
+        for i in (0, 2, 1):
+            with open(([first] + shardFiles)[i], 'rb') as fh:
+                streams[i].feed(fh.read())
+        self.assertTrue(all(s.finished for s in streams))
+
+        merger.finish([first] + shardFiles)
+        patchdiff.applyPatchDirectory(orig, os.path.join(self.wd, 'temp'))
+        self._assertSameTree(orig, new)
+
+    def testCompressWorkers(self):
+        """
+        Tests that compressing in more processes gives the same patch
+        """
+        orig = os.path.join(self.wd, 'orig')
+        new = os.path.join(self.wd, 'new')
+        rand = random.Random(0)
+        files = {}
+        for i in range(6):
+            files[os.path.join('dir%d' % (i % 2), 'file%d' % i)] = (
+                'file %d\n' % i * 200)
+        files['random'] = ''.join(chr(rand.randint(0, 255))
+                                  for i in xrange(20000))
+        os.makedirs(orig)
+        self._writeTree(new, files)
+
+        for useContainer in (False, True):
+            patchF = os.path.join(self.wd, 'patch%d' % useContainer)
+            patchdiff.generateDiff(orig, new, patchF,
+                                   useContainer=useContainer,
+                                   compressWorkers=3)
+            temp = os.path.join(self.wd, 'temp%d' % useContainer)
+            dst = os.path.join(self.wd, 'dst%d' % useContainer)
+            shutil.copytree(orig, dst)
+            patchdiff.mergePatches(dst, temp, [patchF])
+            patchdiff.applyPatchDirectory(dst, temp)
+            self._assertSameTree(dst, new)
+
+            outputs = []
+            for workers in (1, 3):
+                outF = os.path.join(self.wd, 'out%d%d' % (useContainer,
+                                                         workers))
+                patchdiff._writePatchFile(new, outF,
+                                          useContainer=useContainer,
+                                          workers=workers)
+                with open(outF, 'rb') as f:
+                    outputs.append(f.read())
+            self.assertEqual(outputs[0], outputs[1])
+
+    def testMemoryCeiling(self):
+        """
+        Tests that a file larger than the memory ceiling is patched a block
+        at a time, and isn't diffed as text
+        """
+        ceiling = patchdiff.MEMORY_CEILING
+        patchdiff.MEMORY_CEILING = 16*1024
+        try:
+            rand = random.Random(0)
+            old = ''.join(chr(rand.randint(0, 255)) for i in xrange(100000))
+            changed = list(old[:60000])
+            for i in xrange(0, 60000, 1000):
+                changed[i] = chr(ord(changed[i]) ^ 0x55)
+            changed = ''.join(changed)
+            new = (changed + 'inserted' * 1000 + old[80000:]
+                   + 'beyond the end')
+
+            #as bsdiff would make, with part of the diff beyond the old file
+            controls = [(60000, 8000, 20000), (20000, 0, 0), (14, 0, 0)]
+            diff = (''.join(chr((ord(a) - ord(b)) & 0xff)
+                            for a, b in zip(changed, old))
+                    + '\0' * 20000 + 'beyond the end')
+            extra = 'inserted' * 1000
+            ctrl = bz2.compress(''.join(_offtout(n) for c in controls
+                                                    for n in c))
+            diff = bz2.compress(diff)
+            extra = bz2.compress(extra)
+
+            src = os.path.join(self.wd, 'old')
+            out = os.path.join(self.wd, 'out', 'new')
+            patchF = os.path.join(self.wd, 'patch')
+            with open(src, 'wb') as f:
+                f.write(old)
+            with open(patchF, 'wb') as f:
+                f.write(patchdiff.BSDIFF_MAGIC + _offtout(len(ctrl))
+                        + _offtout(len(diff)) + _offtout(len(new))
+                        + ctrl + diff + extra)
+            patchdiff._patchBin(src, out, patchF)
+            with open(out, 'rb') as f:
+                self.assertEqual(f.read(), new)
+
+            #a truncated patch is an error rather than a short file
+            with open(patchF, 'r+b') as f:
+                f.truncate(patchdiff.BSDIFF_HEADER_SIZE + len(ctrl) + 20)
+            self.assertRaises(patchdiff.PatchError,
+                              patchdiff._patchBin, src, out, patchF)
+
+            orig = os.path.join(self.wd, 'orig')
+            newDir = os.path.join(self.wd, 'new')
+            self._writeTree(orig, {'big' : 'some text\n' * 2000,
+                                   'small' : 'some text\n'})
+            self._writeTree(newDir, {'big' : 'more text\n' * 2000,
+                                     'small' : 'more text\n'})
+            cfg = patchdiff._planDiff(orig, newDir,
+                                      patchdiff._hashTree(newDir))
+            self.assertEqual(cfg['big']['type'], 'bsdiff')
+            self.assertEqual(cfg['small']['type'], 'text')
+            self.assertEqual(cfg['big']['patchedmd5'],
+                             hashlib.md5('more text\n' * 2000).hexdigest())
+
+            #zips are rebuilt a member at a time, so one with a member over
+            #the ceiling is refused
+            zipF = os.path.join(self.wd, 'test.zip')
+            self._writeZip(zipF, [('big', 'some text\n' * 2000)])
+            self.assertRaises(patchdiff.DiffError, patchdiff._zipLayout, zipF)
+        finally:
+            patchdiff.MEMORY_CEILING = ceiling
+
+    def testRsync(self):
+        """
+        Tests that large binary files (and files with an extension set to
+        it) are given the rsync type and patched correctly
+        """
+        minSize = patchdiff.RSYNC_MIN_SIZE
+        patchdiff.RSYNC_MIN_SIZE = 32*1024
+        patchdiff.BINARY_TYPES['.dat'] = 'rsync'
+        try:
+            rand = random.Random(0)
+            data = ''.join(chr(rand.randint(0, 255)) for i in xrange(40000))
+            orig = os.path.join(self.wd, 'orig')
+            new = os.path.join(self.wd, 'new')
+            self._writeTree(orig, {'large' : '\0' + data,
+                                   'small.dat' : '\0' + data[:5000]})
+            self._writeTree(new, {'large' : '\0' + data[:20000] + 'changed'
+                                            + data[20000:],
+                                  'small.dat' : '\0changed' + data[:5000]})
+
+            patchF = os.path.join(self.wd, 'patch')
+            patchdiff.generateDiff(orig, new, patchF)
+            with zipfile.ZipFile(patchF) as zf:
+                cfg = json.loads(zf.read(patchdiff.PATCH_CFG))
+                self.assertTrue(zf.getinfo(os.path.join(patchdiff.PATCH_DIR,
+                                                        'large')).file_size
+                                < 10000)
+            self.assertEqual(cfg['large']['type'], 'rsync')
+            self.assertEqual(cfg['small.dat']['type'], 'rsync')
+
+            temp = os.path.join(self.wd, 'temp')
+            patchdiff.mergePatches(orig, temp, [patchF])
+            patchdiff.applyPatchDirectory(orig, temp)
+            self._assertSameTree(orig, new)
+        finally:
+            patchdiff.RSYNC_MIN_SIZE = minSize
+            del patchdiff.BINARY_TYPES['.dat']
+
+    def testSortedDifference(self):
+        self.assertEqual(patchdiff._sortedDifference(['a', 'b', 'd', 'e'],
+                                                     ['b', 'c', 'e', 'f']),
+                         ['a', 'd'])
+        self.assertEqual(patchdiff._sortedDifference(['a'], []), ['a'])
+
+    def testDiffWeight(self):
+        self.assertEqual(patchdiff._diffWeight(0, 100), 0)
+        self.assertTrue(patchdiff._diffWeight(100, 100)
+                        > patchdiff._diffWeight(10, 190))
+
+    def testFindAnchors(self):
+        old = ['a', 'b', 'x', 'c', 'd', 'x']
+        new = ['d', 'a', 'b', 'c', 'e']
+        self.assertEqual(patchdiff._findAnchors(old, new),
+                         [(0, 1), (1, 2), (3, 3)])
+
 if __name__ == '__main__':
     unittest.main()
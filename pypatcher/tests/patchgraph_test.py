@@ -0,0 +1,83 @@
+import os
+import json
+import shutil
+import unittest
+import tempfile
+
+from .. import patchgraph
+
+def _patch(frm, to, size):
+    return {
+        'from' : frm,
+        'to' : to,
+        'url' : 'http://www.example.com/%s-%s' % (frm, to),
+        'size' : size,
+        'md5' : '%s-%s' % (frm, to),
+    }
+
+class TestSimple(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp()
+        #a chain of small incrementals and one large cumulative patch
+        self.manifest = {
+            'latest' : '4',
+            'versions' : ['1', '2', '3', '4'],
+            'patches' : [
+                _patch('1', '2', 100),
+                _patch('2', '3', 100),
+                _patch('3', '4', 100),
+                _patch('1', '4', 250),
+                _patch('2', '4', 500),
+            ],
+        }
+        self.graph = patchgraph.PatchGraph(self.manifest)
+
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+
+    def _urls(self, path):
+        return [p['url'].rsplit('/', 1)[1] for p in path]
+
+    def testFewestBytes(self):
+        self.assertEqual(self._urls(self.graph.shortestPath('1')), ['1-4'])
+        self.assertEqual(self._urls(self.graph.shortestPath('2')),
+                         ['2-3', '3-4'])
+        self.assertEqual(self.graph.shortestPath('4'), [])
+
+    def testLeastTime(self):
+        """
+        Tests that with a high latency fewer larger patches are preferred
+        """
+        path = self.graph.shortestPath('2', throughput=1000, latency=0)
+        self.assertEqual(self._urls(path), ['2-3', '3-4'])
+        path = self.graph.shortestPath('2', throughput=1000, latency=1)
+        self.assertEqual(self._urls(path), ['2-4'])
+
+    def testTarget(self):
+        self.assertEqual(self._urls(self.graph.shortestPath('1', '3')),
+                         ['1-2', '2-3'])
+
+    def testNoPath(self):
+        self.assertRaises(patchgraph.PathError,
+                          self.graph.shortestPath, '4', '1')
+        self.assertRaises(patchgraph.PathError,
+                          self.graph.shortestPath, '0')
+
+    def testFromFile(self):
+        fn = os.path.join(self.wd, 'manifest.json')
+        with open(fn, 'w') as f:
+            f.write(json.dumps(self.manifest))
+        graph = patchgraph.PatchGraph.fromFile(fn)
+        self.assertEqual(graph.versions(), ['1', '2', '3', '4'])
+        self.assertEqual(len(graph.patchesFrom('2')), 2)
+
+    def testBadManifest(self):
+        del self.manifest['patches'][0]['md5']
+        self.assertRaises(patchgraph.ManifestError,
+                          patchgraph.PatchGraph, self.manifest)
+        self.assertRaises(patchgraph.ManifestError,
+                          patchgraph.PatchGraph.fromJson, '{')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import shutil
+import random
+import unittest
+import tempfile
+
+from .. import rsyncdelta
+
+class TestSimple(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp()
+        self.rand = random.Random(0)
+        self.old = os.path.join(self.wd, 'old')
+        self.new = os.path.join(self.wd, 'new')
+        self.delta = os.path.join(self.wd, 'delta')
+        self.out = os.path.join(self.wd, 'out')
+
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+
+    def _random(self, length):
+        return ''.join(chr(self.rand.randint(0, 255)) for i in xrange(length))
+
+    def _roundTrip(self, old, new, size=None):
+        with open(self.old, 'wb') as f:
+            f.write(old)
+        with open(self.new, 'wb') as f:
+            f.write(new)
+        rsyncdelta.generate(self.old, self.new, self.delta, size)
+        rsyncdelta.patch(self.old, self.out, self.delta)
+        with open(self.out, 'rb') as f:
+            self.assertEqual(f.read(), new)
+        return os.path.getsize(self.delta)
+
+    def testEdits(self):
+        """
+        Tests that blocks are found after insertions, deletions and changes
+        that aren't on block boundaries
+        """
+        old = self._random(64*1024)
+        new = (old[:1000] + 'inserted' + old[1000:20000] + old[23333:40000]
+               + self._random(100) + old[40100:] + 'appended')
+        size = self._roundTrip(old, new, 512)
+        self.assertTrue(size < 3000)
+
+    def testMoves(self):
+        old = self._random(32*1024)
+        new = old[16*1024:] + old[:16*1024]
+        self.assertTrue(self._roundTrip(old, new, 1024) < 100)
+
+    def testSmall(self):
+        """
+        Tests files smaller than a block, and empty files
+        """
+        self._roundTrip('', 'some data')
+        self._roundTrip('some data', '')
+        self._roundTrip('old', 'new')
+
+    def testBlockSize(self):
+        self.assertEqual(rsyncdelta.blockSize(0), rsyncdelta.MIN_BLOCK_SIZE)
+        size = rsyncdelta.blockSize(3000 * rsyncdelta.MAX_BLOCKS + 1)
+        self.assertEqual(size, 3001)
+
+    def testCorrupt(self):
+        self._roundTrip('some old data' * 1000, 'some new data' * 1000, 512)
+        with open(self.delta, 'r+b') as f:
+            f.truncate(os.path.getsize(self.delta) - 1)
+        self.assertRaises(rsyncdelta.DeltaError,
+                          rsyncdelta.patch, self.old, self.out, self.delta)
+
+if __name__ == '__main__':
+    unittest.main()